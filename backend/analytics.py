@@ -0,0 +1,310 @@
+"""Analisi di performance su una finestra di date: TWR, XIRR, volatilita', drawdown
+e contributo di ogni asset al rendimento.
+
+- Valore del portafoglio: serie degli snapshot (total_value).
+- Flussi esterni (versamenti/prelievi): variazioni di total_invested tra snapshot
+  consecutivi (flows="invested", default) oppure importi dei ribilanciamenti
+  registrati (flows="rebalance"). Un flusso e' attribuito allo snapshot che lo
+  contiene gia' nel valore.
+- TWR: prodotto dei rendimenti tra snapshot al netto dei flussi, quindi non
+  dipende da quando e quanto si e' versato; volatilita' annualizzata e max
+  drawdown sono calcolati sullo stesso indice.
+- XIRR: rendimento money-weighted, risolto con Newton vettorizzato su piu'
+  problemi insieme (portafoglio + un problema per asset) e bisezione per
+  quelli che non convergono.
+- Contributo per asset: guadagno dell'asset nella finestra (valore finale -
+  iniziale - acquisti netti + dividendi) sul capitale medio del portafoglio
+  (denominatore di Modified Dietz). Le quantita' alle date vengono dal registro
+  movimenti, i prezzi da price_history.
+
+I risultati dei period fissi sono memorizzati nella Valuation corrente
+(valuation.cached), quelli degli intervalli from/to espliciti in una LRU limitata
+(window_cache) con la versione dei dati nella chiave: entrambi restano validi
+fino alla prossima scrittura.
+"""
+import calendar
+import math
+import threading
+from collections import OrderedDict
+from datetime import date
+
+import numpy as np
+from sqlalchemy.orm import Session
+
+import ledger
+from models import PriceHistory, RebalanceLog, Snapshot, Transaction
+from schemas import AnalyticsOut, AssetContribution
+from valuation import Valuation
+
+FLOW_SOURCES = {"invested", "rebalance"}
+
+_NEWTON_ITERATIONS = 50
+_BISECT_ITERATIONS = 200
+_XIRR_TOL = 1e-9
+WINDOW_CACHE_SIZE = 64
+
+
+# ---------------------------------------------------------------------------
+# XIRR vettorizzato
+# ---------------------------------------------------------------------------
+def xirr_batch(times: np.ndarray, flows: np.ndarray) -> np.ndarray:
+    """XIRR annuo di k problemi: times (k, m) in anni dall'inizio, flows (k, m).
+
+    I problemi piu' corti si completano con flussi 0. Restituisce NaN dove la
+    soluzione non esiste (flussi tutti dello stesso segno).
+    """
+    k = flows.shape[0]
+    rate = np.full(k, 0.1)
+    done = np.zeros(k, dtype=bool)
+    valid = (flows > 0).any(axis=1) & (flows < 0).any(axis=1)
+
+    # Newton direttamente su r: NPV(r) = sum cf * (1+r)^-t, derivata in d_npv
+    for _ in range(_NEWTON_ITERATIONS):
+        base = 1 + rate[:, None]
+        disc = base ** -times
+        npv = (flows * disc).sum(axis=1)
+        d_npv = (-times * flows * disc / base).sum(axis=1)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            step = np.where(d_npv != 0, npv / d_npv, 0)
+        new_rate = rate - np.where(done, 0, step)
+        ok = np.isfinite(new_rate) & (new_rate > -0.9999)
+        new_rate = np.where(ok, new_rate, rate)
+        converged = np.abs(new_rate - rate) < _XIRR_TOL
+        done |= converged & ok
+        rate = new_rate
+        if done[valid].all():
+            break
+
+    # Bisezione per i problemi rimasti (NPV monotona con flussi convenzionali)
+    for i in np.where(valid & ~done)[0]:
+        rate[i] = _bisect(times[i], flows[i])
+    rate[~valid] = np.nan
+    return rate
+
+
+def _bisect(times: np.ndarray, flows: np.ndarray) -> float:
+    def npv(r):
+        return float((flows * (1 + r) ** -times).sum())
+
+    lo, hi = -0.9999, 10.0
+    f_lo, f_hi = npv(lo), npv(hi)
+    if f_lo * f_hi > 0:
+        return math.nan
+    for _ in range(_BISECT_ITERATIONS):
+        mid = (lo + hi) / 2
+        f_mid = npv(mid)
+        if abs(f_mid) < _XIRR_TOL or hi - lo < _XIRR_TOL:
+            return mid
+        if f_lo * f_mid < 0:
+            hi = mid
+        else:
+            lo, f_lo = mid, f_mid
+    return (lo + hi) / 2
+
+
+# ---------------------------------------------------------------------------
+# Dati
+# ---------------------------------------------------------------------------
+def months_before(day: date, months: int) -> date:
+    """Stesso giorno `months` mesi di calendario prima, limitato alla lunghezza
+    del mese (31/03 - 1 mese = 28 o 29/02)."""
+    index = day.year * 12 + day.month - 1 - months
+    year, month = index // 12, index % 12 + 1
+    return date(year, month, min(day.day, calendar.monthrange(year, month)[1]))
+
+
+def _years(a: str, b: str) -> float:
+    return (date.fromisoformat(b) - date.fromisoformat(a)).days / 365.25
+
+
+def _price_at(db: Session, portfolio_id: int, asset_id: str, day: str) -> float | None:
+    row = (
+        db.query(PriceHistory.close)
+        .filter(PriceHistory.portfolio_id == portfolio_id, PriceHistory.asset_id == asset_id,
+                PriceHistory.date <= day)
+        .order_by(PriceHistory.date.desc())
+        .first()
+    )
+    return row[0] if row else None
+
+
+def _rebalance_flows(db: Session, portfolio_id: int, dates: list[str]) -> list[float]:
+    """Importi dei ribilanciamenti, attribuiti al primo snapshot alla stessa data o successivo."""
+    flows = [0.0] * len(dates)
+    logs = (
+        db.query(RebalanceLog.executed_at, RebalanceLog.amount)
+        .filter(RebalanceLog.portfolio_id == portfolio_id)
+        .order_by(RebalanceLog.executed_at)
+        .all()
+    )
+    for executed_at, amount in logs:
+        day = executed_at.date().isoformat()
+        for i in range(1, len(dates)):
+            if dates[i - 1] < day <= dates[i]:
+                flows[i] += amount
+                break
+    return flows
+
+
+def _asset_rows(db: Session, val: Valuation, start: str, end: str, today: str):
+    """Per ogni asset: (valore iniziale, valore finale, [(data, flusso netto)])."""
+    tx_by_asset: dict[str, list] = {}
+    pid = val.portfolio_id
+    for tx in db.query(Transaction).filter(
+        Transaction.portfolio_id == pid, Transaction.date <= end,
+    ).order_by(Transaction.asset_id, Transaction.date, Transaction.id):
+        tx_by_asset.setdefault(tx.asset_id, []).append(tx)
+
+    rows = []
+    for a in val.assets:
+        txs = tx_by_asset.get(a.id)
+        if txs:
+            qty_start = ledger.replay(t for t in txs if t.date <= start)[0]
+            qty_end = ledger.replay(txs)[0]
+        else:
+            qty_start = qty_end = a.qty
+        p_start = _price_at(db, pid, a.id, start) or a.price
+        p_end = a.price if end >= today else (_price_at(db, pid, a.id, end) or a.price)
+
+        flows = []
+        for t in txs or ():
+            if not (start < t.date <= end):
+                continue
+            if t.type == "buy":
+                flows.append((t.date, t.amount + t.fee))
+            elif t.type == "sell":
+                flows.append((t.date, -(t.amount - t.fee)))
+            elif t.type == "dividend":
+                flows.append((t.date, -t.amount))      # incasso: conta come guadagno
+            elif t.type == "fee":
+                flows.append((t.date, t.amount))
+        rows.append((a, qty_start * p_start, qty_end * p_end, flows))
+    return rows
+
+
+# ---------------------------------------------------------------------------
+# Analisi
+# ---------------------------------------------------------------------------
+def analyze(db: Session, val: Valuation, date_from: str | None = None,
+            date_to: str | None = None, flows: str = "invested") -> AnalyticsOut:
+    query = db.query(Snapshot.date, Snapshot.total_value, Snapshot.total_invested).filter(
+        Snapshot.portfolio_id == val.portfolio_id,
+    )
+    if date_from:
+        query = query.filter(Snapshot.date >= date_from)
+    if date_to:
+        query = query.filter(Snapshot.date <= date_to)
+    snaps = query.order_by(Snapshot.date).all()
+    if len(snaps) < 2:
+        raise ValueError("Servono almeno due snapshot nella finestra")
+
+    dates = [s.date for s in snaps]
+    values = np.array([s.total_value for s in snaps], dtype=float)
+    if flows == "rebalance":
+        flow = np.array(_rebalance_flows(db, val.portfolio_id, dates))
+    else:
+        invested = np.array([s.total_invested for s in snaps], dtype=float)
+        flow = np.concatenate([[0.0], np.diff(invested)])
+    start, end = dates[0], dates[-1]
+    years = max(_years(start, end), 1 / 365.25)
+
+    # TWR e indice
+    prev = values[:-1]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        period = np.where(prev > 0, (values[1:] - flow[1:]) / prev - 1, 0.0)
+    index = np.concatenate([[1.0], np.cumprod(1 + period)])
+    twr = index[-1] - 1
+    peak = np.maximum.accumulate(index)
+    max_dd = float((index / peak - 1).min())
+    if len(period) > 1:
+        per_year = len(period) / years
+        vol = float(np.std(np.log1p(period), ddof=1) * math.sqrt(per_year))
+    else:
+        vol = 0.0
+
+    # Modified Dietz: capitale medio della finestra
+    weights = np.array([1 - _years(start, d) / years for d in dates])
+    denom = values[0] + float((flow * weights).sum())
+
+    # XIRR: portafoglio + un problema per asset, risolti insieme
+    today = date.today().isoformat()
+    assets = _asset_rows(db, val, start, end, today)
+    problems = [[(start, -values[0])] + [(d, -f) for d, f in zip(dates[1:], flow[1:]) if f]
+                + [(end, values[-1])]]
+    for _, v_start, v_end, asset_flows in assets:
+        problems.append([(start, -v_start)] + [(d, -f) for d, f in asset_flows] + [(end, v_end)])
+    width = max(len(p) for p in problems)
+    times = np.zeros((len(problems), width))
+    cfs = np.zeros((len(problems), width))
+    for i, p in enumerate(problems):
+        times[i, :len(p)] = [_years(start, d) for d, _ in p]
+        cfs[i, :len(p)] = [cf for _, cf in p]
+    irr = xirr_batch(times, cfs)
+
+    contributions = []
+    for (a, v_start, v_end, asset_flows), r in zip(assets, irr[1:]):
+        net = sum(f for _, f in asset_flows)
+        gain = v_end - v_start - net
+        contributions.append(AssetContribution(
+            id=a.id,
+            name=a.name,
+            start_value=round(v_start, 2),
+            end_value=round(v_end, 2),
+            net_flows=round(net, 2),
+            gain=round(gain, 2),
+            contribution_pct=round(gain / denom * 100, 2) if denom else 0,
+            xirr_pct=None if math.isnan(r) else round(float(r) * 100, 2) + 0.0,
+        ))
+
+    return AnalyticsOut(
+        start=start,
+        end=end,
+        snapshots=len(snaps),
+        start_value=round(float(values[0]), 2),
+        end_value=round(float(values[-1]), 2),
+        net_flows=round(float(flow[1:].sum()), 2),
+        twr_pct=round(twr * 100, 2),
+        twr_annualized_pct=round(((1 + twr) ** (1 / years) - 1) * 100, 2) if years >= 1 else None,
+        xirr_pct=None if math.isnan(irr[0]) else round(float(irr[0]) * 100, 2),
+        dietz_pct=round(float(values[-1] - values[0] - flow[1:].sum()) / denom * 100, 2) if denom else 0,
+        volatility_pct=round(vol * 100, 2),
+        max_drawdown_pct=round(max_dd * 100, 2),
+        contributions=contributions,
+    )
+
+
+# ---------------------------------------------------------------------------
+# Cache degli intervalli espliciti
+# ---------------------------------------------------------------------------
+class WindowCache:
+    """Analisi su from/to espliciti, LRU di WINDOW_CACHE_SIZE voci.
+
+    La chiave (portfolio_id, versione, from, to, flows) cambia a ogni scrittura,
+    quindi le voci superate escono per anzianita' senza invalidazione esplicita.
+    """
+
+    def __init__(self, size: int = WINDOW_CACHE_SIZE):
+        self._lock = threading.Lock()
+        self._size = size
+        self._entries: OrderedDict[tuple, AnalyticsOut] = OrderedDict()
+
+    def get(self, key: tuple) -> AnalyticsOut | None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key: tuple, result: AnalyticsOut):
+        with self._lock:
+            self._entries[key] = result
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+window_cache = WindowCache()
@@ -0,0 +1,311 @@
+"""Backtest storico di una strategia sui prezzi di price_history.
+
+Il portafoglio parte da `initial_value` investito sui target e ogni primo giorno
+di borsa del mese riceve il contributo, investito con lo stesso algoritmo di
+GET /api/rebalance (rebalance.plan_rebalance, quote intere). Politiche:
+
+- monthly: solo il contributo mensile, senza vendite
+- threshold: come monthly, piu' un ribilanciamento completo ai target quando un
+  peso si allontana dal target di oltre `band_pct` punti
+- none: buy-and-hold, il contributo e' diviso per target senza guardare i pesi
+
+Drawdown e CAGR sono calcolati su un indice time-weighted (i contributi non
+contano come rendimento). Il turnover annuo e' il controvalore scambiato nei
+ribilanciamenti (contributi esclusi) sul valore medio.
+
+Il motore e' incrementale: lo stato (quote, liquidita', indice, curva mensile)
+viene salvato in cache per (portafoglio, target, politica, parametri, inizio) al
+penultimo giorno elaborato. Se lo storico fino a quel giorno non e' cambiato
+(conteggio e somma delle chiusure) si riparte da li' e si elaborano solo le barre nuove;
+l'ultima barra viene sempre rielaborata perche' l'aggiornamento prezzi del
+giorno la riscrive.
+"""
+import math
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, field, replace
+from datetime import date
+
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+
+from history import iter_history
+from models import PriceHistory
+from rebalance import plan_rebalance
+from schemas import BacktestOut, BacktestPoint
+
+BACKTEST_POLICIES = {"monthly", "threshold", "none"}
+
+# Backtest tenuti in cache (LRU)
+CACHE_SIZE = 64
+
+
+@dataclass(frozen=True)
+class _Position:
+    """Asset minimo per rebalance.plan_rebalance."""
+    id: str
+    name: str
+    type: str
+    price: float
+    qty: float
+    target_pct: float
+
+
+@dataclass
+class BacktestState:
+    """Stato del motore dopo l'ultima barra elaborata."""
+    last_date: str | None = None
+    prices: dict[str, float] = field(default_factory=dict)
+    shares: dict[str, float] = field(default_factory=dict)
+    cash: float = 0.0
+    contributed: float = 0.0
+    index: float = 1.0                  # valore time-weighted (base 1)
+    peak: float = 1.0
+    max_drawdown: float = 0.0
+    traded: float = 0.0                 # controvalore dei ribilanciamenti
+    rebalances: int = 0
+    prev_value: float = 0.0             # valore dopo i flussi della barra precedente
+    month: str | None = None
+    points: list[BacktestPoint] = field(default_factory=list)   # un punto per mese chiuso
+    pending: BacktestPoint | None = None                       # mese in corso
+
+    def copy(self) -> "BacktestState":
+        return replace(self, prices=dict(self.prices), shares=dict(self.shares),
+                       points=list(self.points))
+
+
+@dataclass(frozen=True)
+class BacktestParams:
+    portfolio_id: int
+    targets: tuple[tuple[str, float], ...]     # (asset id, target %) con target > 0
+    cash_target: float
+    policy: str
+    mode: str
+    band_pct: float
+    initial_value: float
+    monthly_contribution: float
+    start: str | None
+
+
+# ---------------------------------------------------------------------------
+# Motore
+# ---------------------------------------------------------------------------
+def _value(state: BacktestState) -> float:
+    return sum(state.shares[i] * state.prices[i] for i in state.shares) + state.cash
+
+
+def _positions(state: BacktestState, params: BacktestParams) -> list[_Position]:
+    return [
+        _Position(id=i, name=i, type="etf", price=state.prices[i],
+                  qty=state.shares[i], target_pct=t)
+        for i, t in params.targets
+    ]
+
+
+def _invest(state: BacktestState, params: BacktestParams, amount: float):
+    """Investe `amount` di nuova liquidita' secondo la politica."""
+    state.contributed += amount
+    if params.policy == "none":
+        for i, t in params.targets:
+            n = math.floor(amount * t / 100 / state.prices[i])
+            state.shares[i] += n
+            amount -= n * state.prices[i]
+        state.cash += amount
+        return
+    plan = plan_rebalance(
+        _positions(state, params), state.cash, params.cash_target, amount, params.mode,
+    )
+    for item in plan.plan:
+        state.shares[item.id] += item.shares_delta
+    state.cash = plan.liquidity_after
+
+
+def _rebalance_to_targets(state: BacktestState, params: BacktestParams):
+    total = _value(state)
+    cash = total
+    for i, t in params.targets:
+        n = math.floor(total * t / 100 / state.prices[i])
+        state.traded += abs(n - state.shares[i]) * state.prices[i]
+        state.shares[i] = n
+        cash -= n * state.prices[i]
+    state.cash = cash
+    state.rebalances += 1
+
+
+def _drifted(state: BacktestState, params: BacktestParams) -> bool:
+    total = _value(state)
+    if total <= 0:
+        return False
+    return any(
+        abs(state.shares[i] * state.prices[i] / total * 100 - t) > params.band_pct
+        for i, t in params.targets
+    )
+
+
+def _step(state: BacktestState, params: BacktestParams, day: str, closes: dict[str, float]):
+    """Elabora una barra giornaliera."""
+    state.prices.update(closes)
+    first_bar = state.last_date is None
+    month = day[:7]
+    if state.pending is not None and month != state.month:
+        state.points.append(state.pending)
+
+    # Rendimento della barra, prima dei flussi
+    value = _value(state)
+    if not first_bar and state.prev_value > 0:
+        state.index *= value / state.prev_value
+
+    if first_bar:
+        state.shares = {i: 0.0 for i, _ in params.targets}
+        _invest(state, params, params.initial_value)
+    elif month != state.month and params.monthly_contribution > 0:
+        _invest(state, params, params.monthly_contribution)
+    if params.policy == "threshold" and not first_bar and _drifted(state, params):
+        _rebalance_to_targets(state, params)
+
+    state.prev_value = _value(state)
+    state.peak = max(state.peak, state.index)
+    drawdown = state.index / state.peak - 1
+    state.max_drawdown = min(state.max_drawdown, drawdown)
+    state.month = month
+    state.last_date = day
+    state.pending = BacktestPoint(
+        date=day,
+        value=round(state.prev_value, 2),
+        contributed=round(state.contributed, 2),
+        drawdown_pct=round(drawdown * 100, 2),
+    )
+
+
+def _bars(db: Session, portfolio_id: int, asset_ids: list[str], start: str | None,
+          end: str | None, known: dict[str, float], after: str | None = None):
+    """Barre (giorno, chiusure) in ordine di data, successive ad `after`, solo da
+    quando tutti gli asset hanno un prezzo (quelli gia' noti arrivano in `known`)."""
+    by_day: dict[str, dict[str, float]] = {}
+    for asset_id, day, close in iter_history(db, portfolio_id, asset_ids, after or start, end):
+        if day != after:
+            by_day.setdefault(day, {})[asset_id] = close
+    latest = dict(known)
+    complete = len(latest) == len(asset_ids)
+    for day in sorted(by_day):
+        latest.update(by_day[day])
+        if complete:
+            yield day, by_day[day]
+        elif len(latest) == len(asset_ids):
+            # Prima barra completa: porta con se' le ultime chiusure degli altri asset
+            complete = True
+            yield day, dict(latest)
+
+
+def _fingerprint(db: Session, params: BacktestParams, asset_ids: list[str], until: str):
+    query = db.query(func.count(), func.sum(PriceHistory.close)).filter(
+        PriceHistory.portfolio_id == params.portfolio_id,
+        PriceHistory.asset_id.in_(asset_ids), PriceHistory.date <= until,
+    )
+    if params.start:
+        query = query.filter(PriceHistory.date >= params.start)
+    count, total = query.one()
+    return count, round(total or 0, 6)
+
+
+# ---------------------------------------------------------------------------
+# Cache incrementale
+# ---------------------------------------------------------------------------
+class BacktestCache:
+    def __init__(self, size: int = CACHE_SIZE):
+        self._lock = threading.Lock()
+        self._size = size
+        self._entries: OrderedDict[BacktestParams, tuple[tuple, BacktestState]] = OrderedDict()
+
+    def get(self, key: BacktestParams):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key: BacktestParams, fingerprint: tuple, state: BacktestState):
+        with self._lock:
+            self._entries[key] = (fingerprint, state)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+backtest_cache = BacktestCache()
+
+
+def run_backtest(db: Session, portfolio_id: int, label: str, strategy_id: int | None,
+                 targets: dict[str, float], policy: str = "monthly",
+                 mode: str = "proportional", band_pct: float = 5,
+                 initial_value: float = 10_000, monthly_contribution: float = 0,
+                 start: date | None = None, end: date | None = None) -> BacktestOut:
+    params = BacktestParams(
+        portfolio_id=portfolio_id,
+        targets=tuple(sorted((k, v) for k, v in targets.items() if k != "cash" and v > 0)),
+        cash_target=targets.get("cash", 0),
+        policy=policy, mode=mode, band_pct=band_pct,
+        initial_value=initial_value, monthly_contribution=monthly_contribution,
+        start=start.isoformat() if start else None,
+    )
+    asset_ids = [i for i, _ in params.targets]
+    if not asset_ids:
+        raise ValueError("La strategia non ha target sugli asset")
+    end_s = end.isoformat() if end else None
+
+    # Ripresa dallo stato in cache se lo storico gia' elaborato non e' cambiato
+    state = BacktestState()
+    extended = False
+    cached = backtest_cache.get(params)
+    if cached is not None:
+        fingerprint, checkpoint = cached
+        if (checkpoint.last_date is not None
+                and (end_s is None or checkpoint.last_date < end_s)
+                and _fingerprint(db, params, asset_ids, checkpoint.last_date) == fingerprint):
+            state = checkpoint.copy()
+            extended = True
+
+    bars = list(_bars(db, portfolio_id, asset_ids, params.start, end_s, state.prices,
+                      after=state.last_date))
+    if not bars and state.last_date is None:
+        raise ValueError("Storico prezzi insufficiente: eseguire il backfill degli asset della strategia")
+
+    for day, closes in bars[:-1]:
+        _step(state, params, day, closes)
+    # Checkpoint prima dell'ultima barra, che l'aggiornamento prezzi puo' ancora riscrivere
+    if len(bars) > 1:
+        backtest_cache.put(params, _fingerprint(db, params, asset_ids, state.last_date),
+                           state.copy())
+    if bars:
+        _step(state, params, *bars[-1])
+
+    return _result(state, params, label, strategy_id, policy, extended)
+
+
+def _result(state: BacktestState, params: BacktestParams, label: str,
+            strategy_id: int | None, policy: str, extended: bool) -> BacktestOut:
+    points = state.points + ([state.pending] if state.pending else [])
+    start_day = date.fromisoformat(points[0].date)
+    end_day = date.fromisoformat(points[-1].date)
+    years = max((end_day - start_day).days / 365.25, 1 / 365.25)
+    avg_value = sum(p.value for p in points) / len(points)
+    return BacktestOut(
+        label=label,
+        strategy_id=strategy_id,
+        policy=policy,
+        start=points[0].date,
+        end=points[-1].date,
+        final_value=round(_value(state), 2),
+        contributed=round(state.contributed, 2),
+        twr_pct=round((state.index - 1) * 100, 2),
+        cagr_pct=round((state.index ** (1 / years) - 1) * 100, 2),
+        max_drawdown_pct=round(state.max_drawdown * 100, 2),
+        turnover_pct=round(state.traded / avg_value / years * 100, 2) if avg_value else 0,
+        rebalances=state.rebalances,
+        points=points,
+        extended=extended,
+    )
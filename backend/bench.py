@@ -0,0 +1,113 @@
+"""Benchmark offline di aggiornamento prezzi e ricerca ticker.
+
+Usa LocalQuoteProvider e un database SQLite in memoria, quindi non tocca ne'
+la rete ne' portfolio.db. Con --cache-ttl il provider e' avvolto nella cache
+delle quotazioni e l'aggiornamento viene ripetuto a cache calda. Le stesse
+query di ricerca sono misurate sia sul provider sia sul livello di ricerca con
+cache e indice locale (search.py). Esempio:
+
+    python bench.py --assets 300 --latency-ms 150 --workers 8 --cache-ttl 60
+"""
+import argparse
+import threading
+import time
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+from database import Base
+from models import Asset, Cash
+from prices import refresh_prices
+from quotes import CachedQuoteProvider, LocalQuoteProvider, run_parallel
+from search import TickerSearch
+
+
+def _make_session(n_assets: int):
+    engine = create_engine(
+        "sqlite://",
+        connect_args={"check_same_thread": False},
+        poolclass=StaticPool,
+    )
+    Base.metadata.create_all(bind=engine)
+    db = sessionmaker(bind=engine)()
+    db.add(Cash(id=1, amount=0, target_pct=0))
+    db.add_all(
+        Asset(id=f"a{i}", name=f"Asset {i}", ticker=f"T{i}", yahoo_ticker=f"SYM{i}.MI",
+              qty=10, pmc=100, price=100, target_pct=0)
+        for i in range(n_assets)
+    )
+    db.commit()
+    return db
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--assets", type=int, default=300)
+    parser.add_argument("--latency-ms", type=float, default=100)
+    parser.add_argument("--error-rate", type=float, default=0.02)
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--searches", type=int, default=200)
+    parser.add_argument("--fixture", default=None)
+    parser.add_argument("--cache-ttl", type=float, default=0)
+    args = parser.parse_args()
+
+    provider = LocalQuoteProvider(
+        path=args.fixture, latency_ms=args.latency_ms, error_rate=args.error_rate,
+    )
+    if args.cache_ttl > 0:
+        provider = CachedQuoteProvider(provider, ttl=args.cache_ttl)
+
+    # Richieste contemporanee degli stessi simboli (scheduler + click manuale)
+    if args.cache_ttl > 0:
+        symbols = [f"PAR{i}.MI" for i in range(args.assets)]
+        t0 = time.perf_counter()
+        threads = [
+            threading.Thread(target=run_parallel, args=(provider.get_quote, symbols, args.workers))
+            for _ in range(2)
+        ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - t0
+        cache = provider.cache
+        print(f"concorrenti: 2 x {args.assets} simboli in {elapsed:.3f}s — "
+              f"chiamate={cache.misses} coalescenti={cache.coalesced} hit={cache.hits}")
+
+    db = _make_session(args.assets)
+    try:
+        for label in (["refresh", "refresh (cache)"] if args.cache_ttl > 0 else ["refresh"]):
+            t0 = time.perf_counter()
+            out = refresh_prices(db, max_workers=args.workers, provider=provider)
+            elapsed = time.perf_counter() - t0
+            print(f"{label}: {args.assets} asset in {elapsed:.3f}s "
+                  f"({args.assets / elapsed:.1f} asset/s) — "
+                  f"ok={out.updated} errori={out.errors} saltati={out.skipped}")
+    finally:
+        db.close()
+
+    queries = [f"q{i % 50}" for i in range(args.searches)]
+    t0 = time.perf_counter()
+    for q in queries:
+        try:
+            provider.search(q)
+        except ValueError:
+            pass
+    elapsed = time.perf_counter() - t0
+    print(f"search: {len(queries)} query in {elapsed:.3f}s ({len(queries) / elapsed:.1f} query/s)")
+
+    searcher = TickerSearch(provider=provider)
+    t0 = time.perf_counter()
+    for q in queries:
+        try:
+            searcher.search(q)
+        except ValueError:
+            pass
+    elapsed = time.perf_counter() - t0
+    print(f"search (cache+indice): {len(queries)} query in {elapsed:.3f}s "
+          f"({len(queries) / elapsed:.1f} query/s) — remote={searcher.remote_calls}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,16 +1,78 @@
 import os
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.orm import sessionmaker, declarative_base
 
 DB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "portfolio.db")
 SQLALCHEMY_DATABASE_URL = f"sqlite:///{DB_PATH}"
+ASYNC_DATABASE_URL = f"sqlite+aiosqlite:///{DB_PATH}"
+
+# Profili di storage SQLite, scelti con DB_PROFILE (default "wal").
+# - wal: journal WAL, le letture del dashboard non aspettano le scritture dello
+#   scheduler; synchronous=NORMAL e' sicuro in WAL (si perde al massimo l'ultima
+#   transazione in caso di crash del sistema, mai la consistenza del file).
+# - safe: journal a rollback e synchronous=FULL, il comportamento storico.
+# Ogni valore si puo' sovrascrivere con SQLITE_<PRAGMA>, es. SQLITE_MMAP_SIZE=0.
+STORAGE_PROFILES = {
+    "wal": {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "mmap_size": 256 * 1024 * 1024,
+        "busy_timeout": 5000,          # ms di attesa su un lock prima di "database is locked"
+        "cache_size": -32000,          # KiB (valore negativo) di page cache per connessione
+        "temp_store": "MEMORY",
+    },
+    "safe": {
+        "journal_mode": "DELETE",
+        "synchronous": "FULL",
+        "mmap_size": 0,
+        "busy_timeout": 5000,
+        "cache_size": -2000,
+        "temp_store": "DEFAULT",
+    },
+}
+
+DB_PROFILE = os.environ.get("DB_PROFILE", "wal")
+if DB_PROFILE not in STORAGE_PROFILES:
+    raise RuntimeError(
+        f"DB_PROFILE non valido: {DB_PROFILE}. Ammessi: {', '.join(STORAGE_PROFILES)}"
+    )
+SQLITE_PRAGMAS = {
+    name: os.environ.get(f"SQLITE_{name.upper()}", value)
+    for name, value in STORAGE_PROFILES[DB_PROFILE].items()
+}
 
 engine = create_engine(
     SQLALCHEMY_DATABASE_URL,
     connect_args={"check_same_thread": False},
 )
 
+
+# Engine async (aiosqlite) per gli handler async def delle letture del dashboard:
+# le query girano sul thread di aiosqlite e l'event loop resta libero, quindi un
+# solo worker uvicorn serve molti client anche mentre lo scheduler scrive.
+async_engine = create_async_engine(ASYNC_DATABASE_URL)
+
+
+@event.listens_for(engine, "connect")
+@event.listens_for(async_engine.sync_engine, "connect")
+def _apply_pragmas(dbapi_conn, _record):
+    """Applica il profilo di storage a ogni nuova connessione del pool."""
+    cursor = dbapi_conn.cursor()
+    try:
+        # journal_mode per primo: e' persistente nel file, gli altri valgono per connessione
+        cursor.execute(f"PRAGMA journal_mode={SQLITE_PRAGMAS['journal_mode']}")
+        for name, value in SQLITE_PRAGMAS.items():
+            if name != "journal_mode":
+                cursor.execute(f"PRAGMA {name}={value}")
+    finally:
+        cursor.close()
+
+
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# expire_on_commit=False: gli oggetti restano leggibili dopo il commit senza
+# lazy load (non consentito fuori da un await)
+AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
 
 Base = declarative_base()
 
@@ -21,3 +83,8 @@ def get_db():
         yield db
     finally:
         db.close()
+
+
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
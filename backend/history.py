@@ -0,0 +1,136 @@
+"""Storico prezzi per asset: scrittura bulk, backfill dal provider e lettura a range.
+
+Le chiusure sono in EUR, come Asset.price. Ogni aggiornamento prezzi registra la
+chiusura del giorno; il backfill scarica serie storiche complete dal
+QuoteProvider e le inserisce in executemany con upsert su (asset_id, date).
+"""
+from datetime import date
+from typing import Iterable, Iterator
+
+from sqlalchemy import select
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.orm import Session
+
+from models import Asset, PriceHistory
+from quotes import PRICE_UPDATE_WORKERS, QuoteProvider, get_provider, run_parallel
+from schemas import PriceHistoryBackfillOut, PriceHistoryBackfillResult
+from valuation import bump_version
+
+# Righe per singolo executemany (limita la memoria nei backfill pluridecennali)
+INSERT_CHUNK = 5000
+
+
+def upsert_closes(db: Session, rows: Iterable[dict]) -> int:
+    """Inserisce o aggiorna righe {portfolio_id, asset_id, date, close}. Non esegue commit.
+
+    Una riga esistente con la stessa chiusura non viene riscritta.
+    """
+    stmt = insert(PriceHistory)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[PriceHistory.portfolio_id, PriceHistory.asset_id, PriceHistory.date],
+        set_={"close": stmt.excluded.close},
+        where=PriceHistory.close != stmt.excluded.close,
+    )
+    total = 0
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= INSERT_CHUNK:
+            db.execute(stmt, chunk)
+            total += len(chunk)
+            chunk = []
+    if chunk:
+        db.execute(stmt, chunk)
+        total += len(chunk)
+    return total
+
+
+def _to_eur(closes: list[tuple[str, float]], fx: list[tuple[str, float]]) -> list[tuple[str, float]]:
+    """Converte una serie in EUR con il cambio dello stesso giorno (o l'ultimo noto)."""
+    if not fx:
+        return closes
+    fx_by_day = dict(fx)
+    days = sorted(fx_by_day)
+    out = []
+    rate = fx_by_day[days[0]]
+    i = 0
+    for day, close in closes:
+        while i < len(days) and days[i] <= day:
+            rate = fx_by_day[days[i]]
+            i += 1
+        out.append((day, round(close / rate, 4)))
+    return out
+
+
+def backfill(db: Session, portfolio_id: int, start: date, end: date,
+             asset_ids: list[str] | None = None, provider: QuoteProvider | None = None,
+             max_workers: int | None = None) -> PriceHistoryBackfillOut:
+    """Scarica e salva lo storico giornaliero degli asset richiesti del portafoglio."""
+    provider = provider or get_provider()
+    workers = max_workers or PRICE_UPDATE_WORKERS
+
+    query = db.query(Asset.id, Asset.yahoo_ticker).filter(Asset.portfolio_id == portfolio_id)
+    if asset_ids is not None:
+        query = query.filter(Asset.id.in_(asset_ids))
+    assets = query.order_by(Asset.id).all()
+
+    symbols = sorted({a.yahoo_ticker for a in assets if a.yahoo_ticker})
+    series = run_parallel(lambda s: provider.get_history(s, start, end), symbols, workers)
+    currencies = sorted({
+        s[1] for s in series.values()
+        if not isinstance(s, Exception) and s[1] != "EUR"
+    })
+    fx = run_parallel(lambda c: provider.get_fx_history(c, start, end), currencies, workers)
+
+    results = []
+    inserted = 0
+    for asset in assets:
+        if not asset.yahoo_ticker:
+            results.append(PriceHistoryBackfillResult(id=asset.id, rows=0, status="skipped"))
+            continue
+        data = series[asset.yahoo_ticker]
+        if isinstance(data, Exception):
+            results.append(PriceHistoryBackfillResult(
+                id=asset.id, rows=0, status="error", error=str(data),
+            ))
+            continue
+
+        closes, currency = data
+        if currency != "EUR":
+            rates = fx.get(currency)
+            if isinstance(rates, Exception):
+                results.append(PriceHistoryBackfillResult(
+                    id=asset.id, rows=0, status="error",
+                    error=f"Cambio EUR/{currency} non disponibile: {rates}",
+                ))
+                continue
+            closes = _to_eur(closes, rates)
+
+        n = upsert_closes(db, (
+            {"portfolio_id": portfolio_id, "asset_id": asset.id, "date": day, "close": close}
+            for day, close in closes
+        ))
+        inserted += n
+        results.append(PriceHistoryBackfillResult(id=asset.id, rows=n, status="ok"))
+
+    if inserted:
+        bump_version(db, portfolio_id)
+    db.commit()
+    return PriceHistoryBackfillOut(inserted=inserted, results=results)
+
+
+def iter_history(db: Session, portfolio_id: int, asset_ids: list[str] | None = None,
+                 start: str | None = None, end: str | None = None,
+                 batch_size: int = 2000) -> Iterator[tuple[str, str, float]]:
+    """Legge lo storico in ordine (asset_id, date) senza caricarlo tutto in memoria."""
+    stmt = select(PriceHistory.asset_id, PriceHistory.date, PriceHistory.close).where(
+        PriceHistory.portfolio_id == portfolio_id,
+    )
+    if asset_ids:
+        stmt = stmt.where(PriceHistory.asset_id.in_(asset_ids))
+    if start:
+        stmt = stmt.where(PriceHistory.date >= start)
+    if end:
+        stmt = stmt.where(PriceHistory.date <= end)
+    stmt = stmt.order_by(PriceHistory.asset_id, PriceHistory.date)
+    yield from db.execute(stmt.execution_options(yield_per=batch_size))
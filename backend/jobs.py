@@ -0,0 +1,176 @@
+"""Aggiornamento prezzi come job in background.
+
+POST /api/prices/update non aspetta piu' il download: crea un PriceJob, lo
+esegue sull'executor di APScheduler e restituisce subito l'id. Gli esiti per
+asset arrivano come eventi (result, poi done o error) che l'endpoint SSE
+inoltra al browser man mano che vengono prodotti.
+
+Un solo aggiornamento alla volta: il lock e' preso sia dal job manuale sia dal
+cron delle 09:00, quindi un click non puo' sovrapporsi all'aggiornamento
+pianificato. Un secondo click mentre un job copre gia' il portafoglio si
+aggancia a quel job invece di avviarne un altro. I giri del polling intraday
+(polling.py) aggiornano solo i simboli di un mercato: un click durante un giro
+crea un job "queued" che parte appena il giro finisce (il thread della richiesta
+non aspetta, aspetta il thread dell'executor) e i giri successivi gli cedono il
+passo finche' non e' partito.
+"""
+import asyncio
+import threading
+import uuid
+from datetime import datetime, timezone
+
+from database import SessionLocal
+from prices import refresh_prices
+
+# Job conclusi tenuti in memoria per consultare l'esito
+_KEEP_FINISHED = 20
+
+
+class PriceJob:
+    """Stato ed eventi di un aggiornamento prezzi (portfolio_id None = tutti,
+    symbols None = tutti i simboli)."""
+
+    def __init__(self, portfolio_id: int | None, symbols: set[str] | None = None,
+                 status: str = "running"):
+        self.id = uuid.uuid4().hex
+        self.portfolio_id = portfolio_id
+        self.symbols = symbols
+        self.status = status                     # queued | running | done | error
+        self.started_at = datetime.now(timezone.utc)
+        self.finished_at: datetime | None = None
+        self.result = None                       # PriceUpdateOut a job concluso
+        self.error: str | None = None
+        self.events: list[tuple[str, dict]] = []
+        self.closed = False                      # evento finale (done/error) emesso
+        self._lock = threading.Lock()
+        self._waiters: list[tuple[asyncio.AbstractEventLoop, asyncio.Event]] = []
+        self._done = threading.Event()
+
+    @property
+    def finished(self) -> bool:
+        return self.status in ("done", "error")
+
+    def join(self, timeout: float | None = None) -> bool:
+        """Attende (bloccando il thread) la fine del job; False allo scadere del timeout."""
+        return self._done.wait(timeout)
+
+    def emit(self, event: str, data: dict):
+        """Aggiunge un evento e sveglia i client SSE in attesa (da qualunque thread)."""
+        with self._lock:
+            self.events.append((event, data))
+            self.closed = event in ("done", "error")
+            waiters = list(self._waiters)
+        for loop, flag in waiters:
+            loop.call_soon_threadsafe(flag.set)
+
+    async def wait(self, seen: int, timeout: float) -> bool:
+        """Attende eventi successivi ai primi `seen`; False allo scadere del timeout."""
+        flag = asyncio.Event()
+        entry = (asyncio.get_running_loop(), flag)
+        with self._lock:
+            if len(self.events) > seen:
+                return True
+            self._waiters.append(entry)
+        try:
+            await asyncio.wait_for(flag.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            with self._lock:
+                self._waiters.remove(entry)
+
+
+class PriceJobs:
+    """Registro dei job e lock che impedisce aggiornamenti sovrapposti."""
+
+    def __init__(self):
+        self._run_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self._jobs: dict[str, PriceJob] = {}
+        self.running: PriceJob | None = None
+        self.queued: PriceJob | None = None      # job manuale in attesa di un giro di polling
+
+    def get(self, job_id: str) -> PriceJob | None:
+        return self._jobs.get(job_id)
+
+    def begin(self, portfolio_id: int | None, wait: bool = False,
+              symbols: set[str] | None = None) -> tuple[PriceJob | None, bool]:
+        """Prova ad avviare un job. Restituisce (job, creato); un job creato va
+        passato a run().
+
+        Se un aggiornamento completo in corso o in coda copre gia' il portafoglio
+        richiesto: (quel job, False). Durante un giro di polling un aggiornamento
+        completo senza wait viene messo in coda: (job "queued", True), run() lo
+        avvia alla fine del giro. Negli altri casi con wait=True attende che
+        l'aggiornamento in corso finisca (cron), con wait=False restituisce
+        subito (None, False): il thread della richiesta non resta bloccato.
+        Un giro di polling non parte mentre c'e' un job in coda.
+        """
+        with self._lock:
+            for current in (self.running, self.queued):
+                if (current is not None and current.symbols is None and symbols is None
+                        and current.portfolio_id in (None, portfolio_id)):
+                    return current, False
+            if symbols is not None and self.queued is not None:
+                return None, False
+            acquired = self._run_lock.acquire(blocking=False)
+            if not acquired:
+                polling = self.running is not None and self.running.symbols is not None
+                if not wait and symbols is None and polling and self.queued is None:
+                    self.queued = self._register(PriceJob(portfolio_id, status="queued"))
+                    return self.queued, True
+                if not wait:
+                    return None, False
+        if not acquired:
+            self._run_lock.acquire()
+        with self._lock:
+            job = self._register(PriceJob(portfolio_id, symbols))
+            self.running = job
+            return job, True
+
+    def _register(self, job: PriceJob) -> PriceJob:
+        self._jobs[job.id] = job
+        finished = [j for j in self._jobs.values() if j.finished]
+        for old in finished[:max(0, len(finished) - _KEEP_FINISHED)]:
+            del self._jobs[old.id]
+        return job
+
+    def run(self, job: PriceJob):
+        """Esegue il job avviato con begin() e rilascia il lock. Un job in coda
+        prende prima il lock, aspettando la fine del giro di polling."""
+        if job.status == "queued":
+            self._run_lock.acquire()
+            with self._lock:
+                self.queued = None
+                self.running = job
+                job.status = "running"
+        db = SessionLocal()
+        try:
+            job.result = refresh_prices(
+                db, job.portfolio_id,
+                on_result=lambda r: job.emit("result", r.model_dump()),
+                only_symbols=job.symbols,
+            )
+            job.finished_at = datetime.now(timezone.utc)
+            job.status = "done"
+            job.emit("done", {
+                "updated": job.result.updated,
+                "skipped": job.result.skipped,
+                "errors": job.result.errors,
+            })
+        except Exception as exc:
+            db.rollback()
+            job.finished_at = datetime.now(timezone.utc)
+            job.status = "error"
+            job.error = str(exc)
+            job.emit("error", {"detail": job.error})
+        finally:
+            db.close()
+            with self._lock:
+                self.running = None
+                self._run_lock.release()
+            job._done.set()
+
+
+price_jobs = PriceJobs()
@@ -0,0 +1,294 @@
+"""Registro movimenti: quantita' e prezzo medio di carico derivati dalle transazioni.
+
+Una transazione in coda (data >= ultima data registrata per l'asset) aggiorna
+Asset.qty e Asset.pmc in O(1) partendo dai valori correnti; una transazione
+retrodatata, modificata o cancellata fa ripercorrere tutto il registro dell'asset
+in ordine (date, id).
+
+Il PMC e' la media ponderata del costo di acquisto, commissioni di acquisto
+incluse; le vendite riducono la quantita' lasciando invariato il PMC. Dividendi
+e commissioni sciolte non toccano la posizione ma restano nel registro come
+flussi di cassa.
+
+Se un asset ha gia' una quantita' inserita a mano quando riceve la prima
+transazione, viene registrato un movimento "Saldo iniziale" (buy al PMC corrente)
+datato OPENING_DATE: precede qualsiasi movimento, quindi anche quelli
+retrodatati si applicano sopra la posizione inserita a mano. Per importare lo
+storico completo dal broker si usa replace=True, che lo sostituisce. Da quel
+momento qty e PMC non si modificano piu' a mano (PUT/PATCH /api/assets
+rispondono 400): posizione e registro restano allineati.
+"""
+import csv
+import io
+from datetime import datetime
+
+from sqlalchemy import func, update
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.orm import Session
+
+from models import Asset, Transaction
+from schemas import TransactionImportOut
+from valuation import bump_version
+
+TRANSACTION_TYPES = {"buy", "sell", "dividend", "fee"}
+OPENING_NOTE = "Saldo iniziale"
+OPENING_DATE = "1900-01-01"
+
+# Tolleranza per le quantita' frazionarie (crypto)
+_QTY_EPS = 1e-9
+
+
+def apply(qty: float, pmc: float, tx_type: str, tx_qty: float, price: float,
+          fee: float) -> tuple[float, float]:
+    """Nuova (qty, pmc) dopo un movimento."""
+    if tx_type == "buy":
+        new_qty = qty + tx_qty
+        if new_qty <= _QTY_EPS:
+            return 0.0, 0.0
+        return new_qty, (qty * pmc + tx_qty * price + fee) / new_qty
+    if tx_type == "sell":
+        if tx_qty > qty + _QTY_EPS:
+            raise ValueError(f"Vendita di {tx_qty:g} quote oltre la posizione ({qty:g})")
+        new_qty = qty - tx_qty
+        if new_qty <= _QTY_EPS:
+            return 0.0, 0.0
+        return new_qty, pmc
+    return qty, pmc
+
+
+def replay(rows) -> tuple[float, float]:
+    """(qty, pmc) ripercorrendo i movimenti gia' ordinati per (date, id)."""
+    qty, pmc = 0.0, 0.0
+    for r in rows:
+        qty, pmc = apply(qty, pmc, r.type, r.qty, r.price, r.fee)
+    return qty, pmc
+
+
+def validate(tx_type: str, qty: float, amount: float | None):
+    if tx_type not in TRANSACTION_TYPES:
+        raise ValueError(f"Tipo non valido: {tx_type}. Ammessi: {', '.join(sorted(TRANSACTION_TYPES))}")
+    if tx_type in ("buy", "sell") and qty <= 0:
+        raise ValueError("La quantita' deve essere positiva")
+    if tx_type in ("dividend", "fee") and not amount:
+        raise ValueError("Importo obbligatorio per dividendi e commissioni")
+
+
+def _last_date(db: Session, portfolio_id: int, asset_id: str) -> str | None:
+    return db.query(func.max(Transaction.date)).filter(
+        Transaction.portfolio_id == portfolio_id, Transaction.asset_id == asset_id,
+    ).scalar()
+
+
+def tracked_assets(db: Session, portfolio_id: int, asset_ids: list[str]) -> set[str]:
+    """Asset tra asset_ids che hanno movimenti a registro (una query sull'indice)."""
+    if not asset_ids:
+        return set()
+    rows = db.query(Transaction.asset_id).filter(
+        Transaction.portfolio_id == portfolio_id, Transaction.asset_id.in_(asset_ids),
+    ).distinct()
+    return {asset_id for asset_id, in rows}
+
+
+def _opening(asset: Asset) -> Transaction:
+    return Transaction(
+        portfolio_id=asset.portfolio_id, asset_id=asset.id, date=OPENING_DATE, type="buy", qty=asset.qty, price=asset.pmc,
+        amount=round(asset.qty * asset.pmc, 2), note=OPENING_NOTE,
+    )
+
+
+def recompute(db: Session, asset: Asset):
+    """Ricalcola qty/pmc dell'asset dall'intero registro."""
+    rows = (
+        db.query(Transaction.type, Transaction.qty, Transaction.price, Transaction.fee)
+        .filter(Transaction.portfolio_id == asset.portfolio_id, Transaction.asset_id == asset.id)
+        .order_by(Transaction.date, Transaction.id)
+        .all()
+    )
+    asset.qty, asset.pmc = replay(rows)
+
+
+def post(db: Session, asset: Asset, tx: Transaction) -> bool:
+    """Registra un movimento e aggiorna la posizione. Non esegue commit.
+
+    Restituisce True se e' servito il ricalcolo completo (movimento retrodatato).
+    """
+    last = _last_date(db, asset.portfolio_id, asset.id)
+    if last is None and asset.qty > _QTY_EPS:
+        db.add(_opening(asset))
+    tx.portfolio_id = asset.portfolio_id
+    db.add(tx)
+    db.flush()
+    if last is None or tx.date >= last:
+        asset.qty, asset.pmc = apply(asset.qty, asset.pmc, tx.type, tx.qty, tx.price, tx.fee)
+        return False
+    recompute(db, asset)
+    return True
+
+
+# ---------------------------------------------------------------------------
+# Import CSV
+# ---------------------------------------------------------------------------
+_HEADER_ALIASES = {
+    "date": "date", "data": "date",
+    "asset": "asset", "asset_id": "asset", "isin": "asset", "ticker": "asset", "simbolo": "asset",
+    "type": "type", "tipo": "type", "operazione": "type",
+    "qty": "qty", "quantity": "qty", "quantita": "qty", "quantità": "qty",
+    "price": "price", "prezzo": "price",
+    "fee": "fee", "fees": "fee", "commissioni": "fee",
+    "amount": "amount", "importo": "amount", "controvalore": "amount",
+    "note": "note", "descrizione": "note",
+}
+_TYPE_ALIASES = {
+    "buy": "buy", "acquisto": "buy", "a": "buy",
+    "sell": "sell", "vendita": "sell", "v": "sell",
+    "dividend": "dividend", "dividendo": "dividend", "cedola": "dividend",
+    "fee": "fee", "commissione": "fee", "bollo": "fee",
+}
+
+
+def _number(s: str | None) -> float:
+    """Numero in formato 1234.56, 1,234.56 oppure 1.234,56."""
+    s = (s or "").strip().replace(" ", "").replace("€", "")
+    if not s:
+        return 0.0
+    if "," in s and "." in s:
+        if s.rfind(",") > s.rfind("."):
+            s = s.replace(".", "").replace(",", ".")
+        else:
+            s = s.replace(",", "")
+    elif "," in s:
+        s = s.replace(",", ".")
+    return float(s)
+
+
+def _date(s: str) -> str:
+    s = s.strip()
+    for fmt in ("%Y-%m-%d", "%d/%m/%Y", "%d-%m-%Y", "%d.%m.%Y"):
+        try:
+            return datetime.strptime(s, fmt).date().isoformat()
+        except ValueError:
+            continue
+    raise ValueError(f"Data non valida: {s}")
+
+
+def parse_csv(text: str, assets: list[Asset]) -> tuple[list[dict], list[str]]:
+    """Righe normalizzate {asset_id, date, type, qty, price, fee, amount, note} ed errori."""
+    lookup = {}
+    for a in assets:
+        for key in (a.yahoo_ticker, a.ticker, a.isin, a.id):
+            if key:
+                lookup[key.strip().lower()] = a.id
+
+    first_line = text.split("\n", 1)[0]
+    delimiter = ";" if first_line.count(";") > first_line.count(",") else ","
+    reader = csv.reader(io.StringIO(text), delimiter=delimiter)
+    header = next(reader, None)
+    if not header:
+        return [], ["File vuoto"]
+    columns = [_HEADER_ALIASES.get(h.strip().lower()) for h in header]
+    missing = {"date", "asset", "type"} - set(columns)
+    if missing:
+        return [], [f"Colonne mancanti: {', '.join(sorted(missing))}"]
+
+    rows, errors = [], []
+    for line_no, values in enumerate(reader, start=2):
+        if not any(v.strip() for v in values):
+            continue
+        raw = {c: v for c, v in zip(columns, values) if c}
+        try:
+            asset_id = lookup.get(raw["asset"].strip().lower())
+            if asset_id is None:
+                raise ValueError(f"Asset sconosciuto: {raw['asset']}")
+            tx_type = _TYPE_ALIASES.get(raw["type"].strip().lower(), raw["type"].strip().lower())
+            qty = abs(_number(raw.get("qty")))
+            price = abs(_number(raw.get("price")))
+            fee = abs(_number(raw.get("fee")))
+            amount = abs(_number(raw.get("amount"))) or round(qty * price, 2)
+            validate(tx_type, qty, amount)
+            rows.append({
+                "asset_id": asset_id, "date": _date(raw["date"]), "type": tx_type,
+                "qty": qty, "price": price, "fee": fee, "amount": amount,
+                "note": (raw.get("note") or "").strip(),
+            })
+        except (ValueError, KeyError) as e:
+            errors.append(f"Riga {line_no}: {e}")
+    return rows, errors
+
+
+class _Row:
+    """Movimento da importare, con gli stessi attributi usati da replay()."""
+    __slots__ = ("type", "qty", "price", "fee")
+
+    def __init__(self, type, qty, price, fee, **_):
+        self.type, self.qty, self.price, self.fee = type, qty, price, fee
+
+
+def import_rows(db: Session, portfolio_id: int, rows: list[dict],
+                replace: bool = False) -> TransactionImportOut:
+    """Inserisce i movimenti in blocco e aggiorna le posizioni. Esegue commit.
+
+    Per ogni asset: se tutti i nuovi movimenti sono in coda al registro si
+    applicano in memoria partendo dalla posizione corrente, altrimenti si
+    ripercorre il registro unito. Con replace=True i movimenti importati
+    sostituiscono l'intero registro degli asset coinvolti. Tutto o niente:
+    una vendita oltre la posizione annulla l'import.
+    """
+    by_asset: dict[str, list[dict]] = {}
+    for r in rows:
+        by_asset.setdefault(r["asset_id"], []).append(r)
+    assets = {
+        a.id: a for a in db.query(Asset).filter(
+            Asset.portfolio_id == portfolio_id, Asset.id.in_(by_asset),
+        )
+    }
+
+    recomputed = []
+    positions = []
+    to_insert = []
+    for asset_id, new in by_asset.items():
+        asset = assets[asset_id]
+        new.sort(key=lambda r: r["date"])         # sort stabile: a parita' di data vale l'ordine del file
+        if replace:
+            db.query(Transaction).filter(
+                Transaction.portfolio_id == portfolio_id, Transaction.asset_id == asset_id,
+            ).delete()
+            last, qty, pmc = None, 0.0, 0.0
+        else:
+            last = _last_date(db, portfolio_id, asset_id)
+            qty, pmc = asset.qty, asset.pmc
+            if last is None and qty > _QTY_EPS:
+                to_insert.append({
+                    "portfolio_id": portfolio_id, "asset_id": asset_id, "date": OPENING_DATE, "type": "buy",
+                    "qty": qty, "price": pmc, "fee": 0.0, "amount": round(qty * pmc, 2),
+                    "note": OPENING_NOTE,
+                })
+
+        if last is None or new[0]["date"] >= last:
+            for r in new:
+                qty, pmc = apply(qty, pmc, r["type"], r["qty"], r["price"], r["fee"])
+        else:
+            existing = (
+                db.query(Transaction.date, Transaction.type, Transaction.qty,
+                         Transaction.price, Transaction.fee)
+                .filter(Transaction.portfolio_id == portfolio_id, Transaction.asset_id == asset_id)
+                .order_by(Transaction.date, Transaction.id)
+                .all()
+            )
+            merged = [(e.date, 0, i, e) for i, e in enumerate(existing)]
+            merged += [(r["date"], 1, i, _Row(**r)) for i, r in enumerate(new)]
+            merged.sort(key=lambda m: m[:3])
+            qty, pmc = replay(m[3] for m in merged)
+            recomputed.append(asset_id)
+
+        to_insert.extend({**r, "portfolio_id": portfolio_id} for r in new)
+        positions.append({"portfolio_id": portfolio_id, "id": asset_id, "qty": qty, "pmc": pmc})
+
+    if to_insert:
+        db.execute(insert(Transaction), to_insert)
+    if positions:
+        db.execute(update(Asset), positions)
+        bump_version(db, portfolio_id)
+    db.commit()
+    return TransactionImportOut(
+        imported=len(rows), assets=sorted(by_asset), recomputed=sorted(recomputed),
+    )
@@ -0,0 +1,165 @@
+"""Canale push verso i dashboard (Server-Sent Events, GET /api/events).
+
+Invece di ricaricare portafoglio e strategie dopo ogni scrittura, il frontend
+tiene aperto uno stream per portafoglio e riceve:
+
+- `state`: lo stato completo (PortfolioOut + versione) alla connessione, o
+  quando il client e' rimasto troppo indietro;
+- `delta`: solo cio' che e' cambiato rispetto allo stato precedente (campi
+  modificati degli asset, asset aggiunti/rimossi, liquidita', totali);
+- `reset`: il portafoglio non esiste piu'.
+
+Le modifiche arrivano da valuation.on_data_change (commit con bump_version, in
+qualunque thread). Il delta e' calcolato una volta per portafoglio, non per
+connessione, e solo se qualcuno e' in ascolto; modifiche ravvicinate vengono
+accorpate in un solo calcolo. Le connessioni sono coroutine in attesa su una
+coda: centinaia di dashboard inattivi non occupano thread.
+"""
+import asyncio
+
+# Eventi in coda per connessione prima di passare a un `state` completo
+QUEUE_SIZE = 64
+
+_TOTALS = ("total_value", "total_invested", "total_gain_eur", "total_gain_pct")
+
+
+def diff_state(old: dict, new: dict) -> dict:
+    """Delta tra due PortfolioOut serializzati (solo i campi cambiati)."""
+    delta = {}
+    totals = {k: new[k] for k in _TOTALS if new[k] != old[k]}
+    if totals:
+        delta["totals"] = totals
+    liquidity = {k: v for k, v in new["liquidity"].items() if old["liquidity"].get(k) != v}
+    if liquidity:
+        delta["liquidity"] = liquidity
+
+    old_assets = {a["id"]: a for a in old["etfs"]}
+    assets = {}
+    for a in new["etfs"]:
+        prev = old_assets.get(a["id"])
+        if prev is None:
+            assets[a["id"]] = a                     # aggiunto: oggetto completo
+        else:
+            changed = {k: v for k, v in a.items() if prev.get(k) != v}
+            if changed:
+                assets[a["id"]] = changed
+    if assets:
+        delta["assets"] = assets
+    new_ids = [a["id"] for a in new["etfs"]]
+    removed = [i for i in old_assets if i not in set(new_ids)]
+    if removed:
+        delta["removed"] = removed
+    if removed or any(i not in old_assets for i in new_ids):
+        delta["order"] = new_ids
+    return delta
+
+
+class _Subscriber:
+    def __init__(self):
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+
+    def send(self, event: str, data: dict, state: dict | None):
+        try:
+            self.queue.put_nowait((event, data))
+        except asyncio.QueueFull:
+            # Client lento: si butta via la coda e si rimanda lo stato completo
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            if state is not None:
+                self.queue.put_nowait(("state", state))
+
+
+class LiveHub:
+    """Iscritti per portafoglio e ultimo stato trasmesso.
+
+    Tutto lo stato e' toccato solo dal thread dell'event loop; notify() e'
+    l'unico ingresso da altri thread.
+    """
+
+    def __init__(self):
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._subs: dict[int, set[_Subscriber]] = {}
+        self._last: dict[int, dict] = {}            # portfolio_id -> {version, portfolio}
+        self._busy: set[int] = set()
+        self._dirty: set[int] = set()
+        self._snapshot = None
+
+    def configure(self, snapshot):
+        """snapshot(portfolio_id) -> {"version", "portfolio"} oppure None; bloccante."""
+        self._snapshot = snapshot
+
+    def connections(self) -> int:
+        return sum(len(s) for s in self._subs.values())
+
+    def notify(self, portfolio_ids):
+        """Segnala portafogli modificati (thread-safe, senza costo se nessuno ascolta)."""
+        loop = self._loop
+        if loop is None or not self._subs:
+            return
+        try:
+            loop.call_soon_threadsafe(self._changed, frozenset(portfolio_ids))
+        except RuntimeError:
+            pass                                     # event loop chiuso
+
+    def _changed(self, portfolio_ids):
+        for pid in portfolio_ids:
+            if not self._subs.get(pid):
+                self._last.pop(pid, None)           # nessuno ascolta: stato da rileggere
+            elif pid in self._busy:
+                self._dirty.add(pid)
+            else:
+                self._busy.add(pid)
+                asyncio.ensure_future(self._refresh(pid))
+
+    async def _refresh(self, pid: int):
+        try:
+            while True:
+                self._dirty.discard(pid)
+                state = await asyncio.to_thread(self._snapshot, pid)
+                self._publish(pid, state)
+                if pid not in self._dirty:
+                    break
+        finally:
+            self._busy.discard(pid)
+
+    def _publish(self, pid: int, state: dict | None):
+        subs = self._subs.get(pid, ())
+        if state is None:
+            self._last.pop(pid, None)
+            for sub in subs:
+                sub.send("reset", {}, None)
+            return
+        old = self._last.get(pid)
+        if old is not None and state["version"] <= old["version"]:
+            return
+        self._last[pid] = state
+        if old is None:
+            for sub in subs:
+                sub.send("state", state, state)
+            return
+        delta = {"version": state["version"], **diff_state(old["portfolio"], state["portfolio"])}
+        for sub in subs:
+            sub.send("delta", delta, state)
+
+    async def subscribe(self, pid: int) -> tuple[_Subscriber, dict | None]:
+        """Registra una connessione e restituisce lo stato iniziale da inviarle."""
+        self._loop = asyncio.get_running_loop()
+        sub = _Subscriber()
+        self._subs.setdefault(pid, set()).add(sub)
+        state = await asyncio.to_thread(self._snapshot, pid)
+        if state is not None:
+            old = self._last.get(pid)
+            if old is None or state["version"] > old["version"]:
+                self._last[pid] = state
+        return sub, state
+
+    def unsubscribe(self, pid: int, sub: _Subscriber):
+        subs = self._subs.get(pid)
+        if subs is not None:
+            subs.discard(sub)
+            if not subs:
+                del self._subs[pid]
+                self._last.pop(pid, None)
+
+
+live_hub = LiveHub()
@@ -1,188 +1,245 @@
+import asyncio
 import json
-import math
-from datetime import datetime, timezone
+import zlib
+from collections import Counter
+from dataclasses import replace
+from datetime import date, datetime, timezone
 
 from apscheduler.schedulers.background import BackgroundScheduler
-from fastapi import FastAPI, Depends, HTTPException, Query
+from fastapi import FastAPI, Depends, Header, HTTPException, Query, Request, Response
+from fastapi.responses import StreamingResponse
 from fastapi.staticfiles import StaticFiles
-from sqlalchemy import text, inspect
+from sqlalchemy import bindparam, select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 
-from database import engine, get_db, Base
-from models import Asset, Cash, Snapshot, Strategy, StrategyHistory, RebalanceLog
+from analytics import FLOW_SOURCES, analyze, months_before, window_cache
+from backtest import BACKTEST_POLICIES, run_backtest
+from database import engine, get_async_db, get_db, AsyncSessionLocal, SessionLocal
+from history import backfill, iter_history
+from jobs import PriceJob, price_jobs
+from live import live_hub
+import ledger
+from migrations import run_migrations
+from montecarlo import (
+    CONTRIBUTION_RULES, model_from_assumptions, model_from_history, run_montecarlo,
+)
+from models import (
+    Asset, Cash, DataVersion, PriceHistory, Snapshot, Strategy, StrategyHistory, StrategyTarget,
+    RebalanceLog, Transaction, Portfolio, DEFAULT_PORTFOLIO_ID,
+)
+from polling import INTRADAY_POLLING, poller
+from quotes import get_provider
+from rebalance import REBALANCE_MODES, plan_rebalance
 from schemas import (
     AssetCreate,
     AssetUpdate,
     AssetOut,
+    AssetsPatch,
+    AssetsPatchOut,
     CashUpdate,
     CashOut,
     PortfolioOut,
+    PortfolioCreate,
+    PortfolioInfo,
     TargetsUpdate,
     RebalanceOut,
     RebalancePlanItem,
+    RebalanceRequest,
+    SimulationRequest,
+    MonteCarloRequest,
+    MonteCarloOut,
+    BacktestRequest,
+    BacktestOut,
+    TransactionCreate,
+    TransactionOut,
+    TransactionImport,
+    TransactionImportOut,
+    SimulationOut,
     RebalanceLogCreate,
     RebalanceLogOut,
     SnapshotCreate,
     SnapshotOut,
     SummaryOut,
+    AnalyticsOut,
     StrategyCreate,
     StrategyUpdate,
     StrategyOut,
     StrategyHistoryOut,
-    PriceUpdateResult,
-    PriceUpdateOut,
+    MarketPollOut,
+    PriceJobOut,
+    PriceHistoryBackfill,
+    PriceHistoryBackfillOut,
     TickerSearchResult,
 )
+from search import ticker_search
+from seed import ensure_portfolio, seed_portfolio
+from simulate import run_simulation
+from snapshots import RESOLUTIONS, query_snapshots, write_daily_snapshot
+from strategies import (
+    activate_targets, delete_targets, remove_asset_key, set_targets, targets_by_strategy,
+    unknown_keys,
+)
+from valuation import (
+    AssetRow, Valuation, bump_version, current_version, current_version_async, on_data_change,
+    valuation_cache,
+)
 
 app = FastAPI(title="Portfolio Tracker", version="1.4.0")
 _scheduler = BackgroundScheduler()
 
+
 # ---------------------------------------------------------------------------
-# Tipi di asset ammessi
+# GET condizionali: ETag dalla versione dei dati
 # ---------------------------------------------------------------------------
-ASSET_TYPES = {"etf", "etc", "azione", "crypto", "obbligazione"}
+# GET /api/* che non dipendono dalla versione dei dati del portafoglio
+# (risultati da provider esterni, elenco dei portafogli, stato del polling)
+_ETAG_EXCLUDED = {"/api/ticker/search", "/api/portfolios", "/api/events", "/api/prices/polling"}
+# Stato e stream dei job in background
+_ETAG_EXCLUDED_PREFIXES = ("/api/prices/jobs/",)
+
 
+async def _data_version(portfolio_id: int) -> int | None:
+    async with AsyncSessionLocal() as db:
+        return await current_version_async(db, portfolio_id)
+
+
+def _request_portfolio_id(request: Request) -> int | None:
+    """Portafoglio della richiesta come in portfolio_scope; None se non valido."""
+    raw = request.query_params.get("portfolio") or request.headers.get("x-portfolio-id")
+    if not raw:
+        return DEFAULT_PORTFOLIO_ID
+    try:
+        return int(raw)
+    except ValueError:
+        return None
+
+
+@app.middleware("http")
+async def conditional_get(request: Request, call_next):
+    """ETag forte su tutte le GET /api/*: portafoglio + versione dei suoi dati + hash dell'URL.
+
+    Con If-None-Match corrispondente risponde 304 prima di toccare ORM e
+    serializzazione pydantic: costa solo la lettura del contatore data_version.
+    """
+    path = request.url.path
+    if (request.method != "GET" or not path.startswith("/api/") or path in _ETAG_EXCLUDED
+            or path.startswith(_ETAG_EXCLUDED_PREFIXES)):
+        return await call_next(request)
+
+    portfolio_id = _request_portfolio_id(request)
+    version = None
+    if portfolio_id is not None:
+        version = await _data_version(portfolio_id)
+    if version is None:
+        # Portafoglio inesistente o non valido: risponde portfolio_scope con l'errore
+        return await call_next(request)
+    # Riusata da portfolio_scope e dalla cache di valorizzazione: una sola lettura
+    request.state.data_version = (portfolio_id, version)
+    url_hash = zlib.crc32(f"{path}?{request.url.query}".encode())
+    etag = f'"p{portfolio_id}-v{version}-{url_hash:08x}"'
+    headers = {"ETag": etag, "Cache-Control": "no-cache", "Vary": "X-Portfolio-Id"}
+
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and (if_none_match.strip() == "*" or
+                          etag in (t.strip() for t in if_none_match.split(","))):
+        return Response(status_code=304, headers=headers)
+
+    response = await call_next(request)
+    if response.status_code == 200:
+        response.headers.update(headers)
+    return response
+
+
+@app.middleware("http")
+async def data_version_header(request: Request, call_next):
+    """X-Data-Version sulle scritture riuscite: versione dei dati dopo il commit.
+    Il frontend aspetta che il canale push (/api/events) la raggiunga invece di
+    ricaricare il portafoglio."""
+    response = await call_next(request)
+    if (request.method in ("POST", "PUT", "PATCH", "DELETE") and request.url.path.startswith("/api/")
+            and response.status_code < 400):
+        portfolio_id = _request_portfolio_id(request)
+        if portfolio_id is not None:
+            version = await _data_version(portfolio_id)
+            if version is not None:
+                response.headers["X-Data-Version"] = str(version)
+    return response
+
+
+# ---------------------------------------------------------------------------
+# Portafoglio della richiesta
 # ---------------------------------------------------------------------------
-# Startup: migrate, create tables & seed data
-# ---------------------------------------------------------------------------
-SEED_DATA = [
-    {
-        "id": "world",
-        "name": "MSCI AC World",
-        "ticker": "Xtrackers MSCI AC World Scr. UCITS ETF 1C",
-        "type": "etf",
-        "qty": 211,
-        "pmc": 40.0320,
-        "price": 44.6650,
-        "target_pct": 70,
-    },
-    {
-        "id": "em",
-        "name": "Emerging Markets",
-        "ticker": "Xtrackers MSCI Emerging Markets UCITS ETF 1C",
-        "type": "etf",
-        "qty": 15,
-        "pmc": 64.4460,
-        "price": 71.7520,
-        "target_pct": 15,
-    },
-    {
-        "id": "gold",
-        "name": "Gold ETC",
-        "ticker": "Invesco Physical Gold ETC",
-        "type": "etc",
-        "qty": 2,
-        "pmc": 272.0300,
-        "price": 409.0900,
-        "target_pct": 10,
-    },
-    {
-        "id": "bond13",
-        "name": "Bond 1-3Y",
-        "ticker": "iShares EUR Govt Bond 1-3yr UCITS ETF EUR (Acc)",
-        "type": "etf",
-        "qty": 32,
-        "pmc": 114.0963,
-        "price": 116.4300,
-        "target_pct": 5,
-    },
-    {
-        "id": "bond710",
-        "name": "Bond 7-10Y",
-        "ticker": "Amundi Euro Government Bond 7-10Y UCITS ETF Acc",
-        "type": "etf",
-        "qty": 17,
-        "pmc": 166.2000,
-        "price": 172.4300,
-        "target_pct": 0,
-    },
-]
-
-
-def _migrate_etfs_to_assets():
-    """Migra la tabella 'etfs' in 'assets' se necessario (aggiunta v1.3)."""
-    inspector = inspect(engine)
-    tables = inspector.get_table_names()
-
-    if "etfs" in tables and "assets" not in tables:
-        with engine.begin() as conn:
-            conn.execute(text("ALTER TABLE etfs RENAME TO assets"))
-            conn.execute(text("ALTER TABLE assets ADD COLUMN type TEXT DEFAULT 'etf'"))
-            conn.execute(text("ALTER TABLE assets ADD COLUMN isin TEXT"))
-            conn.execute(text("ALTER TABLE assets ADD COLUMN yahoo_ticker TEXT"))
-            conn.execute(text("UPDATE assets SET type = 'etc' WHERE id = 'gold'"))
+async def portfolio_scope(
+    request: Request,
+    portfolio: int | None = Query(None, description="Id del portafoglio (in alternativa all'header)"),
+    x_portfolio_id: int | None = Header(None),
+    db: AsyncSession = Depends(get_async_db),
+) -> int:
+    """Id del portafoglio su cui lavora la richiesta: query `portfolio`, header
+    X-Portfolio-Id oppure il portafoglio predefinito. Tutte le query degli
+    endpoint filtrano su questo id (prima colonna delle chiavi e degli indici)."""
+    portfolio_id = portfolio or x_portfolio_id or DEFAULT_PORTFOLIO_ID
+    # Versione gia' letta dal middleware delle GET: il portafoglio esiste
+    known = getattr(request.state, "data_version", None)
+    if known is not None and known[0] == portfolio_id:
+        return portfolio_id
+    if await db.get(Portfolio, portfolio_id) is None:
+        raise HTTPException(status_code=404, detail="Portafoglio non trovato")
+    return portfolio_id
+
 
+# ---------------------------------------------------------------------------
+# Tipi di asset ammessi
+# ---------------------------------------------------------------------------
+ASSET_TYPES = {"etf", "etc", "azione", "crypto", "obbligazione"}
 
+# ---------------------------------------------------------------------------
+# Startup: migrazioni versionate (schema e seed) e scheduler
+# ---------------------------------------------------------------------------
 @app.on_event("startup")
 def startup():
-    """Crea le tabelle, inserisce i dati iniziali e avvia lo scheduler."""
-    # Migrazione etfs → assets (prima di create_all)
-    _migrate_etfs_to_assets()
-
-    Base.metadata.create_all(bind=engine)
+    """Applica le migrazioni mancanti (incluso il seed iniziale) e avvia lo scheduler."""
+    run_migrations(engine)
     db = next(get_db())
     try:
-        # Seed Asset
-        if db.query(Asset).count() == 0:
-            for item in SEED_DATA:
-                db.add(Asset(**item))
-            db.commit()
-
-        # Seed Cash
-        if db.query(Cash).count() == 0:
-            db.add(Cash(id=1, amount=0, target_pct=0))
-            db.commit()
-
-        # Seed strategia predefinita (solo se non ne esiste nessuna)
-        if db.query(Strategy).count() == 0:
-            seed_targets = {s["id"]: s["target_pct"] for s in SEED_DATA}
-            seed_targets["cash"] = 0
-            now = datetime.now(timezone.utc)
-            db.add(Strategy(
-                name="Predefinita",
-                description="Allocazione iniziale del portafoglio",
-                targets_json=json.dumps(seed_targets),
-                is_active=True,
-                activated_at=now,
-            ))
-            db.add(StrategyHistory(
-                strategy_name="Predefinita",
-                activated_at=now,
-            ))
-            db.commit()
-
-        # Template pronti all'uso: aggiunge solo quelli che non esistono gia'
-        STRATEGY_TEMPLATES = [
-            ("Aggressiva 20Y", "Orizzonte lungo, forte azionario",
-             {"world": 75, "em": 15, "gold": 5, "bond13": 0, "bond710": 0, "cash": 5}),
-            ("Moderata 10Y", "Bilanciata, orizzonte medio",
-             {"world": 50, "em": 10, "gold": 10, "bond13": 15, "bond710": 5, "cash": 10}),
-            ("Pre-pensione", "Conservativa, alta liquidita e bond",
-             {"world": 30, "em": 5, "gold": 10, "bond13": 25, "bond710": 10, "cash": 20}),
-        ]
-        for name, desc, targets in STRATEGY_TEMPLATES:
-            if not db.query(Strategy).filter(Strategy.name == name).first():
-                db.add(Strategy(
-                    name=name, description=desc,
-                    targets_json=json.dumps(targets),
-                ))
-        db.commit()
+        # Indice locale della ricerca ticker: gli strumenti gia' in portafoglio
+        for asset in db.query(Asset).filter(Asset.yahoo_ticker.isnot(None)):
+            ticker_search.learn_asset(asset)
     finally:
         db.close()
 
-    # Avvia lo scheduler per l'aggiornamento prezzi automatico
+    # Avvia lo scheduler: aggiornamento prezzi condiviso seguito dagli snapshot del giorno
     def _scheduled_price_update():
+        # Stesso lock dei job manuali: se un aggiornamento e' in corso lo aspetta
+        job, created = price_jobs.begin(None, wait=True)
+        if created:
+            price_jobs.run(job)
+        else:
+            # Un aggiornamento completo di tutti i portafogli e' gia' in corso:
+            # lo esegue chi l'ha avviato, qui si aspetta solo che finisca
+            job.join()
+        if job.status == "error":
+            print(f"[scheduler] Errore auto-update prezzi: {job.error}")
         db = next(get_db())
         try:
-            _do_price_update(db)
-        except Exception as exc:
-            print(f"[scheduler] Errore auto-update prezzi: {exc}")
+            for (portfolio_id,) in db.query(Portfolio.id).order_by(Portfolio.id).all():
+                try:
+                    write_daily_snapshot(db, portfolio_id)
+                except Exception as exc:
+                    db.rollback()
+                    print(f"[scheduler] Errore snapshot giornaliero (portafoglio {portfolio_id}): {exc}")
         finally:
             db.close()
 
-    _scheduler.add_job(_scheduled_price_update, "cron", hour=9, minute=0)
+    _scheduler.add_job(_scheduled_price_update, "cron", hour=9, minute=0, id="prices-daily")
+    # Polling intraday per mercato (solo simboli del mercato, solo a mercato aperto)
+    if INTRADAY_POLLING:
+        poller.start(_scheduler)
     _scheduler.start()
-    print("[scheduler] Avviato — auto-update prezzi ogni giorno alle 09:00")
+    print("[scheduler] Avviato — auto-update prezzi e snapshot ogni giorno alle 09:00"
+          + (", polling intraday per mercato" if INTRADAY_POLLING else ""))
 
 
 @app.on_event("shutdown")
@@ -193,7 +250,7 @@ def shutdown():
 # ---------------------------------------------------------------------------
 # Helpers
 # ---------------------------------------------------------------------------
-def _build_asset_out(asset: Asset, total_value: float) -> AssetOut:
+def _build_asset_out(asset: Asset | AssetRow, total_value: float, tracked: bool = False) -> AssetOut:
     value = round(asset.price * asset.qty, 2)
     invested = round(asset.pmc * asset.qty, 2)
     gain_eur = round(value - invested, 2)
@@ -216,52 +273,149 @@ def _build_asset_out(asset: Asset, total_value: float) -> AssetOut:
         gain_pct=gain_pct,
         weight_pct=weight_pct,
         delta_pct=delta_pct,
+        ledger=tracked,
     )
 
 
-def _get_cash(db: Session) -> Cash:
-    cash = db.query(Cash).first()
+def _get_cash(db: Session, portfolio_id: int) -> Cash:
+    cash = db.query(Cash).filter(Cash.portfolio_id == portfolio_id).first()
     if not cash:
-        cash = Cash(id=1, amount=0, target_pct=0)
+        cash = Cash(portfolio_id=portfolio_id, amount=0, target_pct=0)
         db.add(cash)
         db.commit()
         db.refresh(cash)
     return cash
 
 
-def _total_value(db: Session) -> float:
-    assets = db.query(Asset).all()
-    cash = _get_cash(db)
-    return sum(a.price * a.qty for a in assets) + cash.amount
+def _get_asset(db: Session, portfolio_id: int, asset_id: str) -> Asset | None:
+    return db.get(Asset, (portfolio_id, asset_id))
 
 
-def _total_invested(db: Session) -> float:
-    assets = db.query(Asset).all()
-    cash = _get_cash(db)
-    return sum(a.pmc * a.qty for a in assets) + cash.amount
+def _valuation(db: Session, portfolio_id: int) -> Valuation:
+    """Asset, liquidita' e totali dalla cache (ricalcolati solo se i dati sono cambiati)."""
+    return valuation_cache.get(db, portfolio_id)
+
+
+async def _valuation_async(db: AsyncSession, portfolio_id: int, request: Request) -> Valuation:
+    """Come _valuation per gli handler async; riusa la versione letta per l'ETag."""
+    known = getattr(request.state, "data_version", None)
+    version = known[1] if known is not None and known[0] == portfolio_id else None
+    return await valuation_cache.get_async(db, portfolio_id, version)
+
+
+# ---------------------------------------------------------------------------
+# Portafogli — GET/POST /api/portfolios, DELETE /api/portfolios/{id}
+# ---------------------------------------------------------------------------
+@app.get("/api/portfolios", response_model=list[PortfolioInfo])
+def list_portfolios(db: Session = Depends(get_db)):
+    return db.query(Portfolio).order_by(Portfolio.id).all()
+
+
+@app.post("/api/portfolios", response_model=PortfolioInfo, status_code=201)
+def create_portfolio(data: PortfolioCreate, db: Session = Depends(get_db)):
+    """Crea un portafoglio vuoto (con seed=True: asset di esempio e strategie)."""
+    if db.query(Portfolio.id).filter(Portfolio.name == data.name).first():
+        raise HTTPException(status_code=400, detail="Esiste gia' un portafoglio con questo nome")
+    portfolio = Portfolio(name=data.name)
+    db.add(portfolio)
+    db.flush()
+    ensure_portfolio(db, portfolio.id, data.name)
+    if data.seed:
+        seed_portfolio(db, portfolio.id)
+    db.refresh(portfolio)
+    return portfolio
+
+
+@app.delete("/api/portfolios/{portfolio_id}")
+def delete_portfolio(portfolio_id: int, db: Session = Depends(get_db)):
+    """Elimina un portafoglio con tutti i suoi dati. Il predefinito non si elimina."""
+    portfolio = db.get(Portfolio, portfolio_id)
+    if not portfolio:
+        raise HTTPException(status_code=404, detail="Portafoglio non trovato")
+    if portfolio_id == DEFAULT_PORTFOLIO_ID:
+        raise HTTPException(status_code=400, detail="Non puoi eliminare il portafoglio predefinito")
+    for model in (Asset, Cash, Snapshot, Strategy, StrategyTarget, StrategyHistory, RebalanceLog,
+                  Transaction, PriceHistory):
+        db.query(model).filter(model.portfolio_id == portfolio_id).delete()
+    db.query(DataVersion).filter(DataVersion.id == portfolio_id).delete()
+    db.delete(portfolio)
+    db.commit()
+    valuation_cache.discard(portfolio_id)
+    live_hub.notify({portfolio_id})
+    return {"status": "ok"}
 
 
 # ---------------------------------------------------------------------------
 # GET /api/portfolio
 # ---------------------------------------------------------------------------
 @app.get("/api/portfolio", response_model=PortfolioOut)
-def get_portfolio(db: Session = Depends(get_db)):
-    assets = db.query(Asset).all()
-    cash = _get_cash(db)
-    asset_val = sum(a.price * a.qty for a in assets)
-    total_val = asset_val + cash.amount
-    total_inv = sum(a.pmc * a.qty for a in assets) + cash.amount
+async def get_portfolio(request: Request, pid: int = Depends(portfolio_scope),
+                        db: AsyncSession = Depends(get_async_db)):
+    val = await _valuation_async(db, pid, request)
+    return val.cached("portfolio", lambda: _build_portfolio_out(val))
+
+
+def _live_state(portfolio_id: int) -> dict | None:
+    """Stato completo per il canale push: stesso PortfolioOut di GET /api/portfolio."""
+    with SessionLocal() as db:
+        if current_version(db, portfolio_id) is None:
+            return None
+        val = _valuation(db, portfolio_id)
+        out = val.cached("portfolio", lambda: _build_portfolio_out(val))
+        return {"version": val.version, "portfolio": out.model_dump()}
+
+
+live_hub.configure(_live_state)
+on_data_change(live_hub.notify)
+
+
+@app.get("/api/events")
+async def portfolio_events(request: Request):
+    """Canale push del portafoglio (Server-Sent Events): `state` completo alla
+    connessione, poi `delta` con i soli campi cambiati dopo ogni scrittura.
+
+    Il portafoglio si indica con ?portfolio= (EventSource non invia header).
+    """
+    pid = _request_portfolio_id(request)
+    if pid is None or await _data_version(pid) is None:
+        raise HTTPException(status_code=404, detail="Portafoglio non trovato")
+
+    async def stream():
+        sub, state = await live_hub.subscribe(pid)
+        try:
+            yield "retry: 3000\n\n"
+            if state is None:
+                yield "event: reset\ndata: {}\n\n"
+                return
+            yield f"event: state\ndata: {json.dumps(state)}\n\n"
+            while True:
+                try:
+                    event, data = await asyncio.wait_for(sub.queue.get(), 15)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                yield f"event: {event}\ndata: {json.dumps(data)}\n\n"
+                if event == "reset":
+                    return
+        finally:
+            live_hub.unsubscribe(pid, sub)
+
+    return StreamingResponse(stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+def _build_portfolio_out(val: Valuation) -> PortfolioOut:
+    total_val = val.total_value
+    total_inv = val.total_invested
     gain_eur = round(total_val - total_inv, 2)
     gain_pct = round((gain_eur / total_inv * 100) if total_inv else 0, 2)
 
-    cash_weight = round((cash.amount / total_val * 100) if total_val else 0, 2)
-
     return PortfolioOut(
-        etfs=[_build_asset_out(a, total_val) for a in assets],
+        etfs=[_build_asset_out(a, total_val, a.ledger) for a in val.assets],
         liquidity=CashOut(
-            amount=cash.amount,
-            target_pct=cash.target_pct,
-            weight_pct=cash_weight,
+            amount=val.cash_amount,
+            target_pct=val.cash_target_pct,
+            weight_pct=val.weight_pct(val.cash_amount),
         ),
         total_value=round(total_val, 2),
         total_invested=round(total_inv, 2),
@@ -274,16 +428,21 @@ def get_portfolio(db: Session = Depends(get_db)):
 # POST /api/assets — Aggiunge un nuovo strumento
 # ---------------------------------------------------------------------------
 @app.post("/api/assets", response_model=AssetOut, status_code=201)
-def create_asset(data: AssetCreate, db: Session = Depends(get_db)):
+def create_asset(data: AssetCreate, pid: int = Depends(portfolio_scope),
+                 db: Session = Depends(get_db)):
     if data.type not in ASSET_TYPES:
         raise HTTPException(
             status_code=400,
             detail=f"Tipo non valido. Ammessi: {', '.join(sorted(ASSET_TYPES))}",
         )
-    if db.query(Asset).filter(Asset.id == data.id).first():
+    if _get_asset(db, pid, data.id):
         raise HTTPException(status_code=400, detail=f"Esiste gia' un asset con id '{data.id}'")
 
+    # Totale aggiornato in modo incrementale: niente nuova scansione della tabella
+    total_before = _valuation(db, pid).total_value
+
     asset = Asset(
+        portfolio_id=pid,
         id=data.id,
         name=data.name,
         ticker=data.ticker,
@@ -296,69 +455,151 @@ def create_asset(data: AssetCreate, db: Session = Depends(get_db)):
         target_pct=data.target_pct,
     )
     db.add(asset)
+    bump_version(db, pid)
     db.commit()
     db.refresh(asset)
+    ticker_search.learn_asset(asset)
 
-    total_val = _total_value(db)
-    return _build_asset_out(asset, total_val)
+    return _build_asset_out(asset, total_before + asset.price * asset.qty)
 
 
 # ---------------------------------------------------------------------------
 # PUT /api/assets/{id}
 # ---------------------------------------------------------------------------
 @app.put("/api/assets/{asset_id}", response_model=AssetOut)
-def update_asset(asset_id: str, data: AssetUpdate, db: Session = Depends(get_db)):
-    asset = db.query(Asset).filter(Asset.id == asset_id).first()
+def update_asset(asset_id: str, data: AssetUpdate, pid: int = Depends(portfolio_scope),
+                 db: Session = Depends(get_db)):
+    asset = _get_asset(db, pid, asset_id)
     if not asset:
         raise HTTPException(status_code=404, detail="Asset not found")
 
-    if data.price is not None:
-        asset.price = data.price
-    if data.pmc is not None:
-        asset.pmc = data.pmc
-    if data.qty is not None:
-        asset.qty = data.qty
-    if data.yahoo_ticker is not None:
-        asset.yahoo_ticker = data.yahoo_ticker
-    if data.isin is not None:
-        asset.isin = data.isin
-    if data.type is not None:
-        if data.type not in ASSET_TYPES:
-            raise HTTPException(
-                status_code=400,
-                detail=f"Tipo non valido. Ammessi: {', '.join(sorted(ASSET_TYPES))}",
-            )
-        asset.type = data.type
+    _check_asset_type(data.type)
+    tracked = bool(ledger.tracked_assets(db, pid, [asset_id]))
+    if tracked:
+        _check_position_edit([(asset_id, data)])
 
-    asset.updated_at = datetime.now(timezone.utc)
+    total_before = _valuation(db, pid).total_value
+    value_before = asset.price * asset.qty
+    _patch_asset(asset, data, datetime.now(timezone.utc))
+    bump_version(db, pid)
     db.commit()
     db.refresh(asset)
+    ticker_search.learn_asset(asset)
+
+    return _build_asset_out(asset, total_before - value_before + asset.price * asset.qty, tracked)
+
+
+def _check_asset_type(asset_type: str | None):
+    if asset_type is not None and asset_type not in ASSET_TYPES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Tipo non valido. Ammessi: {', '.join(sorted(ASSET_TYPES))}",
+        )
 
-    total_val = _total_value(db)
-    return _build_asset_out(asset, total_val)
+
+def _check_position_edit(patches: list[tuple[str, AssetUpdate]]):
+    """qty e PMC degli asset con movimenti derivano dal registro: niente modifiche a mano."""
+    edited = [asset_id for asset_id, p in patches if p.qty is not None or p.pmc is not None]
+    if edited:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Quantita' e PMC derivano dal registro movimenti: {', '.join(edited)}. "
+                   "Registra un movimento invece di modificarli.",
+        )
+
+
+def _patch_asset(asset: Asset, data: AssetUpdate, now: datetime):
+    """Applica i campi valorizzati di un AssetUpdate (gia' validato)."""
+    for field in ("price", "pmc", "qty", "yahoo_ticker", "isin", "type"):
+        value = getattr(data, field)
+        if value is not None:
+            setattr(asset, field, value)
+    asset.updated_at = now
+
+
+# ---------------------------------------------------------------------------
+# PATCH /api/assets — modifica di piu' asset in una transazione
+# ---------------------------------------------------------------------------
+@app.patch("/api/assets", response_model=AssetsPatchOut)
+def patch_assets(data: AssetsPatch, pid: int = Depends(portfolio_scope),
+                 db: Session = Depends(get_db)):
+    """Valida tutte le modifiche e le applica insieme (tutto o niente): una query
+    per leggere gli asset, un commit. Usato dal salvataggio delle impostazioni."""
+    ids = [a.id for a in data.assets]
+    duplicates = sorted(i for i, n in Counter(ids).items() if n > 1)
+    if duplicates:
+        raise HTTPException(status_code=400, detail=f"Asset ripetuti: {', '.join(duplicates)}")
+    for patch in data.assets:
+        _check_asset_type(patch.type)
+
+    assets = {
+        a.id: a for a in db.query(Asset).filter(Asset.portfolio_id == pid, Asset.id.in_(ids))
+    } if ids else {}
+    missing = [i for i in ids if i not in assets]
+    if missing:
+        raise HTTPException(status_code=404, detail=f"Asset not found: {', '.join(missing)}")
+    tracked = ledger.tracked_assets(db, pid, ids)
+    _check_position_edit([(p.id, p) for p in data.assets if p.id in tracked])
+
+    # Totale aggiornato in modo incrementale, come negli endpoint per singolo asset
+    total = _valuation(db, pid).total_value
+    now = datetime.now(timezone.utc)
+    for patch in data.assets:
+        asset = assets[patch.id]
+        total -= asset.price * asset.qty
+        _patch_asset(asset, patch, now)
+        total += asset.price * asset.qty
+    cash = _get_cash(db, pid)
+    if data.cash is not None:
+        total -= cash.amount
+        if data.cash.amount is not None:
+            cash.amount = data.cash.amount
+        if data.cash.target_pct is not None:
+            cash.target_pct = data.cash.target_pct
+        cash.updated_at = now
+        total += cash.amount
+
+    # Risposta costruita prima del commit: dopo, ogni asset scaduto andrebbe riletto
+    out = AssetsPatchOut(
+        assets=[_build_asset_out(assets[i], total, i in tracked) for i in ids],
+        liquidity=CashOut(
+            amount=cash.amount, target_pct=cash.target_pct,
+            weight_pct=round((cash.amount / total * 100) if total else 0, 2),
+        ),
+    )
+    if data.assets or data.cash is not None:
+        bump_version(db, pid)
+        db.commit()
+    for asset in out.assets:
+        ticker_search.learn_asset(asset)
+    return out
 
 
 # ---------------------------------------------------------------------------
 # DELETE /api/assets/{id}
 # ---------------------------------------------------------------------------
 @app.delete("/api/assets/{asset_id}")
-def delete_asset(asset_id: str, db: Session = Depends(get_db)):
-    asset = db.query(Asset).filter(Asset.id == asset_id).first()
+def delete_asset(asset_id: str, pid: int = Depends(portfolio_scope),
+                 db: Session = Depends(get_db)):
+    asset = _get_asset(db, pid, asset_id)
     if not asset:
         raise HTTPException(status_code=404, detail="Asset not found")
 
     # Protezione: non eliminare l'ultimo asset
-    if db.query(Asset).count() <= 1:
+    if db.query(Asset).filter(Asset.portfolio_id == pid).count() <= 1:
         raise HTTPException(status_code=400, detail="Non puoi eliminare l'ultimo asset")
 
-    # Pulisci la chiave dalle strategie
-    for strategy in db.query(Strategy).all():
-        targets = json.loads(strategy.targets_json)
-        if asset_id in targets:
-            del targets[asset_id]
-            strategy.targets_json = json.dumps(targets)
+    # Pulisci la chiave dalle strategie (un DELETE per tutto il portafoglio)
+    remove_asset_key(db, pid, asset_id)
 
+    db.query(PriceHistory).filter(
+        PriceHistory.portfolio_id == pid, PriceHistory.asset_id == asset_id,
+    ).delete()
+    db.query(Transaction).filter(
+        Transaction.portfolio_id == pid, Transaction.asset_id == asset_id,
+    ).delete()
     db.delete(asset)
+    bump_version(db, pid)
     db.commit()
     return {"status": "ok"}
 
@@ -367,17 +608,21 @@ def delete_asset(asset_id: str, db: Session = Depends(get_db)):
 # PUT /api/cash
 # ---------------------------------------------------------------------------
 @app.put("/api/cash", response_model=CashOut)
-def update_cash(data: CashUpdate, db: Session = Depends(get_db)):
-    cash = _get_cash(db)
+def update_cash(data: CashUpdate, pid: int = Depends(portfolio_scope),
+                db: Session = Depends(get_db)):
+    cash = _get_cash(db, pid)
+    total_before = _valuation(db, pid).total_value
+    amount_before = cash.amount
     if data.amount is not None:
         cash.amount = data.amount
     if data.target_pct is not None:
         cash.target_pct = data.target_pct
     cash.updated_at = datetime.now(timezone.utc)
+    bump_version(db, pid)
     db.commit()
     db.refresh(cash)
 
-    total_val = _total_value(db)
+    total_val = total_before - amount_before + cash.amount
     cash_weight = round((cash.amount / total_val * 100) if total_val else 0, 2)
     return CashOut(amount=cash.amount, target_pct=cash.target_pct, weight_pct=cash_weight)
 
@@ -386,32 +631,22 @@ def update_cash(data: CashUpdate, db: Session = Depends(get_db)):
 # PUT /api/targets
 # ---------------------------------------------------------------------------
 @app.put("/api/targets")
-def update_targets(data: TargetsUpdate, db: Session = Depends(get_db)):
+def update_targets(data: TargetsUpdate, pid: int = Depends(portfolio_scope),
+                   db: Session = Depends(get_db)):
     """Aggiorna i target sugli Asset/Cash e sincronizza la strategia attiva."""
-    total = sum(data.targets.values())
-    if abs(total - 100) > 0.01:
-        raise HTTPException(
-            status_code=400,
-            detail=f"I target devono sommare a 100%. Attuale: {total}%",
-        )
+    _check_targets(db, pid, data.targets)
 
     # Aggiorna i target sui singoli Asset e Cash
-    for key, pct in data.targets.items():
-        if key == "cash":
-            cash = _get_cash(db)
-            cash.target_pct = pct
-            cash.updated_at = datetime.now(timezone.utc)
-        else:
-            asset = db.query(Asset).filter(Asset.id == key).first()
-            if asset:
-                asset.target_pct = pct
-                asset.updated_at = datetime.now(timezone.utc)
+    _apply_strategy_targets(db, pid, data.targets)
 
     # Sincronizza con la strategia attiva (se esiste)
-    active = db.query(Strategy).filter(Strategy.is_active == True).first()
+    active = db.query(Strategy).filter(
+        Strategy.portfolio_id == pid, Strategy.is_active == True,
+    ).first()
     if active:
-        active.targets_json = json.dumps(data.targets)
+        set_targets(db, active, data.targets)
 
+    bump_version(db, pid)
     db.commit()
     return {"status": "ok", "targets": data.targets}
 
@@ -420,163 +655,314 @@ def update_targets(data: TargetsUpdate, db: Session = Depends(get_db)):
 # GET /api/rebalance?amount=1800
 # ---------------------------------------------------------------------------
 @app.get("/api/rebalance", response_model=RebalanceOut)
-def get_rebalance(amount: float = Query(..., gt=0), db: Session = Depends(get_db)):
-    assets = db.query(Asset).all()
-    cash = _get_cash(db)
-    asset_total = sum(a.price * a.qty for a in assets)
-    current_total = asset_total + cash.amount
-    future_total = current_total + amount
-
-    # Calculate gaps (only for assets with target > 0)
-    gaps = []
-    for a in assets:
-        target_val = future_total * (a.target_pct / 100)
-        current_val = a.price * a.qty
-        gap = max(0, target_val - current_val)
-        gaps.append({"asset": a, "target_val": target_val, "gap": gap})
-
-    total_gap = sum(g["gap"] for g in gaps)
-
-    plan = []
-    total_spent = 0
-
-    for g in gaps:
-        a = g["asset"]
-        if a.target_pct == 0 or g["gap"] <= 0:
-            plan.append(
-                RebalancePlanItem(
-                    id=a.id,
-                    name=a.name,
-                    invest_eur=0,
-                    shares_to_buy=0,
-                    actual_spend=0,
-                    price_per_share=a.price,
-                    weight_after_pct=round(
-                        (a.price * a.qty) / future_total * 100, 2
-                    ),
-                )
-            )
-            continue
+def get_rebalance(
+    amount: float = Query(..., gt=0),
+    mode: str = Query("proportional"),
+    pid: int = Depends(portfolio_scope),
+    db: Session = Depends(get_db),
+):
+    """Piano di acquisto per il contributo `amount`.
+
+    mode=proportional (default) divide l'importo in proporzione ai gap e arrotonda
+    per difetto; mode=optimal cerca le quote intere che avvicinano di piu' i pesi
+    finali ai target; mode=full ribilancia anche vendendo, con le commissioni
+    di default (vedi POST /api/rebalance/plan per personalizzarle).
+    """
+    _check_rebalance_mode(mode)
+    val = _valuation(db, pid)
+    return plan_rebalance(val.assets, val.cash_amount, val.cash_target_pct, amount, mode)
 
-        # Distribute proportionally to gap
-        if total_gap > 0:
-            invest = (g["gap"] / total_gap) * amount
-        else:
-            invest = 0
-
-        shares = math.floor(invest / a.price) if a.price > 0 else 0
-        actual = round(shares * a.price, 2)
-        total_spent += actual
-
-        new_val = a.price * a.qty + actual
-        weight_after = round(new_val / future_total * 100, 2)
-
-        plan.append(
-            RebalancePlanItem(
-                id=a.id,
-                name=a.name,
-                invest_eur=round(invest, 2),
-                shares_to_buy=shares,
-                actual_spend=actual,
-                price_per_share=a.price,
-                weight_after_pct=weight_after,
-            )
+
+# ---------------------------------------------------------------------------
+# POST /api/rebalance/plan — Piano con target/commissioni personalizzati
+# ---------------------------------------------------------------------------
+@app.post("/api/rebalance/plan", response_model=RebalanceOut)
+def plan_rebalance_custom(data: RebalanceRequest, pid: int = Depends(portfolio_scope),
+                          db: Session = Depends(get_db)):
+    """Piano di ribilanciamento senza salvare nulla.
+
+    I target passati sovrascrivono quelli salvati (anteprima dagli slider),
+    la chiave "cash" e' il target della liquidita'.
+    """
+    _check_rebalance_mode(data.mode)
+    val = _valuation(db, pid)
+    assets = val.assets
+    cash_target = val.cash_target_pct
+    if data.targets is not None:
+        assets = [
+            replace(a, target_pct=data.targets[a.id]) if a.id in data.targets else a
+            for a in assets
+        ]
+        cash_target = data.targets.get("cash", cash_target)
+    return plan_rebalance(
+        assets, val.cash_amount, cash_target, data.amount, data.mode,
+        fees=data.fees, min_trade_eur=data.min_trade_eur, cost_aversion=data.cost_aversion,
+    )
+
+
+def _check_rebalance_mode(mode: str):
+    if mode not in REBALANCE_MODES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Modalita' non valida. Ammesse: {', '.join(sorted(REBALANCE_MODES))}",
         )
 
-    leftover = round(amount - total_spent, 2)
-    liquidity_after = round(cash.amount + leftover, 2)
 
-    return RebalanceOut(
-        amount=amount,
-        plan=plan,
-        total_spent=round(total_spent, 2),
-        leftover=leftover,
-        liquidity_after=liquidity_after,
+# ---------------------------------------------------------------------------
+# POST /api/rebalance/simulate — Scenari what-if in blocco
+# ---------------------------------------------------------------------------
+@app.post("/api/rebalance/simulate", response_model=SimulationOut)
+def simulate_rebalance(data: SimulationRequest, pid: int = Depends(portfolio_scope),
+                       db: Session = Depends(get_db)):
+    """Ribilanciamento proporzionale su molti scenari in una sola chiamata.
+
+    Con `amounts` ogni importo e' un ribilanciamento singolo dal portafoglio
+    attuale; con `monthly_amount` + `months` il contributo si ripete ogni mese
+    e i prezzi crescono di `price_growth_pct` annuo. Gli scenari si moltiplicano
+    per le strategie richieste (`strategy_ids` o `all_strategies`).
+    """
+    recurring = data.monthly_amount is not None and data.months > 0
+    if (data.amounts is None) == (not recurring):
+        raise HTTPException(
+            status_code=400,
+            detail="Specificare 'amounts' oppure 'monthly_amount' e 'months' (non entrambi)",
+        )
+    if data.amounts is not None and any(a <= 0 for a in data.amounts):
+        raise HTTPException(status_code=400, detail="Gli importi devono essere positivi")
+
+    val = _valuation(db, pid)
+    scenarios = _target_scenarios(db, val, data.strategy_ids, data.all_strategies)
+    return run_simulation(
+        val, scenarios,
+        amounts=data.amounts,
+        monthly_amount=data.monthly_amount if recurring else None,
+        months=data.months,
+        price_growth_pct=data.price_growth_pct,
+        asset_growth_pct=data.asset_growth_pct,
     )
 
 
+def _target_scenarios(db: Session, val: Valuation, strategy_ids: list[int] | None,
+                      all_strategies: bool) -> list[tuple[str, int | None, dict[str, float]]]:
+    """Set di target da simulare: strategie richieste oppure i target attuali."""
+    if all_strategies or strategy_ids:
+        query = db.query(Strategy).filter(Strategy.portfolio_id == val.portfolio_id)
+        if not all_strategies:
+            query = query.filter(Strategy.id.in_(strategy_ids))
+        strategies = query.order_by(Strategy.id).all()
+        if not all_strategies and len(strategies) != len(set(strategy_ids)):
+            raise HTTPException(status_code=404, detail="Strategia non trovata")
+        targets = targets_by_strategy(db, val.portfolio_id, [s.id for s in strategies])
+        return [(s.name, s.id, targets.get(s.id, {})) for s in strategies]
+    current = {a.id: a.target_pct for a in val.assets}
+    current["cash"] = val.cash_target_pct
+    return [("Target attuali", None, current)]
+
+
+# ---------------------------------------------------------------------------
+# POST /api/montecarlo — Proiezioni Monte Carlo per strategia
+# ---------------------------------------------------------------------------
+@app.post("/api/montecarlo", response_model=MonteCarloOut)
+def montecarlo(data: MonteCarloRequest, pid: int = Depends(portfolio_scope),
+               db: Session = Depends(get_db)):
+    """Bande percentili del valore futuro per le strategie richieste.
+
+    Rendimenti correlati stimati dallo storico prezzi (`source=history`, serve il
+    backfill) o dai parametri passati (`source=params`).
+    """
+    if data.source not in ("history", "params"):
+        raise HTTPException(status_code=400, detail="Sorgente non valida. Ammesse: history, params")
+    if data.rebalance not in CONTRIBUTION_RULES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Regola non valida. Ammesse: {', '.join(sorted(CONTRIBUTION_RULES))}",
+        )
+
+    val = _valuation(db, pid)
+    scenarios = _target_scenarios(db, val, data.strategy_ids, data.all_strategies)
+    # Solo gli asset che contano: posseduti (se si parte dal portafoglio) o con target
+    asset_ids = [
+        a.id for a in val.assets
+        if any(t.get(a.id, 0) > 0 for _, _, t in scenarios)
+        or (data.initial_value is None and a.value > 0)
+    ]
+    if not asset_ids:
+        raise HTTPException(status_code=400, detail="Nessun asset da simulare")
+
+    try:
+        if data.source == "history":
+            model, parameters = model_from_history(db, pid, asset_ids, data.cash_return_pct)
+        else:
+            model = model_from_assumptions(
+                asset_ids, data.assumptions, data.correlations, data.cash_return_pct,
+            )
+            parameters = {i: data.assumptions[i] for i in asset_ids}
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    return run_montecarlo(
+        val, model, asset_ids, scenarios,
+        months=data.months, paths=data.paths,
+        monthly_contribution=data.monthly_contribution, rule=data.rebalance,
+        sample_every=data.sample_every, initial_value=data.initial_value,
+        seed=data.seed, source=data.source, parameters=parameters,
+    )
+
+
+# ---------------------------------------------------------------------------
+# POST /api/backtest — Backtest storico delle strategie
+# ---------------------------------------------------------------------------
+@app.post("/api/backtest", response_model=list[BacktestOut])
+def backtest(data: BacktestRequest, pid: int = Depends(portfolio_scope),
+             db: Session = Depends(get_db)):
+    """Ripete contributi e ribilanciamenti sullo storico prezzi, una curva per strategia.
+
+    I risultati restano in cache: richiamare lo stesso backtest dopo un
+    aggiornamento prezzi elabora solo le barre nuove.
+    """
+    if data.policy not in BACKTEST_POLICIES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Politica non valida. Ammesse: {', '.join(sorted(BACKTEST_POLICIES))}",
+        )
+    _check_rebalance_mode(data.mode)
+    if data.start and data.end and data.start > data.end:
+        raise HTTPException(status_code=400, detail="La data iniziale deve precedere quella finale")
+
+    val = _valuation(db, pid)
+    results = []
+    for label, strategy_id, targets in _target_scenarios(db, val, data.strategy_ids, data.all_strategies):
+        try:
+            results.append(run_backtest(
+                db, pid, label, strategy_id, targets,
+                policy=data.policy, mode=data.mode, band_pct=data.band_pct,
+                initial_value=data.initial_value, monthly_contribution=data.monthly_contribution,
+                start=data.start, end=data.end,
+            ))
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=f"{label}: {e}")
+    return results
+
+
 # ---------------------------------------------------------------------------
 # Helpers strategie
 # ---------------------------------------------------------------------------
 
-def _strategy_to_out(s: Strategy) -> StrategyOut:
-    """Converte un record Strategy nel suo schema di output, deserializzando il JSON."""
+def _strategy_to_out(s: Strategy, targets: dict[str, float]) -> StrategyOut:
+    """Converte un record Strategy e i suoi target nello schema di output."""
     return StrategyOut(
         id=s.id,
         name=s.name,
         description=s.description,
-        targets=json.loads(s.targets_json),
+        targets=targets,
         is_active=s.is_active,
         created_at=s.created_at,
         activated_at=s.activated_at,
     )
 
 
-def _apply_strategy_targets(db: Session, targets: dict):
+def _get_strategy(db: Session, portfolio_id: int, strategy_id: int) -> Strategy | None:
+    return db.query(Strategy).filter(
+        Strategy.portfolio_id == portfolio_id, Strategy.id == strategy_id,
+    ).first()
+
+
+# Un solo UPDATE eseguito in executemany; le chiavi senza asset non toccano righe
+_SET_ASSET_TARGET = (
+    update(Asset.__table__)
+    .where(Asset.__table__.c.portfolio_id == bindparam("pid"), Asset.__table__.c.id == bindparam("aid"))
+    .values(target_pct=bindparam("pct"), updated_at=bindparam("now"))
+)
+
+
+def _check_targets(db: Session, portfolio_id: int, targets: dict):
+    """I target devono sommare a 100% e usare solo "cash" o asset del portafoglio."""
+    total = sum(targets.values())
+    if abs(total - 100) > 0.01:
+        raise HTTPException(
+            status_code=400,
+            detail=f"I target devono sommare a 100%. Attuale: {total}%",
+        )
+    unknown = unknown_keys(db, portfolio_id, targets)
+    if unknown:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Asset non presenti nel portafoglio: {', '.join(unknown)}",
+        )
+
+
+def _apply_strategy_targets(db: Session, portfolio_id: int, targets: dict):
     """Copia i target di una strategia sugli Asset e Cash (li rende attivi)."""
-    for key, pct in targets.items():
-        if key == "cash":
-            cash = _get_cash(db)
-            cash.target_pct = pct
-            cash.updated_at = datetime.now(timezone.utc)
-        else:
-            asset = db.query(Asset).filter(Asset.id == key).first()
-            if asset:
-                asset.target_pct = pct
-                asset.updated_at = datetime.now(timezone.utc)
+    now = datetime.now(timezone.utc)
+    rows = [
+        {"pid": portfolio_id, "aid": key, "pct": pct, "now": now}
+        for key, pct in targets.items() if key != "cash"
+    ]
+    if rows:
+        db.execute(_SET_ASSET_TARGET, rows)
+    if "cash" in targets:
+        cash = _get_cash(db, portfolio_id)
+        cash.target_pct = targets["cash"]
+        cash.updated_at = now
 
 
 # ---------------------------------------------------------------------------
 # GET /api/strategies
 # ---------------------------------------------------------------------------
 @app.get("/api/strategies", response_model=list[StrategyOut])
-def list_strategies(db: Session = Depends(get_db)):
-    """Restituisce tutte le strategie, ordinate per nome."""
-    rows = db.query(Strategy).order_by(Strategy.name).all()
-    return [_strategy_to_out(s) for s in rows]
+async def list_strategies(pid: int = Depends(portfolio_scope),
+                          db: AsyncSession = Depends(get_async_db)):
+    """Restituisce tutte le strategie del portafoglio, ordinate per nome."""
+    rows = (await db.scalars(
+        select(Strategy).where(Strategy.portfolio_id == pid).order_by(Strategy.name)
+    )).all()
+    targets = await db.run_sync(targets_by_strategy, pid)
+    return [_strategy_to_out(s, targets.get(s.id, {})) for s in rows]
 
 
 # ---------------------------------------------------------------------------
 # POST /api/strategies
 # ---------------------------------------------------------------------------
 @app.post("/api/strategies", response_model=StrategyOut, status_code=201)
-def create_strategy(data: StrategyCreate, db: Session = Depends(get_db)):
+def create_strategy(data: StrategyCreate, pid: int = Depends(portfolio_scope),
+                    db: Session = Depends(get_db)):
     """Crea una nuova strategia. I target devono sommare a 100%."""
-    total = sum(data.targets.values())
-    if abs(total - 100) > 0.01:
-        raise HTTPException(
-            status_code=400,
-            detail=f"I target devono sommare a 100%. Attuale: {total}%",
-        )
+    _check_targets(db, pid, data.targets)
 
     # Controlla nome univoco
-    if db.query(Strategy).filter(Strategy.name == data.name).first():
+    if db.query(Strategy).filter(Strategy.portfolio_id == pid, Strategy.name == data.name).first():
         raise HTTPException(status_code=400, detail="Esiste gia' una strategia con questo nome")
 
     s = Strategy(
+        portfolio_id=pid,
         name=data.name,
         description=data.description,
-        targets_json=json.dumps(data.targets),
     )
     db.add(s)
+    db.flush()
+    set_targets(db, s, data.targets)
+    bump_version(db, pid)
     db.commit()
     db.refresh(s)
-    return _strategy_to_out(s)
+    return _strategy_to_out(s, data.targets)
 
 
 # ---------------------------------------------------------------------------
 # PUT /api/strategies/{id}
 # ---------------------------------------------------------------------------
 @app.put("/api/strategies/{strategy_id}", response_model=StrategyOut)
-def update_strategy(strategy_id: int, data: StrategyUpdate, db: Session = Depends(get_db)):
+def update_strategy(strategy_id: int, data: StrategyUpdate, pid: int = Depends(portfolio_scope),
+                    db: Session = Depends(get_db)):
     """Modifica nome, descrizione o target di una strategia esistente."""
-    s = db.query(Strategy).filter(Strategy.id == strategy_id).first()
+    s = _get_strategy(db, pid, strategy_id)
     if not s:
         raise HTTPException(status_code=404, detail="Strategia non trovata")
 
     if data.name is not None:
         # Controlla che il nuovo nome non sia gia' usato da un'altra strategia
-        existing = db.query(Strategy).filter(Strategy.name == data.name, Strategy.id != strategy_id).first()
+        existing = db.query(Strategy).filter(
+            Strategy.portfolio_id == pid, Strategy.name == data.name, Strategy.id != strategy_id,
+        ).first()
         if existing:
             raise HTTPException(status_code=400, detail="Esiste gia' una strategia con questo nome")
         s.name = data.name
@@ -585,34 +971,36 @@ def update_strategy(strategy_id: int, data: StrategyUpdate, db: Session = Depend
         s.description = data.description
 
     if data.targets is not None:
-        total = sum(data.targets.values())
-        if abs(total - 100) > 0.01:
-            raise HTTPException(
-                status_code=400,
-                detail=f"I target devono sommare a 100%. Attuale: {total}%",
-            )
-        s.targets_json = json.dumps(data.targets)
+        _check_targets(db, pid, data.targets)
+        set_targets(db, s, data.targets)
         # Se e' la strategia attiva, aggiorna anche Asset/Cash
         if s.is_active:
-            _apply_strategy_targets(db, data.targets)
+            _apply_strategy_targets(db, pid, data.targets)
 
+    bump_version(db, pid)
     db.commit()
     db.refresh(s)
-    return _strategy_to_out(s)
+    targets = data.targets
+    if targets is None:
+        targets = targets_by_strategy(db, pid, [s.id]).get(s.id, {})
+    return _strategy_to_out(s, targets)
 
 
 # ---------------------------------------------------------------------------
 # DELETE /api/strategies/{id}
 # ---------------------------------------------------------------------------
 @app.delete("/api/strategies/{strategy_id}")
-def delete_strategy(strategy_id: int, db: Session = Depends(get_db)):
+def delete_strategy(strategy_id: int, pid: int = Depends(portfolio_scope),
+                    db: Session = Depends(get_db)):
     """Elimina una strategia. Non si puo' eliminare quella attiva."""
-    s = db.query(Strategy).filter(Strategy.id == strategy_id).first()
+    s = _get_strategy(db, pid, strategy_id)
     if not s:
         raise HTTPException(status_code=404, detail="Strategia non trovata")
     if s.is_active:
         raise HTTPException(status_code=400, detail="Non puoi eliminare la strategia attiva")
+    delete_targets(db, pid, s.id)
     db.delete(s)
+    bump_version(db, pid)
     db.commit()
     return {"status": "ok"}
 
@@ -621,74 +1009,119 @@ def delete_strategy(strategy_id: int, db: Session = Depends(get_db)):
 # POST /api/strategies/{id}/activate
 # ---------------------------------------------------------------------------
 @app.post("/api/strategies/{strategy_id}/activate", response_model=StrategyOut)
-def activate_strategy(strategy_id: int, db: Session = Depends(get_db)):
+def activate_strategy(strategy_id: int, pid: int = Depends(portfolio_scope),
+                      db: Session = Depends(get_db)):
     """Attiva una strategia: copia i suoi target sugli Asset/Cash e logga l'attivazione."""
-    s = db.query(Strategy).filter(Strategy.id == strategy_id).first()
+    s = _get_strategy(db, pid, strategy_id)
     if not s:
         raise HTTPException(status_code=404, detail="Strategia non trovata")
 
     now = datetime.now(timezone.utc)
 
-    # Disattiva tutte le strategie
-    db.query(Strategy).update({Strategy.is_active: False})
+    # Disattiva le strategie del portafoglio
+    db.query(Strategy).filter(Strategy.portfolio_id == pid).update({Strategy.is_active: False})
 
     # Attiva quella selezionata
     s.is_active = True
     s.activated_at = now
 
-    # Copia i target della strategia sugli Asset e Cash
-    targets = json.loads(s.targets_json)
-    _apply_strategy_targets(db, targets)
+    # Copia i target della strategia sugli Asset e Cash (UPDATE dalla tabella strategy_targets)
+    activate_targets(db, pid, s.id, now)
 
     # Registra nello storico
-    db.add(StrategyHistory(strategy_name=s.name, activated_at=now))
+    db.add(StrategyHistory(portfolio_id=pid, strategy_name=s.name, activated_at=now))
 
+    bump_version(db, pid)
     db.commit()
     db.refresh(s)
-    return _strategy_to_out(s)
+    return _strategy_to_out(s, targets_by_strategy(db, pid, [s.id]).get(s.id, {}))
 
 
 # ---------------------------------------------------------------------------
 # GET /api/strategies/history
 # ---------------------------------------------------------------------------
 @app.get("/api/strategies/history", response_model=list[StrategyHistoryOut])
-def get_strategy_history(db: Session = Depends(get_db)):
+async def get_strategy_history(pid: int = Depends(portfolio_scope),
+                               db: AsyncSession = Depends(get_async_db)):
     """Restituisce lo storico delle attivazioni (piu' recenti prima)."""
-    return (
-        db.query(StrategyHistory)
+    return (await db.scalars(
+        select(StrategyHistory)
+        .where(StrategyHistory.portfolio_id == pid)
         .order_by(StrategyHistory.activated_at.desc())
         .limit(50)
-        .all()
-    )
+    )).all()
 
 
 # ---------------------------------------------------------------------------
 # Snapshots
 # ---------------------------------------------------------------------------
 @app.get("/api/snapshots", response_model=list[SnapshotOut])
-def get_snapshots(db: Session = Depends(get_db)):
-    return db.query(Snapshot).order_by(Snapshot.date).all()
+async def get_snapshots(
+    response: Response,
+    date_from: str | None = Query(None, alias="from"),
+    date_to: str | None = Query(None, alias="to"),
+    resolution: str = Query("daily"),
+    points: int = Query(200, ge=3, le=5000),
+    limit: int | None = Query(None, ge=1, le=10000),
+    cursor: str | None = Query(None),
+    pid: int = Depends(portfolio_scope),
+    db: AsyncSession = Depends(get_async_db),
+):
+    """Snapshot ordinati per data.
+
+    resolution: daily (default), weekly, monthly (ultimo snapshot del periodo) oppure
+    lttb (downsampling a `points` punti). Con `limit` la risposta e' paginata: se ci
+    sono altre righe l'header X-Next-Cursor contiene il valore da passare in `cursor`.
+    """
+    if resolution not in RESOLUTIONS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Risoluzione non valida. Ammesse: {', '.join(sorted(RESOLUTIONS))}",
+        )
+    rows = await db.run_sync(query_snapshots, pid, date_from, date_to, resolution=resolution,
+                             limit=limit, cursor=cursor, points=points)
+    if limit and len(rows) == limit and resolution != "lttb":
+        response.headers["X-Next-Cursor"] = rows[-1].date
+    return rows
 
 
 @app.post("/api/snapshots", response_model=SnapshotOut, status_code=201)
-def create_snapshot(data: SnapshotCreate, db: Session = Depends(get_db)):
+def create_snapshot(data: SnapshotCreate, pid: int = Depends(portfolio_scope),
+                    db: Session = Depends(get_db)):
     snap = Snapshot(
+        portfolio_id=pid,
         date=data.date,
         total_value=data.total_value,
         total_invested=data.total_invested,
     )
     db.add(snap)
-    db.commit()
+    bump_version(db, pid)
+    try:
+        db.commit()
+    except IntegrityError:
+        db.rollback()
+        raise HTTPException(status_code=409, detail=f"Esiste gia' uno snapshot per il {data.date}")
     db.refresh(snap)
     return snap
 
 
+@app.post("/api/snapshots/auto", response_model=SnapshotOut)
+def create_auto_snapshot(pid: int = Depends(portfolio_scope), db: Session = Depends(get_db)):
+    """Snapshot di oggi calcolato lato server; se esiste gia' restituisce quello salvato."""
+    snap, _ = write_daily_snapshot(db, pid)
+    return snap
+
+
 @app.delete("/api/snapshots/{snapshot_id}")
-def delete_snapshot(snapshot_id: int, db: Session = Depends(get_db)):
-    snap = db.query(Snapshot).filter(Snapshot.id == snapshot_id).first()
+def delete_snapshot(snapshot_id: int, pid: int = Depends(portfolio_scope),
+                    db: Session = Depends(get_db)):
+    snap = db.query(Snapshot).filter(
+        Snapshot.portfolio_id == pid, Snapshot.id == snapshot_id,
+    ).first()
     if not snap:
         raise HTTPException(status_code=404, detail="Snapshot not found")
     db.delete(snap)
+    bump_version(db, pid)
     db.commit()
     return {"status": "ok"}
 
@@ -697,138 +1130,262 @@ def delete_snapshot(snapshot_id: int, db: Session = Depends(get_db)):
 # GET /api/summary
 # ---------------------------------------------------------------------------
 @app.get("/api/summary", response_model=SummaryOut)
-def get_summary(db: Session = Depends(get_db)):
-    assets = db.query(Asset).all()
-    cash = _get_cash(db)
-    asset_val = sum(a.price * a.qty for a in assets)
-    total_val = asset_val + cash.amount
-    total_inv = sum(a.pmc * a.qty for a in assets) + cash.amount
+async def get_summary(request: Request, pid: int = Depends(portfolio_scope),
+                      db: AsyncSession = Depends(get_async_db)):
+    val = await _valuation_async(db, pid, request)
+    return val.cached("summary", lambda: _build_summary_out(val))
+
+
+def _build_summary_out(val: Valuation) -> SummaryOut:
+    total_val = val.total_value
+    total_inv = val.total_invested
     gain_eur = round(total_val - total_inv, 2)
     gain_pct = round((gain_eur / total_inv * 100) if total_inv else 0, 2)
 
-    weights = {a.id: round((a.price * a.qty) / total_val * 100, 2) if total_val else 0 for a in assets}
-    weights["cash"] = round((cash.amount / total_val * 100) if total_val else 0, 2)
-    targets = {a.id: a.target_pct for a in assets}
-    targets["cash"] = cash.target_pct
+    weights = {a.id: val.weight_pct(a.value) for a in val.assets}
+    weights["cash"] = val.weight_pct(val.cash_amount)
+    targets = {a.id: a.target_pct for a in val.assets}
+    targets["cash"] = val.cash_target_pct
 
     return SummaryOut(
         total_value=round(total_val, 2),
         total_invested=round(total_inv, 2),
         total_gain_eur=gain_eur,
         total_gain_pct=gain_pct,
-        liquidity=cash.amount,
+        liquidity=val.cash_amount,
         weights=weights,
         targets=targets,
     )
 
 
 # ---------------------------------------------------------------------------
-# POST /api/prices/update — Aggiorna prezzi via Yahoo Finance
+# GET /api/analytics?period=1y — TWR, XIRR, volatilita', drawdown, contributi
 # ---------------------------------------------------------------------------
-def _do_price_update(db: Session) -> PriceUpdateOut:
-    """Aggiorna i prezzi di tutti gli asset con yahoo_ticker. Usato dall'endpoint e dallo scheduler."""
+_PERIOD_MONTHS = {"1m": 1, "3m": 3, "6m": 6, "1y": 12, "3y": 36, "5y": 60, "10y": 120}
+
+
+@app.get("/api/analytics", response_model=AnalyticsOut)
+def get_analytics(
+    period: str = Query("max"),
+    date_from: str | None = Query(None, alias="from"),
+    date_to: str | None = Query(None, alias="to"),
+    flows: str = Query("invested"),
+    pid: int = Depends(portfolio_scope),
+    db: Session = Depends(get_db),
+):
+    """Performance sulla finestra richiesta: `from`/`to` espliciti oppure `period`
+    (1m, 3m, 6m, ytd, 1y, 3y, 5y, 10y, max). Calcolata una volta per versione dei dati."""
+    if flows not in FLOW_SOURCES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Sorgente flussi non valida. Ammesse: {', '.join(sorted(FLOW_SOURCES))}",
+        )
+    # Intervallo esplicito: date ISO validate, risultato nella LRU window_cache;
+    # i period fissi restano nel memo della valorizzazione.
+    explicit = date_from is not None or date_to is not None
     try:
-        import yfinance as yf
-    except ImportError:
-        raise RuntimeError("yfinance non installato. Esegui: pip install yfinance")
+        date_from = date.fromisoformat(date_from).isoformat() if date_from else None
+        date_to = date.fromisoformat(date_to).isoformat() if date_to else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Date non valide: usa il formato AAAA-MM-GG")
+    if date_from is None and period != "max":
+        today = datetime.now(timezone.utc).date()
+        if period == "ytd":
+            date_from = today.replace(month=1, day=1).isoformat()
+        elif period in _PERIOD_MONTHS:
+            date_from = months_before(today, _PERIOD_MONTHS[period]).isoformat()
+        else:
+            raise HTTPException(status_code=400, detail=f"Periodo non valido: {period}")
 
-    assets = db.query(Asset).all()
-    results = []
-    updated = 0
-    skipped = 0
-    errors = 0
-
-    # Ottieni tasso EUR/USD per conversioni
-    eur_usd_rate = None
-
-    for asset in assets:
-        if not asset.yahoo_ticker:
-            results.append(PriceUpdateResult(
-                id=asset.id, name=asset.name,
-                old_price=asset.price, new_price=asset.price,
-                status="skipped",
-            ))
-            skipped += 1
-            continue
+    val = _valuation(db, pid)
+    try:
+        if explicit:
+            key = (pid, val.version, date_from, date_to, flows)
+            result = window_cache.get(key)
+            if result is None:
+                result = analyze(db, val, date_from, date_to, flows)
+                window_cache.put(key, result)
+            return result
+        return val.cached(
+            ("analytics", period, date_from, flows),
+            lambda: analyze(db, val, date_from, date_to, flows),
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
-        try:
-            ticker = yf.Ticker(asset.yahoo_ticker)
-            info = ticker.fast_info
-            new_price = info.get("lastPrice") or info.get("last_price")
-            currency = info.get("currency", "EUR")
-
-            if new_price is None:
-                raise ValueError("Prezzo non disponibile")
-
-            # Converti in EUR se necessario
-            if currency and currency.upper() != "EUR":
-                if eur_usd_rate is None and currency.upper() == "USD":
-                    try:
-                        fx = yf.Ticker("EURUSD=X")
-                        eur_usd_rate = fx.fast_info.get("lastPrice") or fx.fast_info.get("last_price") or 1.0
-                    except Exception:
-                        eur_usd_rate = 1.0
-
-                if currency.upper() == "USD" and eur_usd_rate:
-                    new_price = new_price / eur_usd_rate
-                elif currency.upper() == "GBP":
-                    try:
-                        fx = yf.Ticker("EURGBP=X")
-                        rate = fx.fast_info.get("lastPrice") or fx.fast_info.get("last_price") or 1.0
-                        new_price = new_price / rate
-                    except Exception:
-                        pass
-
-            new_price = round(new_price, 4)
-            old_price = asset.price
-            asset.price = new_price
-            asset.updated_at = datetime.now(timezone.utc)
-
-            results.append(PriceUpdateResult(
-                id=asset.id, name=asset.name,
-                old_price=old_price, new_price=new_price,
-                status="ok",
-            ))
-            updated += 1
 
-        except Exception as exc:
-            results.append(PriceUpdateResult(
-                id=asset.id, name=asset.name,
-                old_price=asset.price, new_price=asset.price,
-                status="error", error=str(exc),
-            ))
-            errors += 1
+# ---------------------------------------------------------------------------
+# POST /api/prices/update — Aggiornamento prezzi in background con progresso SSE
+# ---------------------------------------------------------------------------
+def _job_out(job: PriceJob) -> PriceJobOut:
+    return PriceJobOut(
+        job_id=job.id,
+        portfolio_id=job.portfolio_id,
+        status=job.status,
+        started_at=job.started_at,
+        finished_at=job.finished_at,
+        result=job.result,
+        error=job.error,
+    )
 
-    db.commit()
 
-    return PriceUpdateOut(
-        updated=updated, skipped=skipped, errors=errors,
-        results=results,
-    )
+def _get_price_job(job_id: str) -> PriceJob:
+    job = price_jobs.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job non trovato")
+    return job
+
+
+@app.post("/api/prices/update", response_model=PriceJobOut, status_code=202)
+def update_prices(pid: int = Depends(portfolio_scope)):
+    """Avvia in background l'aggiornamento dei prezzi degli asset del portafoglio con
+    yahoo_ticker e restituisce subito il job. I nuovi prezzi valgono anche per gli
+    altri portafogli che usano gli stessi simboli.
+
+    Un solo aggiornamento alla volta: se ne e' gia' in corso (o in coda) uno che
+    copre il portafoglio si restituisce quello; durante un giro di polling il job
+    viene accodato (status "queued") e parte alla fine del giro; altrimenti 409.
+    """
+    try:
+        get_provider()
+    except RuntimeError as exc:
+        raise HTTPException(status_code=500, detail=str(exc))
+
+    job, created = price_jobs.begin(pid)
+    if job is None:
+        raise HTTPException(status_code=409, detail="Aggiornamento prezzi gia' in corso")
+    if created:
+        _scheduler.add_job(price_jobs.run, args=[job], id=f"prices-{job.id}", misfire_grace_time=None)
+    return _job_out(job)
+
+
+@app.get("/api/prices/polling", response_model=list[MarketPollOut])
+def get_price_polling():
+    """Gruppi del polling intraday: mercato, orari, ultimo giro ed eventuale backoff."""
+    return poller.status() if INTRADAY_POLLING else []
+
 
+@app.get("/api/prices/jobs/{job_id}", response_model=PriceJobOut)
+def get_price_job(job_id: str):
+    """Stato di un job di aggiornamento prezzi, con l'esito completo se concluso."""
+    return _job_out(_get_price_job(job_id))
 
-@app.post("/api/prices/update", response_model=PriceUpdateOut)
-def update_prices(db: Session = Depends(get_db)):
-    """Aggiorna i prezzi di tutti gli asset che hanno un yahoo_ticker impostato."""
+
+@app.get("/api/prices/jobs/{job_id}/events")
+async def price_job_events(job_id: str, request: Request):
+    """Server-Sent Events del job: un evento `result` per asset appena il suo
+    prezzo e' scaricato, poi `done` (conteggi) o `error`. Con Last-Event-ID il
+    client che si riconnette riprende dall'evento successivo."""
+    job = _get_price_job(job_id)
+    try:
+        seen = int(request.headers.get("last-event-id", 0))
+    except ValueError:
+        seen = 0
+
+    async def stream():
+        nonlocal seen
+        while True:
+            events = job.events[seen:]
+            for event, data in events:
+                seen += 1
+                yield f"id: {seen}\nevent: {event}\ndata: {json.dumps(data)}\n\n"
+                if event in ("done", "error"):
+                    return
+            if not events:
+                if job.closed:
+                    return          # riconnessione dopo l'evento finale
+                if not await job.wait(seen, 15):
+                    yield ": keepalive\n\n"
+
+    return StreamingResponse(stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+# ---------------------------------------------------------------------------
+# Storico prezzi per asset
+# ---------------------------------------------------------------------------
+@app.post("/api/prices/history/backfill", response_model=PriceHistoryBackfillOut)
+def backfill_price_history(data: PriceHistoryBackfill, pid: int = Depends(portfolio_scope),
+                           db: Session = Depends(get_db)):
+    """Scarica lo storico giornaliero dal provider e lo salva in price_history."""
+    end = data.end or datetime.now(timezone.utc).date()
+    if data.start > end:
+        raise HTTPException(status_code=400, detail="La data iniziale deve precedere quella finale")
     try:
-        return _do_price_update(db)
+        return backfill(db, pid, data.start, end, asset_ids=data.asset_ids)
     except RuntimeError as exc:
         raise HTTPException(status_code=500, detail=str(exc))
 
 
+@app.get("/api/prices/history")
+def get_price_history(
+    asset_id: list[str] | None = Query(None),
+    date_from: str | None = Query(None, alias="from"),
+    date_to: str | None = Query(None, alias="to"),
+    pid: int = Depends(portfolio_scope),
+):
+    """Chiusure giornaliere in NDJSON (una riga {asset_id, date, close} per giorno),
+    ordinate per asset e data. La risposta e' in streaming: anni di storico per
+    centinaia di asset non vengono mai caricati interamente in memoria.
+    """
+    def generate():
+        db = SessionLocal()
+        try:
+            for row in iter_history(db, pid, asset_id, date_from, date_to):
+                yield json.dumps({"asset_id": row.asset_id, "date": row.date, "close": row.close}) + "\n"
+        finally:
+            db.close()
+
+    return StreamingResponse(generate(), media_type="application/x-ndjson")
+
+
 # ---------------------------------------------------------------------------
 # POST /api/rebalance/execute — Salva il ribilanciamento eseguito
 # ---------------------------------------------------------------------------
 @app.post("/api/rebalance/execute", response_model=RebalanceLogOut, status_code=201)
-def execute_rebalance(data: RebalanceLogCreate, db: Session = Depends(get_db)):
-    """Registra il ribilanciamento eseguito nel log storico."""
+def execute_rebalance(data: RebalanceLogCreate, pid: int = Depends(portfolio_scope),
+                      db: Session = Depends(get_db)):
+    """Registra il ribilanciamento eseguito nel log storico e nel registro movimenti.
+
+    Ogni riga del piano con quote diventa un buy/sell alla data di oggi, quindi
+    quantita' e PMC degli asset si aggiornano da soli.
+    """
+    now = datetime.now(timezone.utc)
     log = RebalanceLog(
-        executed_at=datetime.now(timezone.utc),
+        portfolio_id=pid,
+        executed_at=now,
         amount=data.amount,
         total_spent=data.total_spent,
         plan_json=json.dumps([item.model_dump() for item in data.plan]),
     )
     db.add(log)
+    db.flush()
+
+    assets = {
+        a.id: a for a in db.query(Asset).filter(
+            Asset.portfolio_id == pid, Asset.id.in_([p.id for p in data.plan]),
+        )
+    }
+    for item in data.plan:
+        shares = item.shares_delta or item.shares_to_buy
+        if not shares or item.id not in assets:
+            continue
+        try:
+            ledger.post(db, assets[item.id], Transaction(
+                asset_id=item.id,
+                date=now.date().isoformat(),
+                type="buy" if shares > 0 else "sell",
+                qty=abs(shares),
+                price=item.price_per_share,
+                fee=item.fee,
+                amount=abs(item.actual_spend),
+                note=f"Ribilanciamento #{log.id}",
+                rebalance_id=log.id,
+            ))
+        except ValueError as e:
+            db.rollback()
+            raise HTTPException(status_code=400, detail=f"{item.name}: {e}")
+    bump_version(db, pid)
     db.commit()
     db.refresh(log)
 
@@ -845,10 +1402,11 @@ def execute_rebalance(data: RebalanceLogCreate, db: Session = Depends(get_db)):
 # GET /api/rebalance/history — Storico ribilanciamenti
 # ---------------------------------------------------------------------------
 @app.get("/api/rebalance/history", response_model=list[RebalanceLogOut])
-def get_rebalance_history(db: Session = Depends(get_db)):
+def get_rebalance_history(pid: int = Depends(portfolio_scope), db: Session = Depends(get_db)):
     """Restituisce lo storico dei ribilanciamenti (piu' recenti prima, max 50)."""
     logs = (
         db.query(RebalanceLog)
+        .filter(RebalanceLog.portfolio_id == pid)
         .order_by(RebalanceLog.executed_at.desc())
         .limit(50)
         .all()
@@ -866,35 +1424,156 @@ def get_rebalance_history(db: Session = Depends(get_db)):
 
 
 # ---------------------------------------------------------------------------
-# GET /api/ticker/search?q=... — Ricerca ticker su Yahoo Finance
+# Registro movimenti
+# ---------------------------------------------------------------------------
+@app.get("/api/transactions", response_model=list[TransactionOut])
+async def list_transactions(
+    asset_id: str | None = None,
+    date_from: str | None = Query(None, alias="from"),
+    date_to: str | None = Query(None, alias="to"),
+    limit: int = Query(500, ge=1, le=10000),
+    pid: int = Depends(portfolio_scope),
+    db: AsyncSession = Depends(get_async_db),
+):
+    """Movimenti dal piu' recente, filtrabili per asset e intervallo di date."""
+    query = select(Transaction).where(Transaction.portfolio_id == pid)
+    if asset_id:
+        query = query.where(Transaction.asset_id == asset_id)
+    if date_from:
+        query = query.where(Transaction.date >= date_from)
+    if date_to:
+        query = query.where(Transaction.date <= date_to)
+    query = query.order_by(Transaction.date.desc(), Transaction.id.desc()).limit(limit)
+    return (await db.scalars(query)).all()
+
+
+def _transaction_fields(data: TransactionCreate) -> dict:
+    try:
+        ledger.validate(data.type, data.qty, data.amount)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {
+        "asset_id": data.asset_id,
+        "date": data.date.isoformat(),
+        "type": data.type,
+        "qty": data.qty,
+        "price": data.price,
+        "fee": data.fee,
+        "amount": data.amount if data.amount is not None else round(data.qty * data.price, 2),
+        "note": data.note,
+    }
+
+
+def _get_transaction(db: Session, portfolio_id: int, tx_id: int) -> Transaction:
+    tx = db.query(Transaction).filter(
+        Transaction.portfolio_id == portfolio_id, Transaction.id == tx_id,
+    ).first()
+    if not tx:
+        raise HTTPException(status_code=404, detail="Movimento non trovato")
+    return tx
+
+
+def _ledger_asset(db: Session, portfolio_id: int, asset_id: str) -> Asset:
+    asset = _get_asset(db, portfolio_id, asset_id)
+    if not asset:
+        raise HTTPException(status_code=404, detail=f"Asset '{asset_id}' non trovato")
+    return asset
+
+
+@app.post("/api/transactions", response_model=TransactionOut, status_code=201)
+def create_transaction(data: TransactionCreate, pid: int = Depends(portfolio_scope),
+                       db: Session = Depends(get_db)):
+    """Registra un movimento e aggiorna quantita' e PMC dell'asset."""
+    fields = _transaction_fields(data)
+    asset = _ledger_asset(db, pid, data.asset_id)
+    tx = Transaction(**fields)
+    try:
+        ledger.post(db, asset, tx)
+    except ValueError as e:
+        db.rollback()
+        raise HTTPException(status_code=400, detail=str(e))
+    bump_version(db, pid)
+    db.commit()
+    db.refresh(tx)
+    return tx
+
+
+@app.put("/api/transactions/{tx_id}", response_model=TransactionOut)
+def update_transaction(tx_id: int, data: TransactionCreate, pid: int = Depends(portfolio_scope),
+                       db: Session = Depends(get_db)):
+    """Modifica un movimento: le posizioni coinvolte vengono ricalcolate dal registro."""
+    tx = _get_transaction(db, pid, tx_id)
+    fields = _transaction_fields(data)
+    affected = {tx.asset_id, data.asset_id}
+    assets = [_ledger_asset(db, pid, a) for a in affected]
+    for key, value in fields.items():
+        setattr(tx, key, value)
+    db.flush()
+    try:
+        for asset in assets:
+            ledger.recompute(db, asset)
+    except ValueError as e:
+        db.rollback()
+        raise HTTPException(status_code=400, detail=str(e))
+    bump_version(db, pid)
+    db.commit()
+    db.refresh(tx)
+    return tx
+
+
+@app.delete("/api/transactions/{tx_id}")
+def delete_transaction(tx_id: int, pid: int = Depends(portfolio_scope),
+                       db: Session = Depends(get_db)):
+    tx = _get_transaction(db, pid, tx_id)
+    asset = _get_asset(db, pid, tx.asset_id)
+    db.delete(tx)
+    db.flush()
+    if asset:
+        try:
+            ledger.recompute(db, asset)
+        except ValueError as e:
+            db.rollback()
+            raise HTTPException(status_code=400, detail=f"Impossibile eliminare: {e}")
+    bump_version(db, pid)
+    db.commit()
+    return {"status": "ok"}
+
+
+@app.post("/api/transactions/import", response_model=TransactionImportOut)
+def import_transactions(data: TransactionImport, pid: int = Depends(portfolio_scope),
+                        db: Session = Depends(get_db)):
+    """Import in blocco da CSV (estratto conto del broker). Tutto o niente."""
+    rows, errors = ledger.parse_csv(data.csv, db.query(Asset).filter(Asset.portfolio_id == pid).all())
+    if errors:
+        raise HTTPException(status_code=400, detail="; ".join(errors[:20]))
+    try:
+        return ledger.import_rows(db, pid, rows, replace=data.replace)
+    except ValueError as e:
+        db.rollback()
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+# ---------------------------------------------------------------------------
+# GET /api/ticker/search?q=... — Ricerca ticker (Yahoo Finance o provider locale)
 # ---------------------------------------------------------------------------
 @app.get("/api/ticker/search", response_model=list[TickerSearchResult])
-def search_ticker(q: str = Query(..., min_length=2)):
-    """Cerca strumenti finanziari su Yahoo Finance per nome o ticker."""
+async def search_ticker(q: str = Query(..., min_length=2), more: bool = Query(False)):
+    """Cerca strumenti finanziari per nome, ticker o ISIN.
+
+    Risponde dalla cache delle query o dall'indice locale degli strumenti noti;
+    il provider configurato viene interrogato solo per le query senza risultati
+    locali forti o con `more=true` (ricerca esplicita dal pulsante Cerca),
+    sull'executor delle quotazioni invece che nel threadpool delle richieste.
+    """
     try:
-        import yfinance as yf
-    except ImportError:
-        raise HTTPException(
-            status_code=500,
-            detail="yfinance non installato. Esegui: pip install yfinance",
-        )
+        provider = get_provider()
+    except RuntimeError as exc:
+        raise HTTPException(status_code=500, detail=str(exc))
 
     try:
-        search = yf.Search(q, max_results=10)
-        quotes = search.quotes if hasattr(search, "quotes") else []
+        return await ticker_search.search_async(q, max_results=10, more=more)
     except Exception as exc:
-        raise HTTPException(status_code=502, detail=f"Errore ricerca Yahoo Finance: {exc}")
-
-    results = []
-    for item in quotes:
-        results.append(TickerSearchResult(
-            symbol=item.get("symbol", ""),
-            name=item.get("shortname") or item.get("longname") or item.get("symbol", ""),
-            exchange=item.get("exchDisp") or item.get("exchange", ""),
-            type=item.get("typeDisp") or item.get("quoteType", ""),
-            currency=item.get("currency", ""),
-        ))
-    return results
+        raise HTTPException(status_code=502, detail=f"Errore ricerca {provider.label}: {exc}")
 
 
 # ---------------------------------------------------------------------------
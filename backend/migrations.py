@@ -0,0 +1,291 @@
+"""Migrazioni versionate dello schema.
+
+Ogni passo ha un numero di versione crescente ed e' registrato nella tabella
+schema_version quando viene applicato. All'avvio:
+
+- percorso veloce: una sola lettura di MAX(version); se lo schema e' aggiornato
+  non si fa nessuna introspezione, create_all o query di seed;
+- altrimenti i passi mancanti vengono applicati in ordine in un'unica
+  transazione (BEGIN IMMEDIATE: con piu' worker uvicorn uno solo migra, gli
+  altri aspettano il lock e poi trovano lo schema gia' aggiornato).
+
+I primi passi portano allo schema attuale i database creati prima di questo
+modulo (senza schema_version): controllano lo stato delle tabelle e non fanno
+nulla se il passo non serve, quindi valgono sia per un database nuovo sia per
+uno esistente. I passi nuovi si aggiungono in fondo con @migration(N, "nome").
+"""
+from datetime import datetime, timezone
+
+from sqlalchemy import inspect, text
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import Session
+
+from database import Base
+from models import DEFAULT_PORTFOLIO_ID, Portfolio
+from seed import ensure_portfolio, seed_portfolio
+
+MIGRATIONS: list[tuple[int, str, callable]] = []
+
+
+def migration(version: int, name: str):
+    """Registra un passo di migrazione; le versioni devono essere crescenti."""
+    def register(fn):
+        assert not MIGRATIONS or version > MIGRATIONS[-1][0], "versioni non crescenti"
+        MIGRATIONS.append((version, name, fn))
+        return fn
+    return register
+
+
+def latest_version() -> int:
+    return MIGRATIONS[-1][0] if MIGRATIONS else 0
+
+
+def _schema_version(conn: Connection) -> int | None:
+    """Versione applicata, None se schema_version non esiste."""
+    try:
+        return conn.execute(text("SELECT MAX(version) FROM schema_version")).scalar() or 0
+    except OperationalError:
+        return None
+
+
+def run_migrations(engine: Engine) -> list[str]:
+    """Applica i passi mancanti e restituisce i nomi di quelli applicati."""
+    with engine.connect() as conn:
+        if _schema_version(conn) == latest_version():
+            return []
+        conn.rollback()
+
+        conn.exec_driver_sql("BEGIN IMMEDIATE")
+        try:
+            conn.execute(text(
+                "CREATE TABLE IF NOT EXISTS schema_version ("
+                "version INTEGER PRIMARY KEY, name TEXT NOT NULL, applied_at DATETIME NOT NULL)"
+            ))
+            current = _schema_version(conn)
+            applied = []
+            for version, name, step in MIGRATIONS:
+                if version <= current:
+                    continue
+                step(conn)
+                conn.execute(
+                    text("INSERT INTO schema_version (version, name, applied_at) VALUES (:v, :n, :t)"),
+                    {"v": version, "n": name, "t": datetime.now(timezone.utc)},
+                )
+                applied.append(name)
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+    if applied:
+        print(f"[migrazione] schema alla versione {latest_version()}: {', '.join(applied)}")
+    return applied
+
+
+# ---------------------------------------------------------------------------
+# Passi
+# ---------------------------------------------------------------------------
+@migration(1, "etfs_to_assets")
+def _etfs_to_assets(conn: Connection):
+    """Rinomina la tabella 'etfs' in 'assets' (v1.3)."""
+    tables = inspect(conn).get_table_names()
+    if "etfs" in tables and "assets" not in tables:
+        conn.execute(text("ALTER TABLE etfs RENAME TO assets"))
+        conn.execute(text("ALTER TABLE assets ADD COLUMN type TEXT DEFAULT 'etf'"))
+        conn.execute(text("ALTER TABLE assets ADD COLUMN isin TEXT"))
+        conn.execute(text("ALTER TABLE assets ADD COLUMN yahoo_ticker TEXT"))
+        conn.execute(text("UPDATE assets SET type = 'etc' WHERE id = 'gold'"))
+
+
+@migration(2, "snapshots_unique_date")
+def _snapshots_unique_date(conn: Connection):
+    """Rende Snapshot.date univoco tenendo l'ultimo snapshot per data (v1.5).
+    Serve solo alle tabelle precedenti a portfolio_id."""
+    inspector = inspect(conn)
+    if "snapshots" not in inspector.get_table_names():
+        return
+    if "portfolio_id" in {c["name"] for c in inspector.get_columns("snapshots")}:
+        return
+    if "ix_snapshots_date" in {ix["name"] for ix in inspector.get_indexes("snapshots")}:
+        return
+    conn.execute(text(
+        "DELETE FROM snapshots WHERE id NOT IN (SELECT MAX(id) FROM snapshots GROUP BY date)"
+    ))
+    conn.execute(text("CREATE UNIQUE INDEX ix_snapshots_date ON snapshots (date)"))
+
+
+# Tabelle con portfolio_id (v1.5), come erano al passo 3: colonne copiate dalle
+# tabelle precedenti e DDL delle nuove. Scritte qui e non prese dai modelli,
+# perche' il passo deve dare lo stesso risultato anche quando i modelli cambiano
+# (es. strategies.targets_json, spostata in strategy_targets dal passo 6).
+_SCOPED_TABLES = {
+    "assets": (
+        ["id", "name", "ticker", "yahoo_ticker", "isin", "type", "qty", "pmc", "price",
+         "target_pct", "updated_at"],
+        "CREATE TABLE assets (portfolio_id INTEGER NOT NULL, id VARCHAR NOT NULL, "
+        "name TEXT NOT NULL, ticker TEXT NOT NULL, yahoo_ticker TEXT, isin TEXT, "
+        "type TEXT NOT NULL, qty FLOAT NOT NULL, pmc FLOAT NOT NULL, price FLOAT NOT NULL, "
+        "target_pct FLOAT NOT NULL, updated_at DATETIME, PRIMARY KEY (portfolio_id, id))",
+    ),
+    "cash": (
+        ["id", "amount", "target_pct", "updated_at"],
+        "CREATE TABLE cash (id INTEGER NOT NULL, portfolio_id INTEGER NOT NULL, "
+        "amount FLOAT NOT NULL, target_pct FLOAT NOT NULL, updated_at DATETIME, "
+        "PRIMARY KEY (id), UNIQUE (portfolio_id))",
+    ),
+    "snapshots": (
+        ["id", "date", "total_value", "total_invested", "created_at"],
+        "CREATE TABLE snapshots (id INTEGER NOT NULL, portfolio_id INTEGER NOT NULL, "
+        "date VARCHAR NOT NULL, total_value FLOAT NOT NULL, total_invested FLOAT NOT NULL, "
+        "created_at DATETIME, PRIMARY KEY (id), "
+        "CONSTRAINT uq_snapshots_portfolio_date UNIQUE (portfolio_id, date))",
+    ),
+    "strategies": (
+        ["id", "name", "description", "targets_json", "is_active", "created_at", "activated_at"],
+        "CREATE TABLE strategies (id INTEGER NOT NULL, portfolio_id INTEGER NOT NULL, "
+        "name TEXT NOT NULL, description TEXT NOT NULL, targets_json TEXT NOT NULL, "
+        "is_active BOOLEAN NOT NULL, created_at DATETIME, activated_at DATETIME, "
+        "PRIMARY KEY (id), CONSTRAINT uq_strategies_portfolio_name UNIQUE (portfolio_id, name))",
+    ),
+    "strategy_history": (
+        ["id", "strategy_name", "activated_at"],
+        "CREATE TABLE strategy_history (id INTEGER NOT NULL, portfolio_id INTEGER NOT NULL, "
+        "strategy_name TEXT NOT NULL, activated_at DATETIME NOT NULL, PRIMARY KEY (id))",
+    ),
+    "rebalance_logs": (
+        ["id", "executed_at", "amount", "total_spent", "plan_json"],
+        "CREATE TABLE rebalance_logs (id INTEGER NOT NULL, portfolio_id INTEGER NOT NULL, "
+        "executed_at DATETIME NOT NULL, amount FLOAT NOT NULL, total_spent FLOAT NOT NULL, "
+        "plan_json TEXT NOT NULL, PRIMARY KEY (id))",
+    ),
+    "transactions": (
+        ["id", "asset_id", "date", "type", "qty", "price", "fee", "amount", "note",
+         "rebalance_id", "created_at"],
+        "CREATE TABLE transactions (id INTEGER NOT NULL, portfolio_id INTEGER NOT NULL, "
+        "asset_id VARCHAR NOT NULL, date VARCHAR NOT NULL, type TEXT NOT NULL, "
+        "qty FLOAT NOT NULL, price FLOAT NOT NULL, fee FLOAT NOT NULL, amount FLOAT NOT NULL, "
+        "note TEXT NOT NULL, rebalance_id INTEGER, created_at DATETIME, PRIMARY KEY (id))",
+    ),
+    "price_history": (
+        ["asset_id", "date", "close"],
+        "CREATE TABLE price_history (portfolio_id INTEGER NOT NULL, asset_id VARCHAR NOT NULL, "
+        "date VARCHAR NOT NULL, close FLOAT NOT NULL, "
+        "PRIMARY KEY (portfolio_id, asset_id, date)) WITHOUT ROWID",
+    ),
+}
+
+
+@migration(3, "portfolio_scope")
+def _portfolio_scope(conn: Connection):
+    """Aggiunge portfolio_id alle tabelle dati (v1.5).
+
+    Chiavi primarie e vincoli di unicita' cambiano (es. assets e' ora su
+    (portfolio_id, id)), quindi le tabelle vengono ricostruite e i dati
+    esistenti copiati nel portafoglio predefinito. Gli indici mancanti li crea
+    il passo 4.
+    """
+    inspector = inspect(conn)
+    tables = set(inspector.get_table_names())
+    legacy = [
+        t for t in _SCOPED_TABLES
+        if t in tables and "portfolio_id" not in {c["name"] for c in inspector.get_columns(t)}
+    ]
+    if not legacy:
+        return
+    columns = {}
+    for t in legacy:
+        existing = {c["name"] for c in inspector.get_columns(t)}
+        columns[t] = [c for c in _SCOPED_TABLES[t][0] if c in existing]
+    for t in legacy:
+        for ix in inspector.get_indexes(t):
+            conn.execute(text(f'DROP INDEX IF EXISTS "{ix["name"]}"'))
+        conn.execute(text(f'ALTER TABLE "{t}" RENAME TO "_{t}_old"'))
+        conn.execute(text(_SCOPED_TABLES[t][1]))
+    for t in legacy:
+        cols = ", ".join(f'"{c}"' for c in columns[t])
+        conn.execute(text(
+            f'INSERT INTO "{t}" (portfolio_id, {cols}) '
+            f'SELECT {DEFAULT_PORTFOLIO_ID}, {cols} FROM "_{t}_old"'
+        ))
+        conn.execute(text(f'DROP TABLE "_{t}_old"'))
+
+
+@migration(4, "create_tables_and_indexes")
+def _create_tables_and_indexes(conn: Connection):
+    """Crea le tabelle mancanti e gli indici dei modelli che mancano nelle tabelle
+    esistenti (create_all li crea solo insieme a tabelle nuove)."""
+    Base.metadata.create_all(bind=conn)
+    inspector = inspect(conn)
+    for table in Base.metadata.sorted_tables:
+        existing = {ix["name"] for ix in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(bind=conn)
+
+
+@migration(5, "seed_default_portfolio")
+def _seed_default_portfolio(conn: Connection):
+    """Portafoglio predefinito con asset di esempio, strategia e template."""
+    # Il seed usa i modelli attuali: se strategies ha ancora targets_json
+    # (database precedente al passo 6) lo esegue il passo 6 dopo la migrazione
+    if "targets_json" in {c["name"] for c in inspect(conn).get_columns("strategies")}:
+        return
+    db = Session(bind=conn)
+    try:
+        ensure_portfolio(db, DEFAULT_PORTFOLIO_ID, "Principale")
+        seed_portfolio(db, DEFAULT_PORTFOLIO_ID)
+    finally:
+        db.close()
+
+
+@migration(6, "strategy_targets")
+def _strategy_targets(conn: Connection):
+    """Sposta i target delle strategie dai blob targets_json alla tabella
+    strategy_targets e ricostruisce strategies senza la colonna (v1.5).
+
+    Le righe vengono copiate con un solo INSERT ... SELECT su json_each (nessun
+    parsing riga per riga). Se il passo 5 non ha potuto creare il portafoglio
+    predefinito (schema ancora con targets_json), il seed avviene qui, dopo.
+    """
+    inspector = inspect(conn)
+    columns = [c["name"] for c in inspector.get_columns("strategies")]
+    if "targets_json" not in columns:
+        return
+    columns.remove("targets_json")
+    for ix in inspector.get_indexes("strategies"):
+        conn.execute(text(f'DROP INDEX IF EXISTS "{ix["name"]}"'))
+    conn.execute(text('ALTER TABLE strategies RENAME TO "_strategies_old"'))
+    conn.execute(text(
+        "CREATE TABLE strategies (id INTEGER NOT NULL, portfolio_id INTEGER NOT NULL, "
+        "name TEXT NOT NULL, description TEXT NOT NULL, is_active BOOLEAN NOT NULL, "
+        "created_at DATETIME, activated_at DATETIME, PRIMARY KEY (id), "
+        "CONSTRAINT uq_strategies_portfolio_name UNIQUE (portfolio_id, name))"
+    ))
+    conn.execute(text(
+        "CREATE INDEX ix_strategies_portfolio_active ON strategies (portfolio_id, is_active)"
+    ))
+    cols = ", ".join(f'"{c}"' for c in columns)
+    conn.execute(text(f'INSERT INTO strategies ({cols}) SELECT {cols} FROM "_strategies_old"'))
+    conn.execute(text(
+        "CREATE TABLE IF NOT EXISTS strategy_targets (portfolio_id INTEGER NOT NULL, "
+        "strategy_id INTEGER NOT NULL, asset_key VARCHAR NOT NULL, pct FLOAT NOT NULL, "
+        "PRIMARY KEY (portfolio_id, strategy_id, asset_key)) WITHOUT ROWID"
+    ))
+    conn.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_strategy_targets_portfolio_asset "
+        "ON strategy_targets (portfolio_id, asset_key)"
+    ))
+    conn.execute(text(
+        "INSERT INTO strategy_targets (portfolio_id, strategy_id, asset_key, pct) "
+        'SELECT s.portfolio_id, s.id, j.key, j.value FROM "_strategies_old" AS s, '
+        "json_each(s.targets_json) AS j"
+    ))
+    conn.execute(text('DROP TABLE "_strategies_old"'))
+
+    db = Session(bind=conn)
+    try:
+        if db.get(Portfolio, DEFAULT_PORTFOLIO_ID) is None:
+            ensure_portfolio(db, DEFAULT_PORTFOLIO_ID, "Principale")
+            seed_portfolio(db, DEFAULT_PORTFOLIO_ID)
+    finally:
+        db.close()
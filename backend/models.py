@@ -1,12 +1,32 @@
 from datetime import datetime, timezone
-from sqlalchemy import Column, String, Float, Integer, DateTime, Text, Boolean
+from sqlalchemy import (
+    Column, String, Float, Integer, DateTime, Text, Boolean, Index, UniqueConstraint,
+)
 from database import Base
 
+# Portafoglio usato quando la richiesta non ne indica uno (e per i dati pre-v1.5)
+DEFAULT_PORTFOLIO_ID = 1
+
+
+class Portfolio(Base):
+    """Portafoglio (utente). Tutte le tabelle dati hanno portfolio_id come prima
+    colonna di chiave o indice, cosi' ogni query legge solo le righe del portafoglio.
+    """
+    __tablename__ = "portfolios"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    name = Column(Text, nullable=False, unique=True)
+    created_at = Column(DateTime, default=lambda: datetime.now(timezone.utc))
+
 
 class Asset(Base):
+    """Strumento in portafoglio. L'id e' uno slug univoco nel portafoglio: la chiave
+    primaria e' (portfolio_id, id)."""
     __tablename__ = "assets"
+    __table_args__ = (Index("ix_assets_yahoo_ticker", "yahoo_ticker"),)
 
-    id = Column(String, primary_key=True, index=True)
+    portfolio_id = Column(Integer, primary_key=True, default=DEFAULT_PORTFOLIO_ID)
+    id = Column(String, primary_key=True)
     name = Column(Text, nullable=False)
     ticker = Column(Text, nullable=False)
     yahoo_ticker = Column(Text, nullable=True)
@@ -24,9 +44,11 @@ class Asset(Base):
 
 
 class Cash(Base):
+    """Liquidita', una riga per portafoglio."""
     __tablename__ = "cash"
 
-    id = Column(Integer, primary_key=True, default=1)
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    portfolio_id = Column(Integer, nullable=False, unique=True, default=DEFAULT_PORTFOLIO_ID)
     amount = Column(Float, nullable=False, default=0)
     target_pct = Column(Float, nullable=False, default=0)
     updated_at = Column(
@@ -36,10 +58,39 @@ class Cash(Base):
     )
 
 
+class PriceHistory(Base):
+    """Serie storica dei prezzi di chiusura in EUR, una riga per (asset, giorno).
+    Tabella WITHOUT ROWID: la chiave primaria (portfolio_id, asset_id, date) e'
+    l'indice clustered, quindi le range query per asset leggono righe contigue
+    senza lookup aggiuntivi.
+    """
+    __tablename__ = "price_history"
+    __table_args__ = {"sqlite_with_rowid": False}
+
+    portfolio_id = Column(Integer, primary_key=True, default=DEFAULT_PORTFOLIO_ID)
+    asset_id = Column(String, primary_key=True)
+    date     = Column(String, primary_key=True)     # YYYY-MM-DD
+    close    = Column(Float, nullable=False)
+
+
+class DataVersion(Base):
+    """Contatore per portafoglio (id = portfolio_id) incrementato da ogni scrittura.
+    Usato per invalidare la cache di valorizzazione anche tra piu' worker.
+    """
+    __tablename__ = "data_version"
+
+    id = Column(Integer, primary_key=True, default=1)
+    version = Column(Integer, nullable=False, default=0)
+
+
 class Snapshot(Base):
     __tablename__ = "snapshots"
+    __table_args__ = (
+        UniqueConstraint("portfolio_id", "date", name="uq_snapshots_portfolio_date"),  # uno per giorno
+    )
 
     id = Column(Integer, primary_key=True, autoincrement=True)
+    portfolio_id = Column(Integer, nullable=False, default=DEFAULT_PORTFOLIO_ID)
     date = Column(String, nullable=False)
     total_value = Column(Float, nullable=False)
     total_invested = Column(Float, nullable=False, default=0)
@@ -50,27 +101,53 @@ class Snapshot(Base):
 
 class Strategy(Base):
     """Template di allocazione target salvato dall'utente.
-    Una sola strategia puo' essere attiva alla volta (is_active=True).
-    I target sono memorizzati come stringa JSON: {"world": 70, "em": 15, ...}
+    Una sola strategia per portafoglio puo' essere attiva alla volta (is_active=True).
+    I target sono righe di StrategyTarget: {"world": 70, "em": 15, ...} in uscita.
     """
     __tablename__ = "strategies"
+    __table_args__ = (
+        UniqueConstraint("portfolio_id", "name", name="uq_strategies_portfolio_name"),
+        Index("ix_strategies_portfolio_active", "portfolio_id", "is_active"),
+    )
 
     id = Column(Integer, primary_key=True, autoincrement=True)
-    name = Column(Text, nullable=False, unique=True)
+    portfolio_id = Column(Integer, nullable=False, default=DEFAULT_PORTFOLIO_ID)
+    name = Column(Text, nullable=False)
     description = Column(Text, nullable=False, default="")
-    targets_json = Column(Text, nullable=False)       # JSON dei target %
     is_active = Column(Boolean, nullable=False, default=False)
     created_at = Column(DateTime, default=lambda: datetime.now(timezone.utc))
     activated_at = Column(DateTime, nullable=True)     # ultima attivazione
 
 
+class StrategyTarget(Base):
+    """Target % di una strategia per un asset (o "cash"), una riga per chiave.
+
+    Tabella WITHOUT ROWID sulla chiave (portfolio_id, strategy_id, asset_key): i
+    target di tutte le strategie di un portafoglio sono righe contigue. L'indice
+    (portfolio_id, asset_key) fa togliere un asset da tutte le strategie con un
+    solo DELETE.
+    """
+    __tablename__ = "strategy_targets"
+    __table_args__ = (
+        Index("ix_strategy_targets_portfolio_asset", "portfolio_id", "asset_key"),
+        {"sqlite_with_rowid": False},
+    )
+
+    portfolio_id = Column(Integer, primary_key=True, default=DEFAULT_PORTFOLIO_ID)
+    strategy_id = Column(Integer, primary_key=True)
+    asset_key = Column(String, primary_key=True)
+    pct = Column(Float, nullable=False)
+
+
 class StrategyHistory(Base):
     """Log delle attivazioni di strategia nel tempo.
     Salva il nome (non FK) cosi' il record resta anche se la strategia viene cancellata.
     """
     __tablename__ = "strategy_history"
+    __table_args__ = (Index("ix_strategy_history_portfolio", "portfolio_id", "activated_at"),)
 
     id = Column(Integer, primary_key=True, autoincrement=True)
+    portfolio_id = Column(Integer, nullable=False, default=DEFAULT_PORTFOLIO_ID)
     strategy_name = Column(Text, nullable=False)
     activated_at = Column(DateTime, nullable=False,
                           default=lambda: datetime.now(timezone.utc))
@@ -81,10 +158,36 @@ class RebalanceLog(Base):
     plan_json contiene la lista degli acquisti (RebalancePlanItem) serializzata.
     """
     __tablename__ = "rebalance_logs"
+    __table_args__ = (Index("ix_rebalance_logs_portfolio", "portfolio_id", "executed_at"),)
 
     id          = Column(Integer, primary_key=True, autoincrement=True)
+    portfolio_id = Column(Integer, nullable=False, default=DEFAULT_PORTFOLIO_ID)
     executed_at = Column(DateTime, nullable=False,
                          default=lambda: datetime.now(timezone.utc))
     amount      = Column(Float, nullable=False)
     total_spent = Column(Float, nullable=False)
     plan_json   = Column(Text, nullable=False)
+
+
+class Transaction(Base):
+    """Movimento sul registro: buy, sell, dividend, fee.
+    qty/pmc dell'asset derivano dal registro: le operazioni in coda aggiornano la
+    posizione in O(1), quelle retrodatate la ricalcolano dall'inizio (ledger.py).
+    """
+    __tablename__ = "transactions"
+    __table_args__ = (
+        Index("ix_transactions_asset_date", "portfolio_id", "asset_id", "date", "id"),
+    )
+
+    id           = Column(Integer, primary_key=True, autoincrement=True)
+    portfolio_id = Column(Integer, nullable=False, default=DEFAULT_PORTFOLIO_ID)
+    asset_id     = Column(String, nullable=False)
+    date         = Column(String, nullable=False)          # YYYY-MM-DD
+    type         = Column(Text, nullable=False)            # buy, sell, dividend, fee
+    qty          = Column(Float, nullable=False, default=0)
+    price        = Column(Float, nullable=False, default=0)
+    fee          = Column(Float, nullable=False, default=0)
+    amount       = Column(Float, nullable=False, default=0)    # controvalore (o importo di dividend/fee)
+    note         = Column(Text, nullable=False, default="")
+    rebalance_id = Column(Integer, nullable=True)          # ribilanciamento che l'ha generato
+    created_at   = Column(DateTime, default=lambda: datetime.now(timezone.utc))
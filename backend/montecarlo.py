@@ -0,0 +1,240 @@
+"""Proiezioni Monte Carlo del portafoglio per una o piu' strategie.
+
+Rendimenti mensili log-normali correlati: r = mu + z @ L.T, con L fattore di
+Cholesky della matrice di covarianza. I parametri vengono stimati dallo storico
+prezzi (chiusure di fine mese in price_history) oppure passati dall'utente come
+rendimento atteso e volatilita' annui piu' correlazioni.
+
+Ogni mese i valori crescono, poi il contributo viene allocato con la regola del
+ribilanciamento proporzionale (solo acquisti, in proporzione ai gap dai target;
+se non ci sono gap resta in liquidita'). In alternativa: ribilanciamento completo
+ogni 12 mesi oppure contributi per target senza ribilanciare.
+
+I percorsi sono generati a blocchi di CHUNK_PATHS (memoria O(blocco x asset)) e
+per ogni percorso si conserva solo il valore totale ai mesi campionati, quindi
+100k percorsi x 240 mesi occupano pochi MB. I blocchi possono girare su un pool
+di processi (`MONTECARLO_WORKERS`); con lo stesso seed il risultato non dipende
+dal numero di worker.
+"""
+import math
+import os
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+
+import numpy as np
+from sqlalchemy.orm import Session
+
+from history import iter_history
+from schemas import MonteCarloAssumption, MonteCarloBand, MonteCarloOut, MonteCarloScenario
+from valuation import Valuation
+
+CHUNK_PATHS = 10_000
+MONTECARLO_WORKERS = int(os.getenv("MONTECARLO_WORKERS", "1"))
+PERCENTILES = (5, 25, 50, 75, 95)
+CONTRIBUTION_RULES = {"contributions", "annual", "none"}
+
+# Mesi minimi di storico per stimare i parametri di un asset
+MIN_HISTORY_MONTHS = 12
+
+
+@dataclass(frozen=True)
+class MarketModel:
+    """Parametri mensili: media dei log-rendimenti e fattore di Cholesky."""
+    mu: np.ndarray          # (asset,)
+    chol: np.ndarray        # (asset, asset)
+    cash_growth: float      # moltiplicatore mensile della liquidita'
+
+
+# ---------------------------------------------------------------------------
+# Stima parametri
+# ---------------------------------------------------------------------------
+def _cholesky(cov: np.ndarray) -> np.ndarray:
+    """Cholesky robusto: se la matrice non e' definita positiva (stime con pochi
+    dati, correlazioni incoerenti) azzera gli autovalori negativi."""
+    try:
+        return np.linalg.cholesky(cov)
+    except np.linalg.LinAlgError:
+        w, v = np.linalg.eigh(cov)
+        fixed = (v * np.clip(w, 1e-12, None)) @ v.T
+        return np.linalg.cholesky(fixed)
+
+
+def model_from_assumptions(asset_ids: list[str], assumptions: dict[str, MonteCarloAssumption],
+                           correlations: dict[str, dict[str, float]] | None,
+                           cash_return_pct: float) -> MarketModel:
+    """Parametri annui (rendimento atteso aritmetico, volatilita') -> mensili log."""
+    missing = [i for i in asset_ids if i not in assumptions]
+    if missing:
+        raise ValueError(f"Parametri mancanti per: {', '.join(missing)}")
+    sigma = np.array([assumptions[i].volatility_pct / 100 for i in asset_ids]) / math.sqrt(12)
+    mean = np.array([math.log1p(assumptions[i].expected_return_pct / 100) / 12 for i in asset_ids])
+    corr = np.eye(len(asset_ids))
+    for a, row in (correlations or {}).items():
+        for b, rho in row.items():
+            if a in asset_ids and b in asset_ids and a != b:
+                ia, ib = asset_ids.index(a), asset_ids.index(b)
+                corr[ia, ib] = corr[ib, ia] = rho
+    cov = corr * np.outer(sigma, sigma)
+    return MarketModel(
+        mu=mean - sigma ** 2 / 2,
+        chol=_cholesky(cov),
+        cash_growth=(1 + cash_return_pct / 100) ** (1 / 12),
+    )
+
+
+def model_from_history(db: Session, portfolio_id: int, asset_ids: list[str],
+                       cash_return_pct: float) -> tuple[MarketModel, dict[str, MonteCarloAssumption]]:
+    """Stima media e covarianza dei log-rendimenti mensili dalle chiusure di fine mese.
+
+    Usa solo i mesi in cui tutti gli asset hanno una chiusura, cosi' la matrice
+    di covarianza e' coerente. Restituisce anche i parametri annui stimati.
+    """
+    month_end: dict[str, dict[str, float]] = {i: {} for i in asset_ids}
+    for asset_id, day, close in iter_history(db, portfolio_id, asset_ids):
+        if close > 0:
+            month_end[asset_id][day[:7]] = close     # righe ordinate per data: vince l'ultima
+
+    short = [i for i in asset_ids if len(month_end[i]) <= MIN_HISTORY_MONTHS]
+    if short:
+        raise ValueError(
+            f"Storico insufficiente (almeno {MIN_HISTORY_MONTHS + 1} mesi) per: {', '.join(short)}"
+        )
+    months = sorted(set.intersection(*(set(m) for m in month_end.values())))
+    if len(months) <= MIN_HISTORY_MONTHS:
+        raise ValueError("Storico comune agli asset insufficiente per stimare le correlazioni")
+
+    closes = np.array([[month_end[i][m] for i in asset_ids] for m in months])
+    rets = np.diff(np.log(closes), axis=0)
+    mu = rets.mean(axis=0)
+    cov = np.atleast_2d(np.cov(rets, rowvar=False))
+    sigma = np.sqrt(np.diag(cov))
+    estimated = {
+        i: MonteCarloAssumption(
+            expected_return_pct=round(float(math.expm1((mu[k] + sigma[k] ** 2 / 2) * 12) * 100), 2),
+            volatility_pct=round(float(sigma[k] * math.sqrt(12) * 100), 2),
+        )
+        for k, i in enumerate(asset_ids)
+    }
+    model = MarketModel(
+        mu=mu, chol=_cholesky(cov), cash_growth=(1 + cash_return_pct / 100) ** (1 / 12),
+    )
+    return model, estimated
+
+
+# ---------------------------------------------------------------------------
+# Simulazione
+# ---------------------------------------------------------------------------
+def _simulate_chunk(args) -> np.ndarray:
+    """Un blocco di percorsi: restituisce (percorsi, mesi campionati) in float32.
+
+    Le matrici sono (asset x percorsi): le somme per percorso diventano somme di
+    righe contigue, molto piu' veloci di sum(axis=1) su matrici strette.
+    """
+    (seed, n_paths, model, values0, cash0, targets, cash_target,
+     contribution, months, sample_at, rule) = args
+    rng = np.random.default_rng(seed)
+    n_assets = len(values0)
+    mu = model.mu[:, None]
+    tgt = targets[:, None]
+    values = np.repeat(values0[:, None].astype(float), n_paths, axis=1)
+    cash = np.full(n_paths, float(cash0))
+    out = np.empty((n_paths, len(sample_at)), dtype=np.float32)
+    col = 0
+    for m in range(1, months + 1):
+        z = rng.standard_normal((n_assets, n_paths))
+        values *= np.exp(mu + model.chol @ z)
+        cash *= model.cash_growth
+
+        if contribution > 0:
+            if rule == "contributions":
+                # Come rebalance.plan_proportional: contributo diviso sui gap
+                future = values.sum(axis=0) + cash + contribution
+                gaps = np.maximum(future * tgt - values, 0)
+                total_gap = gaps.sum(axis=0)
+                has_gap = total_gap > 0
+                values += gaps * np.divide(contribution, total_gap,
+                                           out=np.zeros_like(total_gap), where=has_gap)
+                cash += np.where(has_gap, 0, contribution)
+            else:
+                values += tgt * contribution
+                cash += cash_target * contribution
+
+        if rule == "annual" and m % 12 == 0:
+            total = values.sum(axis=0) + cash
+            values = tgt * total
+            cash = total * cash_target
+
+        if col < len(sample_at) and sample_at[col] == m:
+            out[:, col] = values.sum(axis=0) + cash
+            col += 1
+    return out
+
+
+def simulate_paths(model: MarketModel, values0: np.ndarray, cash0: float,
+                   targets: np.ndarray, cash_target: float, contribution: float,
+                   months: int, paths: int, sample_at: list[int], rule: str,
+                   seed: int | None = None, workers: int | None = None) -> np.ndarray:
+    """Valore totale di ogni percorso ai mesi `sample_at` (percorsi x campioni)."""
+    workers = workers or MONTECARLO_WORKERS
+    sizes = [CHUNK_PATHS] * (paths // CHUNK_PATHS)
+    if paths % CHUNK_PATHS:
+        sizes.append(paths % CHUNK_PATHS)
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    jobs = [
+        (s, n, model, values0, cash0, targets, cash_target, contribution, months, sample_at, rule)
+        for s, n in zip(seeds, sizes)
+    ]
+    if workers > 1 and len(jobs) > 1:
+        with ProcessPoolExecutor(max_workers=min(workers, len(jobs))) as pool:
+            parts = list(pool.map(_simulate_chunk, jobs))
+    else:
+        parts = [_simulate_chunk(j) for j in jobs]
+    return np.concatenate(parts)
+
+
+def run_montecarlo(val: Valuation, model: MarketModel, asset_ids: list[str],
+                   scenarios: list[tuple[str, int | None, dict[str, float]]],
+                   months: int, paths: int, monthly_contribution: float,
+                   rule: str, sample_every: int, initial_value: float | None,
+                   seed: int | None, source: str,
+                   parameters: dict[str, MonteCarloAssumption]) -> MonteCarloOut:
+    by_id = {a.id: a for a in val.assets}
+    sample_at = list(range(sample_every, months + 1, sample_every))
+    if not sample_at or sample_at[-1] != months:
+        sample_at.append(months)
+
+    out = []
+    for label, strategy_id, target_map in scenarios:
+        targets = np.array([target_map.get(i, 0) / 100 for i in asset_ids])
+        cash_target = target_map.get("cash", 0) / 100
+        if initial_value is not None:
+            values0 = targets * initial_value
+            cash0 = cash_target * initial_value
+            start = initial_value
+        else:
+            values0 = np.array([by_id[i].value for i in asset_ids])
+            cash0 = val.cash_amount
+            start = float(values0.sum()) + cash0
+
+        totals = simulate_paths(
+            model, values0, cash0, targets, cash_target, monthly_contribution,
+            months, paths, sample_at, rule, seed=seed,
+        )
+        bands_arr = np.percentile(totals, PERCENTILES, axis=0)
+        bands = []
+        for k, m in enumerate(sample_at):
+            p5, p25, p50, p75, p95 = (round(float(x), 2) for x in bands_arr[:, k])
+            bands.append(MonteCarloBand(
+                month=m, contributed=round(start + monthly_contribution * m, 2),
+                p5=p5, p25=p25, p50=p50, p75=p75, p95=p95,
+            ))
+        contributed = start + monthly_contribution * months
+        out.append(MonteCarloScenario(
+            label=label,
+            strategy_id=strategy_id,
+            start_value=round(start, 2),
+            bands=bands,
+            prob_below_contributed=round(float((totals[:, -1] < contributed).mean()), 4),
+        ))
+    return MonteCarloOut(source=source, paths=paths, months=months, parameters=parameters,
+                         scenarios=out)
@@ -0,0 +1,196 @@
+"""Polling intraday dei prezzi per mercato.
+
+Oltre all'aggiornamento completo delle 09:00 i simboli vengono raggruppati per
+mercato (dal tipo di asset e dal suffisso del yahoo_ticker) e ogni gruppo ha un
+proprio job a intervallo su APScheduler:
+
+- il job scarica solo i simboli del suo mercato e solo mentre il mercato e'
+  aperto (crypto sempre; le borse nei giorni feriali, festivita' escluse non
+  gestite: il provider restituisce l'ultima chiusura e il prezzo non cambia);
+- l'intervallo ha un jitter del 10% perche' i gruppi non partano insieme;
+- dopo un errore del provider il gruppo salta i giri successivi con backoff
+  esponenziale (intervallo x 2, 4, 8, 16), azzerato al primo giro riuscito.
+
+I giri passano da price_jobs come i job manuali: se un aggiornamento e' gia' in
+corso, o un click manuale e' in coda dietro un giro, il giro viene saltato, non
+accodato.
+
+Configurazione tramite variabili d'ambiente:
+    INTRADAY_POLLING        "0" per disattivare il polling (default attivo)
+    POLL_INTERVAL_<MERCATO> secondi tra due giri, es. POLL_INTERVAL_CRYPTO=120
+"""
+import os
+from dataclasses import dataclass
+from datetime import datetime, time, timedelta, timezone
+from zoneinfo import ZoneInfo
+
+from database import SessionLocal
+from jobs import price_jobs
+from models import Asset
+
+INTRADAY_POLLING = os.environ.get("INTRADAY_POLLING", "1") != "0"
+
+# Moltiplicatore massimo dell'intervallo dopo errori consecutivi
+MAX_BACKOFF = 16
+
+
+@dataclass(frozen=True)
+class Market:
+    name: str
+    label: str
+    interval: int                       # secondi tra due giri
+    tz: str | None = None               # None = sempre aperto
+    opens: time | None = None
+    closes: time | None = None
+
+    def is_open(self, now: datetime) -> bool:
+        """Mercato aperto all'istante now (aware): giorni feriali, orario locale."""
+        if self.tz is None:
+            return True
+        local = now.astimezone(ZoneInfo(self.tz))
+        return local.weekday() < 5 and self.opens <= local.time() < self.closes
+
+
+def _interval(name: str, default: int) -> int:
+    return int(os.environ.get(f"POLL_INTERVAL_{name.upper()}", default))
+
+
+MARKETS = {
+    m.name: m for m in (
+        Market("crypto", "Crypto", _interval("crypto", 300)),
+        Market("eu", "Borse europee", _interval("eu", 900),
+               "Europe/Berlin", time(9, 0), time(17, 30)),
+        Market("lse", "Londra", _interval("lse", 900),
+               "Europe/London", time(8, 0), time(16, 30)),
+        Market("us", "Stati Uniti", _interval("us", 900),
+               "America/New_York", time(9, 30), time(16, 0)),
+    )
+}
+
+# Suffissi Yahoo delle borse dell'area euro e limitrofe (Xetra, Milano, Parigi, ...)
+_EU_SUFFIXES = {
+    "DE", "F", "MI", "PA", "AS", "BR", "MC", "SW", "VI", "LS", "IR", "HE", "CO", "ST", "OL",
+}
+
+
+def market_for(asset_type: str | None, yahoo_ticker: str | None) -> str | None:
+    """Mercato di un asset; None se il simbolo non e' seguito dal polling intraday."""
+    if not yahoo_ticker:
+        return None
+    symbol = yahoo_ticker.upper()
+    if asset_type == "crypto" or symbol.endswith(("-USD", "-EUR")):
+        return "crypto"
+    if "." not in symbol:
+        return "us" if symbol.isalnum() or "-" in symbol else None
+    suffix = symbol.rsplit(".", 1)[1]
+    if suffix in _EU_SUFFIXES:
+        return "eu"
+    if suffix == "L":
+        return "lse"
+    return None
+
+
+def group_symbols(rows) -> dict[str, set[str]]:
+    """Simboli per mercato da righe (type, yahoo_ticker)."""
+    groups: dict[str, set[str]] = {}
+    for asset_type, symbol in rows:
+        market = market_for(asset_type, symbol)
+        if market is not None:
+            groups.setdefault(market, set()).add(symbol)
+    return groups
+
+
+class _GroupState:
+    def __init__(self):
+        self.failures = 0
+        self.paused_until: datetime | None = None
+        self.last_run: datetime | None = None
+        self.last_status: str | None = None     # ok | error | busy | closed | empty | paused
+        self.last_error: str | None = None
+        self.symbols = 0
+
+
+class IntradayPoller:
+    """Un job a intervallo per mercato, con orari, jitter e backoff."""
+
+    def __init__(self, markets: dict[str, Market] = MARKETS):
+        self.markets = markets
+        self._state = {name: _GroupState() for name in markets}
+
+    def start(self, scheduler):
+        """Registra i job sullo scheduler (non ancora avviato o gia' avviato)."""
+        for market in self.markets.values():
+            scheduler.add_job(
+                self.tick, "interval", args=[market.name], id=f"poll-{market.name}",
+                seconds=market.interval, jitter=max(1, market.interval // 10),
+                max_instances=1, coalesce=True,
+            )
+
+    def _symbols(self, market: str) -> set[str]:
+        db = SessionLocal()
+        try:
+            rows = db.query(Asset.type, Asset.yahoo_ticker).filter(
+                Asset.yahoo_ticker.isnot(None)).distinct().all()
+        finally:
+            db.close()
+        return group_symbols(rows).get(market, set())
+
+    def tick(self, market: str, now: datetime | None = None) -> str:
+        """Un giro di polling del mercato; restituisce l'esito (vedi _GroupState)."""
+        now = now or datetime.now(timezone.utc)
+        state = self._state[market]
+        if not self.markets[market].is_open(now):
+            return self._record(state, "closed")
+        if state.paused_until is not None and now < state.paused_until:
+            return self._record(state, "paused")
+
+        symbols = self._symbols(market)
+        state.symbols = len(symbols)
+        if not symbols:
+            return self._record(state, "empty")
+        job, created = price_jobs.begin(None, symbols=symbols)
+        if not created:
+            return self._record(state, "busy")
+        price_jobs.run(job)
+
+        state.last_run = now
+        if job.status == "error":
+            error = job.error
+        elif job.result.errors and not job.result.updated:
+            error = next(r.error for r in job.result.results if r.status == "error")
+        else:
+            error = None
+        if error is None:
+            state.failures = 0
+            state.paused_until = None
+            state.last_error = None
+            return self._record(state, "ok")
+        # Backoff: ogni mercato ha un solo giro alla volta (max_instances=1)
+        state.failures += 1
+        backoff = min(2 ** state.failures, MAX_BACKOFF)
+        state.paused_until = now + timedelta(seconds=self.markets[market].interval * backoff)
+        state.last_error = error
+        print(f"[polling] {market}: errore ({error}), prossimo giro tra {backoff} intervalli")
+        return self._record(state, "error")
+
+    def _record(self, state: _GroupState, status: str) -> str:
+        state.last_status = status
+        return status
+
+    def status(self, now: datetime | None = None) -> list[dict]:
+        """Stato dei gruppi per GET /api/prices/polling."""
+        now = now or datetime.now(timezone.utc)
+        out = []
+        for m in self.markets.values():
+            s = self._state[m.name]
+            out.append({
+                "market": m.name, "label": m.label, "interval": m.interval,
+                "open": m.is_open(now), "symbols": s.symbols,
+                "last_run": s.last_run, "last_status": s.last_status,
+                "last_error": s.last_error, "failures": s.failures,
+                "paused_until": s.paused_until,
+            })
+        return out
+
+
+poller = IntradayPoller()
@@ -0,0 +1,183 @@
+"""Motore di aggiornamento prezzi.
+
+Scarica le quotazioni dei yahoo_ticker dal QuoteProvider configurato, in
+parallelo (thread pool limitato), recupera una sola volta per esecuzione il cambio
+di ciascuna valuta e scrive i nuovi prezzi con un unico UPDATE bulk. La chiusura
+del giorno viene registrata anche nello storico prezzi (price_history).
+
+L'aggiornamento e' condiviso tra portafogli: ogni simbolo scaricato viene
+scritto su tutti gli asset che lo usano, di qualunque portafoglio, e le versioni
+dei portafogli toccati vengono incrementate insieme.
+
+Con on_result il chiamante riceve il PriceUpdateResult di ogni asset appena il
+suo simbolo e' stato scaricato (usato dal job in background per lo streaming
+SSE); la scrittura sul database resta un'unica transazione alla fine.
+"""
+import math
+from datetime import datetime, timezone
+
+from sqlalchemy import update
+from sqlalchemy.orm import Session
+
+from history import upsert_closes
+from models import Asset
+from quotes import PRICE_UPDATE_WORKERS, QuoteProvider, TTLCache, get_provider, run_parallel
+from schemas import PriceUpdateResult, PriceUpdateOut
+from valuation import bump_version
+
+
+def _safe_fx_rate(provider: QuoteProvider, currency: str) -> float | Exception:
+    """Tasso EUR/<valuta>, oppure l'errore se non disponibile.
+
+    L'errore viene restituito invece che sollevato perche' la cache dei cambi lo
+    tenga per tutta l'esecuzione: un solo tentativo per valuta, e ogni asset in
+    quella valuta finisce tra gli errori con il prezzo lasciato invariato (mai
+    un prezzo non convertito scritto come EUR).
+    """
+    try:
+        rate = provider.get_fx_rate(currency)
+    except Exception as exc:
+        return exc
+    return rate or ValueError("tasso nullo")
+
+
+def _load_assets(db: Session, portfolio_id: int | None):
+    """Asset da aggiornare e simboli da scaricare (una volta ciascuno)."""
+    columns = (Asset.portfolio_id, Asset.id, Asset.name, Asset.price, Asset.yahoo_ticker)
+    if portfolio_id is None:
+        assets = db.query(*columns).all()
+        symbols = sorted({a.yahoo_ticker for a in assets if a.yahoo_ticker})
+    else:
+        own = db.query(*columns).filter(Asset.portfolio_id == portfolio_id).all()
+        symbols = sorted({a.yahoo_ticker for a in own if a.yahoo_ticker})
+        # Stessi simboli negli altri portafogli (indice su yahoo_ticker)
+        others = db.query(*columns).filter(
+            Asset.yahoo_ticker.in_(symbols), Asset.portfolio_id != portfolio_id,
+        ).all() if symbols else []
+        assets = own + others
+    return assets, symbols
+
+
+def _asset_result(asset, price) -> PriceUpdateResult:
+    """Esito per un asset: price e' il nuovo prezzo in EUR, un'eccezione o None (saltato)."""
+    if price is None:
+        return PriceUpdateResult(
+            id=asset.id, name=asset.name,
+            old_price=asset.price, new_price=asset.price,
+            status="skipped",
+        )
+    if isinstance(price, Exception):
+        return PriceUpdateResult(
+            id=asset.id, name=asset.name,
+            old_price=asset.price, new_price=asset.price,
+            status="error", error=str(price),
+        )
+    return PriceUpdateResult(
+        id=asset.id, name=asset.name,
+        old_price=asset.price, new_price=price,
+        status="ok",
+    )
+
+
+def refresh_prices(db: Session, portfolio_id: int | None = None, max_workers: int | None = None,
+                   provider: QuoteProvider | None = None, on_result=None,
+                   only_symbols: set[str] | None = None) -> PriceUpdateOut:
+    """Aggiorna i prezzi degli asset con yahoo_ticker del portafoglio (tutti se None).
+
+    Ogni simbolo viene scaricato una sola volta anche se usato da piu' asset,
+    e ogni valuta estera richiede un solo lookup del cambio. Il risultato
+    riporta solo gli asset del portafoglio richiesto. Con only_symbols si
+    aggiornano solo gli asset con quei simboli (polling intraday per mercato).
+    """
+    provider = provider or get_provider()
+    workers = max_workers or PRICE_UPDATE_WORKERS
+    assets, symbols = _load_assets(db, portfolio_id)
+    if only_symbols is not None:
+        assets = [a for a in assets if a.yahoo_ticker in only_symbols]
+        symbols = [s for s in symbols if s in only_symbols]
+
+    # Cambi dell'esecuzione: uno per valuta, chiesto dal primo simbolo che lo usa
+    fx_rates = TTLCache(math.inf, 1000)
+
+    def eur_price(symbol: str) -> float:
+        price, currency = provider.get_quote(symbol)
+        if currency != "EUR":
+            rate = fx_rates.get_or_load(currency, lambda: _safe_fx_rate(provider, currency))
+            if isinstance(rate, Exception):
+                raise ValueError(f"Cambio EUR/{currency} non disponibile: {rate}")
+            price = price / rate
+        return round(price, 4)
+
+    reported: dict[str, list] = {}
+    for asset in assets:
+        if portfolio_id is None or asset.portfolio_id == portfolio_id:
+            reported.setdefault(asset.yahoo_ticker, []).append(asset)
+
+    def notify(symbol, price):
+        for asset in reported.get(symbol, ()):
+            on_result(_asset_result(asset, price))
+
+    if on_result is not None:
+        for asset in reported.get(None, ()):
+            on_result(_asset_result(asset, None))
+    prices = run_parallel(eur_price, symbols, workers, on_done=notify if on_result else None)
+    return _apply_prices(db, portfolio_id, assets, prices)
+
+
+def _apply_prices(db: Session, portfolio_id: int | None, assets, prices: dict) -> PriceUpdateOut:
+    """Scrive i prezzi cambiati (UPDATE bulk) e la chiusura del giorno di ogni
+    quotazione valida, poi prepara il risultato.
+
+    Gli asset con quotazione valida contano come aggiornati anche se il prezzo
+    non e' cambiato; in quel caso si scrive solo la chiusura nello storico.
+    """
+    results = []
+    rows = []
+    closes = []
+    updated = skipped = errors = 0
+    now = datetime.now(timezone.utc)
+    today = now.date().isoformat()
+
+    for asset in assets:
+        reported = portfolio_id is None or asset.portfolio_id == portfolio_id
+        price = prices.get(asset.yahoo_ticker) if asset.yahoo_ticker else None
+        if not isinstance(price, (float, int)):
+            if reported:
+                results.append(_asset_result(asset, price))
+                if price is None:
+                    skipped += 1
+                else:
+                    errors += 1
+            continue
+
+        # Ogni quotazione valida e' la chiusura del giorno, anche se uguale a ieri:
+        # lo storico ha una riga per ogni giorno aggiornato (barre del backtest,
+        # analisi giornaliere)
+        closes.append({
+            "portfolio_id": asset.portfolio_id, "asset_id": asset.id, "date": today,
+            "close": price,
+        })
+        # Prezzo invariato (frequente nel polling intraday): nessun UPDATE, quindi
+        # ne' nuova versione dei dati ne' cache ed ETag invalidati o push ai dashboard
+        if price != asset.price:
+            rows.append({
+                "portfolio_id": asset.portfolio_id, "id": asset.id,
+                "price": price, "updated_at": now,
+            })
+        if reported:
+            results.append(_asset_result(asset, price))
+            updated += 1
+
+    # Un solo UPDATE ... WHERE portfolio_id = ? AND id = ? eseguito in executemany
+    # per i prezzi cambiati; la versione dei dati avanza solo per i loro portafogli
+    if rows:
+        db.execute(update(Asset), rows)
+        bump_version(db, *sorted({r["portfolio_id"] for r in rows}))
+    if closes:
+        upsert_closes(db, closes)
+    db.commit()
+
+    return PriceUpdateOut(
+        updated=updated, skipped=skipped, errors=errors,
+        results=results,
+    )
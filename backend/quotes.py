@@ -0,0 +1,411 @@
+"""Provider di quotazioni e ricerca strumenti.
+
+Tutte le chiamate verso l'esterno (prezzi, cambi, ricerca ticker) passano da un
+QuoteProvider. Il backend di default e' Yahoo Finance; LocalQuoteProvider legge
+i dati da un file JSON e simula latenza ed errori in modo deterministico, cosi'
+aggiornamento prezzi e ricerca si possono misurare e testare senza rete.
+
+Il provider attivo e' avvolto in un CachedQuoteProvider: quotazioni e cambi
+restano in una cache LRU con TTL condivisa da tutti i portafogli, e le richieste
+contemporanee dello stesso simbolo (scheduler + click manuale, doppio click su
+"Aggiorna prezzi") diventano una sola chiamata verso l'esterno.
+
+Selezione tramite variabili d'ambiente:
+    QUOTE_PROVIDER      "yahoo" (default) oppure "local"
+    QUOTE_FIXTURE       file JSON del provider locale (default fixtures/quotes.json)
+    QUOTE_LATENCY_MS    latenza simulata per chiamata (default 0)
+    QUOTE_ERROR_RATE    frazione di simboli che falliscono, 0..1 (default 0)
+    QUOTE_CACHE_TTL     secondi di validita' di quotazioni e cambi (default 60, 0 = niente cache)
+    QUOTE_CACHE_SIZE    simboli tenuti in cache (default 2000)
+    QUOTE_IO_WORKERS    thread per le chiamate al provider dagli handler async (default 32)
+
+La ricerca ticker (handler async) non chiama il provider nel threadpool delle
+richieste: run_io esegue le chiamate bloccanti su un executor dedicato e l'event
+loop resta libero di servire il dashboard. L'aggiornamento prezzi gira invece
+come job in background (jobs.py).
+"""
+import asyncio
+import json
+import math
+import os
+import random
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from datetime import date, timedelta
+
+from schemas import TickerSearchResult
+
+DEFAULT_FIXTURE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "quotes.json")
+
+# Numero massimo di richieste contemporanee verso il provider di quotazioni
+PRICE_UPDATE_WORKERS = int(os.environ.get("PRICE_UPDATE_WORKERS", "8"))
+
+# Thread dell'executor condiviso per le chiamate dagli handler async
+QUOTE_IO_WORKERS = int(os.environ.get("QUOTE_IO_WORKERS", "32"))
+
+# Cache di quotazioni e cambi
+QUOTE_CACHE_TTL = float(os.environ.get("QUOTE_CACHE_TTL", "60"))
+QUOTE_CACHE_SIZE = int(os.environ.get("QUOTE_CACHE_SIZE", "2000"))
+
+
+class QuoteProvider:
+    """Interfaccia comune dei provider di quotazioni."""
+
+    name = "base"
+    label = "provider"
+
+    def get_quote(self, symbol: str) -> tuple[float, str]:
+        """Restituisce (ultimo prezzo, valuta ISO maiuscola)."""
+        raise NotImplementedError
+
+    def get_fx_rate(self, currency: str) -> float:
+        """Tasso EUR/<valuta> (quante unita' di valuta per 1 EUR)."""
+        return self.get_quote(f"EUR{currency}=X")[0]
+
+    def get_history(self, symbol: str, start: date, end: date) -> tuple[list[tuple[str, float]], str]:
+        """Chiusure giornaliere [(YYYY-MM-DD, close), ...] tra start ed end inclusi, e valuta."""
+        raise NotImplementedError
+
+    def get_fx_history(self, currency: str, start: date, end: date) -> list[tuple[str, float]]:
+        """Serie giornaliera del tasso EUR/<valuta>."""
+        return self.get_history(f"EUR{currency}=X", start, end)[0]
+
+    def search(self, query: str, max_results: int = 10) -> list[TickerSearchResult]:
+        raise NotImplementedError
+
+
+# ---------------------------------------------------------------------------
+# Yahoo Finance
+# ---------------------------------------------------------------------------
+class YahooQuoteProvider(QuoteProvider):
+    name = "yahoo"
+    label = "Yahoo Finance"
+
+    def __init__(self):
+        try:
+            import yfinance as yf
+        except ImportError:
+            raise RuntimeError("yfinance non installato. Esegui: pip install yfinance")
+        self._yf = yf
+
+    @staticmethod
+    def _last_price(info) -> float | None:
+        return info.get("lastPrice") or info.get("last_price")
+
+    def get_quote(self, symbol: str) -> tuple[float, str]:
+        info = self._yf.Ticker(symbol).fast_info
+        price = self._last_price(info)
+        if price is None:
+            raise ValueError("Prezzo non disponibile")
+        currency = (info.get("currency", "EUR") or "EUR").upper()
+        return price, currency
+
+    def get_fx_rate(self, currency: str) -> float:
+        fx = self._yf.Ticker(f"EUR{currency}=X")
+        rate = self._last_price(fx.fast_info)
+        if not rate:
+            raise ValueError(f"Cambio EUR/{currency} non disponibile")
+        return rate
+
+    def get_history(self, symbol: str, start: date, end: date) -> tuple[list[tuple[str, float]], str]:
+        ticker = self._yf.Ticker(symbol)
+        # yfinance considera "end" esclusivo
+        df = ticker.history(start=start.isoformat(), end=(end + timedelta(days=1)).isoformat(),
+                            interval="1d", auto_adjust=False)
+        if df is None or df.empty:
+            raise ValueError("Storico prezzi non disponibile")
+        meta = getattr(ticker, "history_metadata", None) or {}
+        currency = (meta.get("currency") or "EUR").upper()
+        closes = [(idx.strftime("%Y-%m-%d"), float(close)) for idx, close in df["Close"].dropna().items()]
+        return closes, currency
+
+    def search(self, query: str, max_results: int = 10) -> list[TickerSearchResult]:
+        search = self._yf.Search(query, max_results=max_results)
+        quotes = search.quotes if hasattr(search, "quotes") else []
+        return [
+            TickerSearchResult(
+                symbol=item.get("symbol", ""),
+                name=item.get("shortname") or item.get("longname") or item.get("symbol", ""),
+                exchange=item.get("exchDisp") or item.get("exchange", ""),
+                type=item.get("typeDisp") or item.get("quoteType", ""),
+                currency=item.get("currency", ""),
+            )
+            for item in quotes
+        ]
+
+
+# ---------------------------------------------------------------------------
+# Provider locale (offline, deterministico)
+# ---------------------------------------------------------------------------
+class LocalQuoteProvider(QuoteProvider):
+    """Provider offline basato su un file JSON.
+
+    Formato del file:
+        {
+          "quotes": {"XMAW.MI": {"price": 44.6, "currency": "EUR", "name": "...",
+                                 "exchange": "Milan", "type": "ETF"}, ...},
+          "fx": {"USD": 1.08, "GBP": 0.85}
+        }
+
+    Un simbolo con "error" nel fixture fallisce sempre con quel messaggio.
+    I simboli assenti ricevono un prezzo sintetico stabile (utile per i test di
+    carico con centinaia di strumenti). error_rate fa fallire una frazione fissa
+    di simboli, scelta con un hash del simbolo: a parita' di seed il risultato
+    e' sempre lo stesso, indipendentemente dall'ordine delle chiamate.
+    """
+
+    name = "local"
+    label = "provider locale"
+
+    def __init__(self, path: str | None = None, latency_ms: float = 0,
+                 error_rate: float = 0, seed: int = 0):
+        self.path = path or DEFAULT_FIXTURE
+        self.latency_ms = latency_ms
+        self.error_rate = error_rate
+        self.seed = seed
+        with open(self.path, encoding="utf-8") as f:
+            data = json.load(f)
+        self.quotes: dict[str, dict] = data.get("quotes", {})
+        self.fx: dict[str, float] = {k.upper(): v for k, v in data.get("fx", {}).items()}
+
+    def _hash(self, key: str) -> int:
+        return zlib.crc32(f"{self.seed}:{key}".encode())
+
+    def _sleep(self, key: str):
+        if self.latency_ms > 0:
+            # Latenza +/-50% attorno al valore configurato, stabile per chiave
+            factor = 0.5 + (self._hash(key) % 1000) / 1000
+            time.sleep(self.latency_ms * factor / 1000)
+
+    def _maybe_fail(self, key: str):
+        if self.error_rate > 0 and (self._hash("err:" + key) % 10_000) < self.error_rate * 10_000:
+            raise ValueError(f"Errore simulato per {key}")
+
+    def get_quote(self, symbol: str) -> tuple[float, str]:
+        self._sleep(symbol)
+        entry = self.quotes.get(symbol)
+        if entry is not None and entry.get("error"):
+            raise ValueError(entry["error"])
+        self._maybe_fail(symbol)
+        if entry is None:
+            return round(10 + self._hash(symbol) % 49_000 / 100, 4), "EUR"
+        return entry["price"], (entry.get("currency") or "EUR").upper()
+
+    def get_fx_rate(self, currency: str) -> float:
+        self._sleep("fx:" + currency)
+        rate = self.fx.get(currency.upper())
+        if not rate:
+            raise ValueError(f"Cambio EUR/{currency} non disponibile")
+        return rate
+
+    @staticmethod
+    def _business_days(start: date, end: date) -> list[date]:
+        days = []
+        d = start
+        while d <= end:
+            if d.weekday() < 5:
+                days.append(d)
+            d += timedelta(days=1)
+        return days
+
+    def get_history(self, symbol: str, start: date, end: date) -> tuple[list[tuple[str, float]], str]:
+        """Random walk stabile per simbolo, che termina all'ultimo prezzo del fixture."""
+        price, currency = self.get_quote(symbol)
+        days = self._business_days(start, end)
+        rng = random.Random(self._hash("hist:" + symbol))
+        closes = [0.0] * len(days)
+        value = price
+        for i in range(len(days) - 1, -1, -1):
+            closes[i] = round(value, 4)
+            value = value / math.exp(rng.gauss(0.0003, 0.01))
+        return [(d.isoformat(), c) for d, c in zip(days, closes)], currency
+
+    def get_fx_history(self, currency: str, start: date, end: date) -> list[tuple[str, float]]:
+        rate = self.get_fx_rate(currency)
+        return [(d.isoformat(), rate) for d in self._business_days(start, end)]
+
+    def search(self, query: str, max_results: int = 10) -> list[TickerSearchResult]:
+        self._sleep("search:" + query)
+        self._maybe_fail("search:" + query)
+        q = query.lower()
+        results = []
+        for symbol, entry in self.quotes.items():
+            if entry.get("error"):
+                continue
+            name = entry.get("name", symbol)
+            if q in symbol.lower() or q in name.lower() or q == (entry.get("isin") or "").lower():
+                results.append(TickerSearchResult(
+                    symbol=symbol,
+                    name=name,
+                    exchange=entry.get("exchange", ""),
+                    type=entry.get("type", ""),
+                    currency=entry.get("currency", ""),
+                ))
+                if len(results) >= max_results:
+                    break
+        return results
+
+
+# ---------------------------------------------------------------------------
+# Cache con TTL e single-flight
+# ---------------------------------------------------------------------------
+class TTLCache:
+    """Cache LRU con scadenza e coalescenza delle richieste (single-flight).
+
+    get_or_load(key, loader) restituisce il valore in cache se non e' scaduto;
+    altrimenti il primo thread che lo chiede esegue loader() e gli altri che
+    arrivano nel frattempo aspettano lo stesso risultato (o la stessa eccezione).
+    Gli errori non vengono memorizzati: la richiesta successiva riprova.
+    """
+
+    def __init__(self, ttl: float, size: int, clock=time.monotonic):
+        self.ttl = ttl
+        self.size = size
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._entries: OrderedDict = OrderedDict()     # key -> (scadenza, valore)
+        self._inflight: dict = {}                       # key -> Future
+        self.hits = self.misses = self.coalesced = 0
+
+    def get_or_load(self, key, loader):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > self._clock():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            flight = self._inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._inflight[key] = Future()
+                self.misses += 1
+            else:
+                self.coalesced += 1
+        if not leader:
+            return flight.result()
+
+        try:
+            value = loader()
+        except BaseException as exc:
+            flight.set_exception(exc)
+            raise
+        else:
+            flight.set_result(value)
+            with self._lock:
+                self._entries[key] = (self._clock() + self.ttl, value)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.size:
+                    self._entries.popitem(last=False)
+            return value
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class CachedQuoteProvider(QuoteProvider):
+    """Avvolge un provider e memorizza quotazioni e cambi per `ttl` secondi.
+
+    Storico e ricerca passano direttamente al provider avvolto.
+    """
+
+    def __init__(self, inner: QuoteProvider, ttl: float = QUOTE_CACHE_TTL,
+                 size: int = QUOTE_CACHE_SIZE):
+        self.inner = inner
+        self.name = inner.name
+        self.label = inner.label
+        self.cache = TTLCache(ttl, size)
+
+    def get_quote(self, symbol: str) -> tuple[float, str]:
+        return self.cache.get_or_load(("quote", symbol), lambda: self.inner.get_quote(symbol))
+
+    def get_fx_rate(self, currency: str) -> float:
+        return self.cache.get_or_load(("fx", currency), lambda: self.inner.get_fx_rate(currency))
+
+    def get_history(self, symbol: str, start: date, end: date) -> tuple[list[tuple[str, float]], str]:
+        return self.inner.get_history(symbol, start, end)
+
+    def get_fx_history(self, currency: str, start: date, end: date) -> list[tuple[str, float]]:
+        return self.inner.get_fx_history(currency, start, end)
+
+    def search(self, query: str, max_results: int = 10) -> list[TickerSearchResult]:
+        return self.inner.search(query, max_results)
+
+
+def run_parallel(func, keys, max_workers: int, on_done=None) -> dict:
+    """Esegue func(key) per ogni chiave; il risultato o l'eccezione finiscono nel dict.
+
+    on_done(key, risultato) viene chiamata nel thread chiamante appena ogni
+    chiave e' completata (in ordine di completamento).
+    """
+    out = {}
+    if not keys:
+        return out
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(keys)))) as pool:
+        futures = {pool.submit(func, key): key for key in keys}
+        for fut in as_completed(futures):
+            key = futures[fut]
+            try:
+                out[key] = fut.result()
+            except Exception as exc:
+                out[key] = exc
+            if on_done is not None:
+                on_done(key, out[key])
+    return {key: out[key] for key in keys}
+
+
+_io_pool: ThreadPoolExecutor | None = None
+_io_pool_lock = threading.Lock()
+
+
+def _io_executor() -> ThreadPoolExecutor:
+    global _io_pool
+    with _io_pool_lock:
+        if _io_pool is None:
+            _io_pool = ThreadPoolExecutor(max_workers=QUOTE_IO_WORKERS, thread_name_prefix="quotes-io")
+        return _io_pool
+
+
+async def run_io(func, *args):
+    """Esegue una chiamata bloccante al provider sull'executor dedicato."""
+    return await asyncio.get_running_loop().run_in_executor(_io_executor(), func, *args)
+
+
+# ---------------------------------------------------------------------------
+# Provider attivo
+# ---------------------------------------------------------------------------
+_provider: QuoteProvider | None = None
+
+
+def get_provider() -> QuoteProvider:
+    """Restituisce il provider configurato (creato al primo uso), con la cache
+    delle quotazioni se QUOTE_CACHE_TTL > 0."""
+    global _provider
+    if _provider is None:
+        kind = os.environ.get("QUOTE_PROVIDER", "yahoo").lower()
+        if kind == "local":
+            provider = LocalQuoteProvider(
+                path=os.environ.get("QUOTE_FIXTURE") or None,
+                latency_ms=float(os.environ.get("QUOTE_LATENCY_MS", "0")),
+                error_rate=float(os.environ.get("QUOTE_ERROR_RATE", "0")),
+            )
+        elif kind == "yahoo":
+            provider = YahooQuoteProvider()
+        else:
+            raise RuntimeError(f"QUOTE_PROVIDER non valido: '{kind}' (ammessi: yahoo, local)")
+        if QUOTE_CACHE_TTL > 0:
+            provider = CachedQuoteProvider(provider)
+        _provider = provider
+    return _provider
+
+
+def set_provider(provider: QuoteProvider | None):
+    """Sostituisce il provider attivo (None = torna alla configurazione da env)."""
+    global _provider
+    _provider = provider
@@ -0,0 +1,279 @@
+"""Algoritmi di ribilanciamento.
+
+- proportional: il contributo viene diviso in proporzione al gap di ogni asset
+  rispetto al target e le quote vengono arrotondate per difetto (algoritmo storico).
+- optimal: acquisti a quote intere che portano i pesi finali il piu' vicino
+  possibile ai target (liquidita' inclusa), minimizzando la somma dei quadrati
+  degli scostamenti. Greedy con heap: O((n + quote acquistate) log n).
+- full: ribilanciamento completo con acquisti e vendite, commissioni per tipo di
+  asset e importo minimo per operazione; bilancia scostamento dai target e costi.
+
+Gli asset sono oggetti con id, name, type, price, qty, target_pct (Asset o AssetRow).
+Nelle modalita' solo acquisto gli strumenti con target 0% non vengono mai comprati.
+"""
+import heapq
+import math
+
+from schemas import FeeRule, RebalanceOut, RebalancePlanItem
+
+REBALANCE_MODES = {"proportional", "optimal", "full"}
+
+# Commissioni di default per tipo di asset (indicative, sovrascrivibili per richiesta)
+_BROKER_FEE = FeeRule(pct=0.19, min_fee=2.95, max_fee=19)
+FEE_SCHEDULE = {
+    "etf": _BROKER_FEE,
+    "etc": _BROKER_FEE,
+    "azione": _BROKER_FEE,
+    "obbligazione": _BROKER_FEE,
+    "crypto": FeeRule(pct=1.0),
+}
+
+# Passate massime della ricerca locale in modalita' full
+_FULL_MAX_PASSES = 20
+
+
+def trade_fee(rule: FeeRule, value: float) -> float:
+    """Commissione per un'operazione di controvalore `value` (0 se non si opera)."""
+    if value <= 0:
+        return 0.0
+    fee = max(rule.fixed + rule.pct / 100 * value, rule.min_fee)
+    if rule.max_fee is not None:
+        fee = min(fee, rule.max_fee)
+    return fee
+
+
+def tracking_error(values: list[float], targets_pct: list[float], total: float) -> float:
+    """Scostamento quadratico dei pesi dai target, in punti percentuali."""
+    if not total:
+        return 0.0
+    return math.sqrt(sum((v / total * 100 - t) ** 2 for v, t in zip(values, targets_pct)))
+
+
+def _result(assets, cash_amount: float, cash_target_pct: float, amount: float,
+            shares: list[int], invest: list[float], mode: str,
+            fees: list[float] | None = None) -> RebalanceOut:
+    fees = fees or [0.0] * len(assets)
+    total_fees = round(sum(fees), 2)
+    future_total = sum(a.price * a.qty for a in assets) + cash_amount + amount - total_fees
+    plan = []
+    total_spent = 0.0
+    values = []
+    for a, n, inv, fee in zip(assets, shares, invest, fees):
+        actual = round(n * a.price, 2)
+        total_spent += actual + round(fee, 2)
+        new_val = a.price * a.qty + actual
+        values.append(new_val)
+        plan.append(RebalancePlanItem(
+            id=a.id,
+            name=a.name,
+            invest_eur=round(inv, 2),
+            shares_to_buy=max(n, 0),
+            actual_spend=actual,
+            price_per_share=a.price,
+            weight_after_pct=round(new_val / future_total * 100, 2) if future_total else 0,
+            shares_delta=n,
+            fee=round(fee, 2),
+        ))
+
+    leftover = round(amount - total_spent, 2)
+    liquidity_after = round(cash_amount + leftover, 2)
+    te = tracking_error(
+        values + [cash_amount + leftover],
+        [a.target_pct for a in assets] + [cash_target_pct],
+        future_total,
+    )
+    return RebalanceOut(
+        amount=amount,
+        plan=plan,
+        total_spent=round(total_spent, 2),
+        leftover=leftover,
+        liquidity_after=liquidity_after,
+        mode=mode,
+        tracking_error_pct=round(te, 4),
+        total_fees=total_fees,
+    )
+
+
+def plan_proportional(assets, cash_amount: float, cash_target_pct: float,
+                      amount: float) -> RebalanceOut:
+    current_total = sum(a.price * a.qty for a in assets) + cash_amount
+    future_total = current_total + amount
+
+    # Gap rispetto al target (solo sottopesati)
+    gaps = [max(0, future_total * (a.target_pct / 100) - a.price * a.qty) for a in assets]
+    total_gap = sum(gaps)
+
+    shares = []
+    invest = []
+    for a, gap in zip(assets, gaps):
+        if a.target_pct == 0 or gap <= 0:
+            shares.append(0)
+            invest.append(0)
+            continue
+        # Distribuisce in proporzione al gap
+        inv = (gap / total_gap) * amount if total_gap > 0 else 0
+        shares.append(math.floor(inv / a.price) if a.price > 0 else 0)
+        invest.append(inv)
+
+    return _result(assets, cash_amount, cash_target_pct, amount, shares, invest, "proportional")
+
+
+def plan_optimal(assets, cash_amount: float, cash_target_pct: float,
+                 amount: float) -> RebalanceOut:
+    """Acquisti interi che minimizzano sum((valore_i - target_i)^2), liquidita' inclusa.
+
+    Comprare una quota di i sposta p_i da liquidita' ad asset i; la variazione
+    dell'errore per euro investito e' 2*[(v_i + p_i - T_i) - (c - T_c)]. Il termine
+    della liquidita' e' comune a tutti gli asset, quindi l'ordine di convenienza
+    dipende solo da k_i = v_i + p_i - T_i (quanto l'asset resta sottopeso dopo
+    l'acquisto): basta un min-heap su k_i, aggiornato solo per l'asset appena
+    comprato. Ci si ferma quando nessun acquisto riduce piu' l'errore o il budget
+    non basta.
+    """
+    future_total = sum(a.price * a.qty for a in assets) + cash_amount + amount
+    cash_target = future_total * cash_target_pct / 100
+    cash = cash_amount + amount
+    remaining = amount
+
+    shares = [0] * len(assets)
+    values = [a.price * a.qty for a in assets]
+    heap = [
+        (values[i] + a.price - future_total * a.target_pct / 100, i)
+        for i, a in enumerate(assets)
+        if a.target_pct > 0 and a.price > 0
+    ]
+    heapq.heapify(heap)
+
+    while heap:
+        key, i = heap[0]
+        price = assets[i].price
+        if price > remaining + 1e-9:
+            # Il budget cala soltanto: l'asset non sara' piu' acquistabile
+            heapq.heappop(heap)
+            continue
+        gain = cash - cash_target - key
+        if gain <= 0:
+            break
+        # Quote consecutive dello stesso asset in un colpo solo: finche' resta il
+        # migliore, l'acquisto riduce ancora l'errore e il budget lo consente
+        n = min(
+            math.ceil(gain / (2 * price)),
+            math.floor(remaining / price + 1e-9),
+        )
+        if len(heap) > 1:
+            next_key = min(heap[1][0], heap[2][0]) if len(heap) > 2 else heap[1][0]
+            n = min(n, math.floor((next_key - key) / price) + 1)
+        n = max(n, 1)
+        shares[i] += n
+        values[i] += n * price
+        cash -= n * price
+        remaining -= n * price
+        heapq.heapreplace(heap, (key + n * price, i))
+
+    invest = [n * a.price for n, a in zip(shares, assets)]
+    return _result(assets, cash_amount, cash_target_pct, amount, shares, invest, "optimal")
+
+
+def plan_full(assets, cash_amount: float, cash_target_pct: float, amount: float,
+              fees: dict[str, FeeRule] | None = None, min_trade_eur: float = 0,
+              cost_aversion: float = 1) -> RebalanceOut:
+    """Ribilanciamento completo (acquisti e vendite) con commissioni.
+
+    Minimizza J = [sum_i (v_i - T_i)^2 + (c - T_c)^2] / F + cost_aversion * commissioni,
+    cioe' scostamento quadratico in euro normalizzato sul totale F piu' il costo
+    delle operazioni: un'operazione si fa solo se riduce lo scostamento piu' di
+    quanto costa. Si parte dalle quote ideali arrotondate, si ripristina la
+    liquidita' non negativa togliendo gli acquisti meno utili, poi una ricerca
+    locale prova per ogni asset +1/-1 quota, nessuna operazione o l'ideale.
+    Costo O(n) per passata: abbastanza veloce da ricalcolare a ogni movimento
+    degli slider dei target.
+    """
+    fees = FEE_SCHEDULE if fees is None else fees
+    rules = [fees.get(a.type) or FeeRule() for a in assets]
+    prices = [a.price for a in assets]
+    values = [a.price * a.qty for a in assets]
+    max_sell = [math.floor(a.qty + 1e-9) for a in assets]
+    total = sum(values) + cash_amount + amount
+    targets = [total * a.target_pct / 100 for a in assets]
+    cash_target = total * cash_target_pct / 100
+
+    def allowed(i: int, k: int) -> bool:
+        if k == 0:
+            return True
+        if prices[i] <= 0 or k < -max_sell[i]:
+            return False
+        return abs(k) * prices[i] >= min_trade_eur
+
+    def fee(i: int, k: int) -> float:
+        return trade_fee(rules[i], abs(k) * prices[i])
+
+    def dev(i: int, k: int) -> float:
+        return (values[i] + k * prices[i] - targets[i]) ** 2 / total
+
+    ideal = [
+        (targets[i] - values[i]) / prices[i] if prices[i] > 0 else 0.0
+        for i in range(len(assets))
+    ]
+    shares = []
+    for i, x in enumerate(ideal):
+        k = max(round(x), -max_sell[i])
+        shares.append(k if allowed(i, k) else 0)
+    cash = cash_amount + amount - sum(k * p + fee(i, k) for i, (k, p) in enumerate(zip(shares, prices)))
+
+    def delta(i: int, k: int) -> tuple[float, float]:
+        """(variazione di J, nuova liquidita') passando da shares[i] a k."""
+        old = shares[i]
+        d_fee = fee(i, k) - fee(i, old)
+        new_cash = cash - (k - old) * prices[i] - d_fee
+        d_cash = ((new_cash - cash_target) ** 2 - (cash - cash_target) ** 2) / total
+        return dev(i, k) - dev(i, old) + d_cash + cost_aversion * d_fee, new_cash
+
+    if total > 0:
+        # Liquidita' negativa: riduce gli acquisti che peggiorano meno J
+        while cash < -1e-9:
+            best = None
+            for i, k in enumerate(shares):
+                if k <= 0:
+                    continue
+                cand = k - 1 if allowed(i, k - 1) else 0
+                d, new_cash = delta(i, cand)
+                if best is None or d < best[0]:
+                    best = (d, i, cand, new_cash)
+            if best is None:
+                break
+            _, i, k, cash = best
+            shares[i] = k
+
+        # Ricerca locale
+        for _ in range(_FULL_MAX_PASSES):
+            improved = False
+            for i, k in enumerate(shares):
+                best = None
+                for cand in {k - 1, k + 1, 0, round(ideal[i])}:
+                    if cand == k or not allowed(i, cand):
+                        continue
+                    d, new_cash = delta(i, cand)
+                    if new_cash < -1e-9:
+                        continue
+                    if d < -1e-9 and (best is None or d < best[0]):
+                        best = (d, cand, new_cash)
+                if best is not None:
+                    _, shares[i], cash = best
+                    improved = True
+            if not improved:
+                break
+
+    invest = [x * p for x, p in zip(ideal, prices)]
+    trade_fees = [fee(i, k) for i, k in enumerate(shares)]
+    return _result(assets, cash_amount, cash_target_pct, amount, shares, invest, "full", trade_fees)
+
+
+def plan_rebalance(assets, cash_amount: float, cash_target_pct: float, amount: float,
+                   mode: str = "proportional", fees: dict[str, FeeRule] | None = None,
+                   min_trade_eur: float = 0, cost_aversion: float = 1) -> RebalanceOut:
+    if mode == "full":
+        return plan_full(assets, cash_amount, cash_target_pct, amount,
+                         fees=fees, min_trade_eur=min_trade_eur, cost_aversion=cost_aversion)
+    if mode == "optimal":
+        return plan_optimal(assets, cash_amount, cash_target_pct, amount)
+    return plan_proportional(assets, cash_amount, cash_target_pct, amount)
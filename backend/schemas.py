@@ -1,4 +1,4 @@
-from datetime import datetime
+from datetime import date, datetime
 from pydantic import BaseModel, Field
 from typing import Optional
 
@@ -26,6 +26,10 @@ class AssetUpdate(BaseModel):
     type: Optional[str] = None
 
 
+class AssetPatch(AssetUpdate):
+    id: str
+
+
 class AssetOut(BaseModel):
     id: str
     name: str
@@ -42,6 +46,7 @@ class AssetOut(BaseModel):
     gain_pct: float
     weight_pct: float
     delta_pct: float
+    ledger: bool = False        # qty/pmc derivano dal registro movimenti (non modificabili)
 
     class Config:
         from_attributes = True
@@ -62,6 +67,17 @@ class CashOut(BaseModel):
         from_attributes = True
 
 
+class AssetsPatch(BaseModel):
+    """Modifiche a piu' asset (e alla liquidita') applicate in un'unica transazione."""
+    assets: list[AssetPatch] = []
+    cash: Optional[CashUpdate] = None
+
+
+class AssetsPatchOut(BaseModel):
+    assets: list[AssetOut]
+    liquidity: CashOut
+
+
 class PortfolioOut(BaseModel):
     etfs: list[AssetOut]
     liquidity: CashOut
@@ -71,6 +87,21 @@ class PortfolioOut(BaseModel):
     total_gain_pct: float
 
 
+# --- Portafogli ---
+class PortfolioCreate(BaseModel):
+    name: str = Field(min_length=1)
+    seed: bool = False              # asset di esempio, strategia predefinita e template
+
+
+class PortfolioInfo(BaseModel):
+    id: int
+    name: str
+    created_at: datetime
+
+    class Config:
+        from_attributes = True
+
+
 # --- Targets ---
 class TargetsUpdate(BaseModel):
     targets: dict[str, float]
@@ -82,9 +113,11 @@ class RebalancePlanItem(BaseModel):
     name: str
     invest_eur: float
     shares_to_buy: int
-    actual_spend: float
+    actual_spend: float             # negativo per le vendite (incasso)
     price_per_share: float
     weight_after_pct: float
+    shares_delta: int = 0           # quote con segno: + acquisto, - vendita
+    fee: float = 0
 
 
 class RebalanceOut(BaseModel):
@@ -93,11 +126,148 @@ class RebalanceOut(BaseModel):
     total_spent: float
     leftover: float
     liquidity_after: float
+    mode: str = "proportional"                  # "proportional", "optimal", "full"
+    tracking_error_pct: Optional[float] = None  # scostamento quadratico pesi/target dopo il piano
+    total_fees: float = 0
+
+
+class FeeRule(BaseModel):
+    """Commissione per operazione: fixed + pct% del controvalore, limitata a [min_fee, max_fee]."""
+    fixed: float = Field(0, ge=0)
+    pct: float = Field(0, ge=0)
+    min_fee: float = Field(0, ge=0)
+    max_fee: Optional[float] = Field(None, ge=0)
+
+
+class RebalanceRequest(BaseModel):
+    amount: float = Field(0, ge=0)
+    mode: str = "full"
+    targets: Optional[dict[str, float]] = None      # target non salvati (es. slider), chiave "cash" inclusa
+    fees: Optional[dict[str, FeeRule]] = None       # per tipo di asset; default FEE_SCHEDULE
+    min_trade_eur: float = Field(0, ge=0)
+    cost_aversion: float = Field(1, ge=0)           # peso delle commissioni rispetto allo scostamento
+
+
+class SimulationRequest(BaseModel):
+    """Scenari what-if: lista di importi singoli oppure piano mensile ricorrente."""
+    amounts: Optional[list[float]] = Field(None, min_length=1, max_length=1000)
+    monthly_amount: Optional[float] = Field(None, gt=0)
+    months: int = Field(0, ge=0, le=600)
+    price_growth_pct: float = 0                     # crescita annua ipotizzata dei prezzi
+    asset_growth_pct: dict[str, float] = {}         # override per asset id
+    strategy_ids: Optional[list[int]] = None        # None = target attuali
+    all_strategies: bool = False
+
+
+class SimulationScenario(BaseModel):
+    label: str
+    strategy_id: Optional[int] = None
+    amount: float                                   # contributo per periodo
+    periods: int
+    total_contributed: float
+    total_spent: float
+    liquidity_after: float
+    final_value: float
+    shares_bought: dict[str, int]
+    weights_after: dict[str, float]                 # chiave "cash" inclusa
+    tracking_error_pct: float
+    drift_pct: list[float] = []                     # scostamento dopo ogni mese (piano ricorrente)
+
+
+class SimulationOut(BaseModel):
+    scenarios: list[SimulationScenario]
+
+
+# --- Monte Carlo ---
+
+class MonteCarloAssumption(BaseModel):
+    expected_return_pct: float                      # rendimento atteso annuo
+    volatility_pct: float = Field(ge=0)             # volatilita' annua
+
+
+class MonteCarloRequest(BaseModel):
+    months: int = Field(240, ge=1, le=600)
+    paths: int = Field(10_000, ge=100, le=200_000)
+    monthly_contribution: float = Field(0, ge=0)
+    source: str = "history"                         # "history" (price_history) o "params"
+    assumptions: dict[str, MonteCarloAssumption] = {}               # per asset id (source=params)
+    correlations: Optional[dict[str, dict[str, float]]] = None      # {"world": {"em": 0.8}}
+    cash_return_pct: float = 0
+    rebalance: str = "contributions"                # "contributions", "annual", "none"
+    strategy_ids: Optional[list[int]] = None        # None = target attuali
+    all_strategies: bool = False
+    initial_value: Optional[float] = Field(None, gt=0)  # None = portafoglio attuale
+    sample_every: int = Field(12, ge=1, le=600)     # mesi tra i punti delle bande
+    seed: Optional[int] = None
+
+
+class MonteCarloBand(BaseModel):
+    month: int
+    contributed: float
+    p5: float
+    p25: float
+    p50: float
+    p75: float
+    p95: float
+
+
+class MonteCarloScenario(BaseModel):
+    label: str
+    strategy_id: Optional[int] = None
+    start_value: float
+    bands: list[MonteCarloBand]
+    prob_below_contributed: float                   # quota di percorsi sotto il versato a fine orizzonte
+
+
+class MonteCarloOut(BaseModel):
+    source: str
+    paths: int
+    months: int
+    parameters: dict[str, MonteCarloAssumption]     # parametri annui usati per asset
+    scenarios: list[MonteCarloScenario]
+
+
+# --- Backtest ---
+
+class BacktestRequest(BaseModel):
+    strategy_ids: Optional[list[int]] = None        # None = target attuali
+    all_strategies: bool = False
+    policy: str = "monthly"                         # "monthly", "threshold", "none"
+    mode: str = "proportional"                      # algoritmo di GET /api/rebalance
+    band_pct: float = Field(5, gt=0)                # soglia per policy=threshold (punti %)
+    initial_value: float = Field(10_000, ge=0)
+    monthly_contribution: float = Field(0, ge=0)
+    start: Optional[date] = None
+    end: Optional[date] = None
+
+
+class BacktestPoint(BaseModel):
+    date: str
+    value: float
+    contributed: float
+    drawdown_pct: float
+
+
+class BacktestOut(BaseModel):
+    label: str
+    strategy_id: Optional[int] = None
+    policy: str
+    start: str
+    end: str
+    final_value: float
+    contributed: float
+    twr_pct: float                                  # rendimento time-weighted complessivo
+    cagr_pct: float
+    max_drawdown_pct: float
+    turnover_pct: float                             # annuo, solo ribilanciamenti
+    rebalances: int
+    points: list[BacktestPoint]                     # ultimo giorno di ogni mese
+    extended: bool = False                          # True se ripreso da un backtest in cache
 
 
 class RebalanceLogCreate(BaseModel):
-    amount: float = Field(gt=0)
-    total_spent: float = Field(ge=0)
+    amount: float = Field(ge=0)
+    total_spent: float              # negativo se le vendite superano gli acquisti (mode=full)
     plan: list[RebalancePlanItem]
 
 
@@ -112,6 +282,48 @@ class RebalanceLogOut(BaseModel):
         from_attributes = True
 
 
+# --- Registro movimenti ---
+
+class TransactionCreate(BaseModel):
+    asset_id: str
+    date: date
+    type: str                                       # buy, sell, dividend, fee
+    qty: float = Field(0, ge=0)
+    price: float = Field(0, ge=0)
+    fee: float = Field(0, ge=0)
+    amount: Optional[float] = Field(None, ge=0)     # default qty * price; obbligatorio per dividend/fee
+    note: str = ""
+
+
+class TransactionOut(BaseModel):
+    id: int
+    asset_id: str
+    date: str
+    type: str
+    qty: float
+    price: float
+    fee: float
+    amount: float
+    note: str
+    rebalance_id: Optional[int] = None
+
+    class Config:
+        from_attributes = True
+
+
+class TransactionImport(BaseModel):
+    """CSV con intestazione: date, asset (id/ticker/ISIN), type, qty, price, fee, amount, note.
+    Separatore , o ; e numeri anche in formato italiano (1.234,56)."""
+    csv: str
+    replace: bool = False                           # sostituisce il registro degli asset importati
+
+
+class TransactionImportOut(BaseModel):
+    imported: int
+    assets: list[str]
+    recomputed: list[str]                           # asset ricalcolati per movimenti retrodatati
+
+
 # --- Snapshots ---
 class SnapshotCreate(BaseModel):
     date: str
@@ -140,6 +352,34 @@ class SummaryOut(BaseModel):
     targets: dict[str, float]
 
 
+# --- Analisi di performance ---
+class AssetContribution(BaseModel):
+    id: str
+    name: str
+    start_value: float
+    end_value: float
+    net_flows: float                # acquisti - vendite - dividendi nella finestra
+    gain: float
+    contribution_pct: float         # punti di rendimento del portafoglio (Modified Dietz)
+    xirr_pct: Optional[float] = None
+
+
+class AnalyticsOut(BaseModel):
+    start: str
+    end: str
+    snapshots: int
+    start_value: float
+    end_value: float
+    net_flows: float                # versamenti netti nella finestra
+    twr_pct: float                  # time-weighted, non annualizzato
+    twr_annualized_pct: Optional[float] = None     # solo per finestre >= 1 anno
+    xirr_pct: Optional[float] = None               # money-weighted annuo
+    dietz_pct: float                # Modified Dietz
+    volatility_pct: float           # annualizzata
+    max_drawdown_pct: float
+    contributions: list[AssetContribution]
+
+
 # --- Strategie ---
 
 class StrategyCreate(BaseModel):
@@ -198,6 +438,55 @@ class PriceUpdateOut(BaseModel):
     results: list[PriceUpdateResult]
 
 
+class PriceJobOut(BaseModel):
+    job_id: str
+    portfolio_id: Optional[int]             # None = tutti i portafogli (cron)
+    status: str                             # queued | running | done | error
+    started_at: datetime
+    finished_at: Optional[datetime] = None
+    result: Optional[PriceUpdateOut] = None
+    error: Optional[str] = None
+
+
+class MarketPollOut(BaseModel):
+    market: str                             # crypto | eu | lse | us
+    label: str
+    interval: int                           # secondi tra due giri
+    open: bool
+    symbols: int                            # simboli del mercato all'ultimo giro
+    last_run: Optional[datetime] = None
+    last_status: Optional[str] = None       # ok | error | busy | closed | empty | paused
+    last_error: Optional[str] = None
+    failures: int = 0
+    paused_until: Optional[datetime] = None  # backoff dopo errori del provider
+
+
+# --- Storico prezzi ---
+
+class PriceHistoryBackfill(BaseModel):
+    asset_ids: Optional[list[str]] = None   # None = tutti gli asset con yahoo_ticker
+    start: date
+    end: Optional[date] = None              # default: oggi
+
+
+class PriceHistoryBackfillResult(BaseModel):
+    id: str
+    rows: int
+    status: str             # "ok", "skipped", "error"
+    error: Optional[str] = None
+
+
+class PriceHistoryBackfillOut(BaseModel):
+    inserted: int
+    results: list[PriceHistoryBackfillResult]
+
+
+class PricePoint(BaseModel):
+    asset_id: str
+    date: str
+    close: float
+
+
 # --- Ticker search (Yahoo Finance) ---
 
 class TickerSearchResult(BaseModel):
@@ -0,0 +1,231 @@
+"""Ricerca ticker con indice locale e cache delle query.
+
+La ricerca dal frontend parte a ogni pausa di digitazione: chiamare il provider
+(yf.Search) ogni volta e' lento e inutile. Il livello di ricerca:
+
+1. cache LRU/TTL dei risultati per query normalizzata, con single-flight: query
+   identiche in volo contemporaneamente fanno una sola chiamata al provider;
+2. indice locale degli strumenti gia' visti (asset dei portafogli e risultati
+   delle ricerche precedenti) su simbolo, ISIN e nome: prefissi delle parole per
+   le query di 1-2 caratteri, trigrammi per le altre;
+3. provider remoto solo se l'indice non basta: nessun risultato locale forte
+   (simbolo/ISIN esatto, prefisso del simbolo o prefissi delle parole del nome,
+   es. "vangu" o "iShares core") oppure richiesta esplicita di altri risultati
+   (`more`, il pulsante Cerca del frontend). I risultati remoti arricchiscono
+   l'indice; se il provider fallisce si restituiscono i risultati locali, se ce
+   ne sono.
+
+Variabili d'ambiente:
+    SEARCH_CACHE_TTL    secondi di validita' dei risultati per query (default 3600)
+    SEARCH_CACHE_SIZE   query tenute in cache (default 500)
+"""
+import bisect
+import os
+import threading
+
+from quotes import QuoteProvider, TTLCache, get_provider, run_io
+from schemas import TickerSearchResult
+
+SEARCH_CACHE_TTL = float(os.environ.get("SEARCH_CACHE_TTL", "3600"))
+SEARCH_CACHE_SIZE = int(os.environ.get("SEARCH_CACHE_SIZE", "500"))
+
+# Rank dei risultati locali: 0 simbolo/ISIN esatto, 1 prefisso del simbolo,
+# 2 prefissi delle parole, 3 sottostringa. Fino a STRONG_RANK si risponde
+# dall'indice senza chiamare il provider.
+STRONG_RANK = 2
+
+# Tipi dell'app -> tipi Yahoo (gli stessi che il frontend rimappa in selectTicker)
+_ASSET_TYPE_LABELS = {
+    "etf": "ETF", "etc": "ETC", "azione": "Equity",
+    "crypto": "Cryptocurrency", "obbligazione": "Bond",
+}
+
+
+def _normalize(text: str) -> str:
+    return " ".join(text.lower().split())
+
+
+def _trigrams(text: str) -> set[str]:
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def _prefixes(words: list[str], text_words: list[str]) -> bool:
+    """Ogni parola della query e' prefisso di una parola del testo."""
+    return all(any(w.startswith(q) for w in text_words) for q in words)
+
+
+class _LocalOnly(Exception):
+    """Provider non raggiungibile: risultati locali da restituire senza metterli in cache."""
+
+    def __init__(self, results):
+        self.results = results
+
+
+class SymbolIndex:
+    """Indice in memoria degli strumenti noti, per simbolo."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._items: dict[str, TickerSearchResult] = {}
+        self._texts: dict[str, set[str]] = {}           # simbolo -> testi cercabili (minuscoli)
+        self._isin: dict[str, str] = {}                  # isin -> simbolo
+        self._trigrams: dict[str, set[str]] = {}         # trigramma -> simboli
+        self._words: list[tuple[str, str]] = []          # (parola, simbolo) ordinate
+
+    def __len__(self):
+        return len(self._items)
+
+    def add(self, item: TickerSearchResult, isin: str | None = None,
+            aliases: tuple[str, ...] = ()) -> bool:
+        """Aggiunge o aggiorna uno strumento. I campi gia' noti non vengono svuotati.
+
+        Restituisce True se l'indice e' cambiato.
+        """
+        if not item.symbol:
+            return False
+        symbol = item.symbol
+        with self._lock:
+            old = self._items.get(symbol)
+            if old is not None:
+                item = TickerSearchResult(
+                    symbol=symbol,
+                    name=item.name or old.name,
+                    exchange=item.exchange or old.exchange,
+                    type=item.type or old.type,
+                    currency=item.currency or old.currency,
+                )
+            changed = old != item
+            self._items[symbol] = item
+
+            texts = {_normalize(t) for t in (symbol, item.name, isin, *aliases) if t}
+            new = texts - self._texts.setdefault(symbol, set())
+            self._texts[symbol] |= new
+            if isin and self._isin.get(isin.lower()) != symbol:
+                self._isin[isin.lower()] = symbol
+                changed = True
+            for text in new:
+                for tg in _trigrams(text):
+                    self._trigrams.setdefault(tg, set()).add(symbol)
+                for word in set(text.split()):
+                    pos = bisect.bisect_left(self._words, (word, symbol))
+                    if pos == len(self._words) or self._words[pos] != (word, symbol):
+                        self._words.insert(pos, (word, symbol))
+            return changed or bool(new)
+
+    def search(self, query: str, max_results: int = 10) -> list[TickerSearchResult]:
+        return [item for _, item in self.ranked(query, max_results)]
+
+    def ranked(self, query: str, max_results: int = 10) -> list[tuple[int, TickerSearchResult]]:
+        """Risultati locali con il loro rank (vedi STRONG_RANK), i migliori prima."""
+        q = _normalize(query)
+        words = q.split()
+        if not q:
+            return []
+        with self._lock:
+            if len(q) >= 3:
+                sets = sorted((self._trigrams.get(tg, set()) for tg in _trigrams(q)), key=len)
+                candidates = set.intersection(*sets) if sets else set()
+            else:
+                candidates = set()
+                pos = bisect.bisect_left(self._words, (q, ""))
+                while pos < len(self._words) and self._words[pos][0].startswith(q):
+                    candidates.add(self._words[pos][1])
+                    pos += 1
+
+            ranked = []
+            for symbol in candidates:
+                texts = self._texts[symbol]
+                if not any(q in t for t in texts):
+                    continue                    # falso positivo dei trigrammi
+                sym = symbol.lower()
+                if sym == q or self._isin.get(q) == symbol:
+                    rank = 0
+                elif sym.startswith(q):
+                    rank = 1
+                elif any(_prefixes(words, t.split()) for t in texts):
+                    rank = 2
+                else:
+                    rank = 3
+                ranked.append((rank, len(symbol), symbol))
+            ranked.sort()
+            return [(rank, self._items[s]) for rank, _, s in ranked[:max_results]]
+
+
+class TickerSearch:
+    """Ricerca ticker: cache delle query, indice locale e provider remoto."""
+
+    def __init__(self, provider: QuoteProvider | None = None,
+                 ttl: float = SEARCH_CACHE_TTL, size: int = SEARCH_CACHE_SIZE):
+        self._provider = provider
+        self.index = SymbolIndex()
+        self.cache = TTLCache(ttl, size)
+        self._lock = threading.Lock()
+        self.remote_calls = 0
+
+    @property
+    def provider(self) -> QuoteProvider:
+        return self._provider or get_provider()
+
+    def learn_asset(self, asset):
+        """Indicizza un asset del portafoglio (serve lo yahoo_ticker).
+
+        Se l'indice cambia, le query in cache possono essere incomplete: si svuota.
+        """
+        if not asset.yahoo_ticker:
+            return
+        changed = self.index.add(
+            TickerSearchResult(
+                symbol=asset.yahoo_ticker,
+                name=asset.name,
+                exchange="",
+                type=_ASSET_TYPE_LABELS.get(asset.type, ""),
+            ),
+            isin=asset.isin,
+            aliases=(asset.ticker,),
+        )
+        if changed:
+            self.cache.clear()
+
+    def search(self, query: str, max_results: int = 10,
+               more: bool = False) -> list[TickerSearchResult]:
+        """Risultati per la query; con more=True il provider viene interrogato anche
+        se l'indice ha gia' risultati forti. Solleva l'errore del provider solo se
+        non ci sono risultati locali da restituire."""
+        key = (_normalize(query), max_results, more)
+        try:
+            return self.cache.get_or_load(key, lambda: self._lookup(query, max_results, more))
+        except _LocalOnly as exc:
+            return exc.results
+
+    async def search_async(self, query: str, max_results: int = 10,
+                           more: bool = False) -> list[TickerSearchResult]:
+        """Come search, eseguita sull'executor delle quotazioni (per gli handler async)."""
+        return await run_io(self.search, query, max_results, more)
+
+    def _lookup(self, query: str, max_results: int, more: bool) -> list[TickerSearchResult]:
+        ranked = self.index.ranked(query, max_results)
+        local = [item for _, item in ranked]
+        if not more and ranked and (ranked[0][0] <= STRONG_RANK or len(local) >= max_results):
+            return local
+
+        with self._lock:
+            self.remote_calls += 1
+        try:
+            remote = self.provider.search(query, max_results=max_results)
+        except Exception as exc:
+            if local:
+                raise _LocalOnly(local) from exc
+            raise
+        for item in remote:
+            self.index.add(item)
+
+        # Prima i risultati remoti (ordine di rilevanza del provider), poi i locali mancanti
+        seen = {r.symbol for r in remote}
+        merged = list(remote) + [r for r in local if r.symbol not in seen]
+        return merged[:max_results]
+
+    def clear(self):
+        self.cache.clear()
+
+
+ticker_search = TickerSearch()
@@ -0,0 +1,136 @@
+"""Dati iniziali: asset di esempio, strategia predefinita e template.
+
+Usato dalla migrazione che crea il portafoglio predefinito e da
+POST /api/portfolios con seed=True.
+"""
+from datetime import datetime, timezone
+
+from sqlalchemy import insert
+from sqlalchemy.orm import Session
+
+from models import Asset, Cash, DataVersion, Portfolio, Strategy, StrategyHistory, StrategyTarget
+
+SEED_DATA = [
+    {
+        "id": "world",
+        "name": "MSCI AC World",
+        "ticker": "Xtrackers MSCI AC World Scr. UCITS ETF 1C",
+        "type": "etf",
+        "qty": 211,
+        "pmc": 40.0320,
+        "price": 44.6650,
+        "target_pct": 70,
+    },
+    {
+        "id": "em",
+        "name": "Emerging Markets",
+        "ticker": "Xtrackers MSCI Emerging Markets UCITS ETF 1C",
+        "type": "etf",
+        "qty": 15,
+        "pmc": 64.4460,
+        "price": 71.7520,
+        "target_pct": 15,
+    },
+    {
+        "id": "gold",
+        "name": "Gold ETC",
+        "ticker": "Invesco Physical Gold ETC",
+        "type": "etc",
+        "qty": 2,
+        "pmc": 272.0300,
+        "price": 409.0900,
+        "target_pct": 10,
+    },
+    {
+        "id": "bond13",
+        "name": "Bond 1-3Y",
+        "ticker": "iShares EUR Govt Bond 1-3yr UCITS ETF EUR (Acc)",
+        "type": "etf",
+        "qty": 32,
+        "pmc": 114.0963,
+        "price": 116.4300,
+        "target_pct": 5,
+    },
+    {
+        "id": "bond710",
+        "name": "Bond 7-10Y",
+        "ticker": "Amundi Euro Government Bond 7-10Y UCITS ETF Acc",
+        "type": "etf",
+        "qty": 17,
+        "pmc": 166.2000,
+        "price": 172.4300,
+        "target_pct": 0,
+    },
+]
+
+# Template pronti all'uso, sugli asset di SEED_DATA
+STRATEGY_TEMPLATES = [
+    ("Aggressiva 20Y", "Orizzonte lungo, forte azionario",
+     {"world": 75, "em": 15, "gold": 5, "bond13": 0, "bond710": 0, "cash": 5}),
+    ("Moderata 10Y", "Bilanciata, orizzonte medio",
+     {"world": 50, "em": 10, "gold": 10, "bond13": 15, "bond710": 5, "cash": 10}),
+    ("Pre-pensione", "Conservativa, alta liquidita e bond",
+     {"world": 30, "em": 5, "gold": 10, "bond13": 25, "bond710": 10, "cash": 20}),
+]
+
+
+def ensure_portfolio(db: Session, portfolio_id: int, name: str):
+    """Crea portafoglio, riga di liquidita' e contatore di versione se mancano."""
+    if db.get(Portfolio, portfolio_id) is None:
+        db.add(Portfolio(id=portfolio_id, name=name))
+    if db.query(Cash.id).filter(Cash.portfolio_id == portfolio_id).first() is None:
+        db.add(Cash(portfolio_id=portfolio_id, amount=0, target_pct=0))
+    if db.get(DataVersion, portfolio_id) is None:
+        db.add(DataVersion(id=portfolio_id, version=0))
+    db.commit()
+
+
+def seed_portfolio(db: Session, portfolio_id: int):
+    """Asset di esempio, strategia predefinita e template, solo dove mancano.
+
+    Due letture in tutto (esistenza di un asset e nomi delle strategie) e un solo commit;
+    i target delle strategie nuove sono un solo INSERT dopo il flush che assegna gli id.
+    """
+    has_assets = db.query(Asset.id).filter(Asset.portfolio_id == portfolio_id).first() is not None
+    strategy_names = {
+        name for (name,) in db.query(Strategy.name).filter(Strategy.portfolio_id == portfolio_id)
+    }
+
+    if not has_assets:
+        db.add_all(Asset(portfolio_id=portfolio_id, **item) for item in SEED_DATA)
+
+    new_strategies = []
+
+    # Strategia predefinita (solo se non ne esiste nessuna)
+    if not strategy_names:
+        seed_targets = {s["id"]: s["target_pct"] for s in SEED_DATA}
+        seed_targets["cash"] = 0
+        now = datetime.now(timezone.utc)
+        new_strategies.append((Strategy(
+            portfolio_id=portfolio_id,
+            name="Predefinita",
+            description="Allocazione iniziale del portafoglio",
+            is_active=True,
+            activated_at=now,
+        ), seed_targets))
+        db.add(StrategyHistory(
+            portfolio_id=portfolio_id,
+            strategy_name="Predefinita",
+            activated_at=now,
+        ))
+
+    # Template pronti all'uso: aggiunge solo quelli che non esistono gia'
+    new_strategies.extend(
+        (Strategy(portfolio_id=portfolio_id, name=name, description=desc), targets)
+        for name, desc, targets in STRATEGY_TEMPLATES
+        if name not in strategy_names
+    )
+    if new_strategies:
+        db.add_all(strategy for strategy, _ in new_strategies)
+        db.flush()
+        db.execute(insert(StrategyTarget), [
+            {"strategy_id": strategy.id, "portfolio_id": portfolio_id, "asset_key": key, "pct": pct}
+            for strategy, targets in new_strategies
+            for key, pct in targets.items()
+        ])
+    db.commit()
@@ -0,0 +1,156 @@
+"""Snapshot giornalieri del portafoglio: scrittura lato server e lettura a finestre.
+
+Totali valorizzati con un'unica query aggregata su assets + cash e scritti con
+INSERT ... ON CONFLICT(portfolio_id, date) DO NOTHING: lo snapshot di un giorno
+viene scritto una sola volta per portafoglio, anche con piu' scritture
+concorrenti (scheduler + click manuale).
+In lettura la serie si puo' filtrare per date, paginare e ridurre (settimanale,
+mensile o LTTB) cosi' il payload dei grafici resta costante al crescere dello storico.
+"""
+from datetime import datetime, timezone
+
+import numpy as np
+from sqlalchemy import func, text
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.orm import Session
+
+from models import Snapshot
+from valuation import bump_version
+
+_TOTALS_SQL = text("""
+    SELECT
+        COALESCE((SELECT SUM(price * qty) FROM assets WHERE portfolio_id = :pid), 0)
+            + COALESCE((SELECT amount FROM cash WHERE portfolio_id = :pid), 0) AS total_value,
+        COALESCE((SELECT SUM(pmc * qty) FROM assets WHERE portfolio_id = :pid), 0)
+            + COALESCE((SELECT amount FROM cash WHERE portfolio_id = :pid), 0) AS total_invested
+""")
+
+
+def portfolio_totals(db: Session, portfolio_id: int) -> tuple[float, float]:
+    """(valore totale, investito totale) inclusa la liquidita', in una sola query."""
+    row = db.execute(_TOTALS_SQL, {"pid": portfolio_id}).one()
+    return float(row.total_value), float(row.total_invested)
+
+
+def write_daily_snapshot(db: Session, portfolio_id: int,
+                         day: str | None = None) -> tuple[Snapshot, bool]:
+    """Scrive lo snapshot del giorno se non esiste gia'.
+
+    Restituisce (snapshot del giorno, True se appena creato).
+    """
+    day = day or datetime.now(timezone.utc).date().isoformat()
+    total_value, total_invested = portfolio_totals(db, portfolio_id)
+    result = db.execute(
+        insert(Snapshot)
+        .values(
+            portfolio_id=portfolio_id,
+            date=day,
+            total_value=round(total_value, 2),
+            total_invested=round(total_invested, 2),
+            created_at=datetime.now(timezone.utc),
+        )
+        .on_conflict_do_nothing(index_elements=[Snapshot.portfolio_id, Snapshot.date])
+    )
+    created = result.rowcount > 0
+    if created:
+        bump_version(db, portfolio_id)
+    db.commit()
+    snap = db.query(Snapshot).filter(
+        Snapshot.portfolio_id == portfolio_id, Snapshot.date == day,
+    ).one()
+    return snap, created
+
+
+# ---------------------------------------------------------------------------
+# Lettura: finestre temporali, paginazione e downsampling
+# ---------------------------------------------------------------------------
+RESOLUTIONS = {"daily", "weekly", "monthly", "lttb"}
+
+# Bucket SQLite per risoluzione: per ogni bucket si tiene l'ultimo snapshot.
+# La settimana e' identificata dal suo lunedi' (il prossimo domenica - 6 giorni),
+# cosi' quella a cavallo di Capodanno resta un solo bucket (con %W sarebbero due)
+_BUCKETS = {
+    "weekly": lambda day: func.date(day, "weekday 0", "-6 days"),
+    "monthly": lambda day: func.strftime("%Y-%m", day),
+}
+
+
+def query_snapshots(db: Session, portfolio_id: int, date_from: str | None = None,
+                    date_to: str | None = None, resolution: str = "daily",
+                    limit: int | None = None, cursor: str | None = None,
+                    points: int = 200) -> list:
+    """Snapshot ordinati per data nella finestra [date_from, date_to].
+
+    - daily: tutte le righe; con limit/cursor paginazione keyset su date (> cursor)
+    - weekly / monthly: ultimo snapshot di ogni settimana/mese, aggregato in SQL
+    - lttb: Largest-Triangle-Three-Buckets su total_value, al massimo `points` righe
+    """
+    query = db.query(Snapshot).filter(Snapshot.portfolio_id == portfolio_id)
+    if date_from:
+        query = query.filter(Snapshot.date >= date_from)
+    if date_to:
+        query = query.filter(Snapshot.date <= date_to)
+
+    if resolution == "lttb":
+        # Solo colonne (niente oggetti ORM): su decine di migliaia di righe e' molto piu' veloce
+        rows = query.with_entities(
+            Snapshot.id, Snapshot.date, Snapshot.total_value, Snapshot.total_invested,
+        ).order_by(Snapshot.date).all()
+        return lttb(rows, points)
+
+    if resolution in _BUCKETS:
+        bucket = _BUCKETS[resolution](Snapshot.date)
+        last_dates = (
+            query.with_entities(func.max(Snapshot.date))
+            .group_by(bucket)
+            .scalar_subquery()
+        )
+        query = db.query(Snapshot).filter(
+            Snapshot.portfolio_id == portfolio_id, Snapshot.date.in_(last_dates),
+        )
+
+    if cursor:
+        query = query.filter(Snapshot.date > cursor)
+    query = query.order_by(Snapshot.date)
+    if limit:
+        query = query.limit(limit)
+    return query.all()
+
+
+def lttb(rows: list, threshold: int) -> list:
+    """Downsampling Largest-Triangle-Three-Buckets (Steinarsson, 2013).
+
+    Conserva primo e ultimo punto e, per ogni bucket intermedio, lo snapshot che
+    forma il triangolo di area massima con il punto scelto prima e la media del
+    bucket successivo: la forma della curva resta fedele anche con pochi punti.
+    L'asse x e' l'indice della riga (gli snapshot sono giornalieri). Medie dei
+    bucket da somme cumulate e aree di ogni bucket calcolate in NumPy: resta un
+    solo ciclo Python sui `threshold` bucket, non sulle righe.
+    """
+    n = len(rows)
+    if threshold >= n or threshold < 3:
+        return rows
+
+    values = np.fromiter((r.total_value for r in rows), dtype=float, count=n)
+    cumsum = np.concatenate(([0.0], np.cumsum(values)))
+    sampled = [rows[0]]
+    every = (n - 2) / (threshold - 2)
+    a = 0
+    for i in range(threshold - 2):
+        # Media del bucket successivo
+        nxt_start = int((i + 1) * every) + 1
+        nxt_end = min(int((i + 2) * every) + 1, n)
+        avg_x = (nxt_start + nxt_end - 1) / 2
+        avg_y = (cumsum[nxt_end] - cumsum[nxt_start]) / (nxt_end - nxt_start)
+
+        # Punto del bucket corrente con area massima (il primo a parita' di area)
+        start = int(i * every) + 1
+        end = int((i + 1) * every) + 1
+        ax, ay = a, values[a]
+        x = np.arange(start, end)
+        area = np.abs((ax - avg_x) * (values[start:end] - ay) - (ax - x) * (avg_y - ay))
+        a = start + int(np.argmax(area))
+        sampled.append(rows[a])
+
+    sampled.append(rows[-1])
+    return sampled
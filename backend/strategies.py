@@ -0,0 +1,90 @@
+"""Target delle strategie (tabella strategy_targets).
+
+Ogni target e' una riga (strategy_id, asset_key, pct); la chiave "cash" e' la
+liquidita'. Le operazioni sono query sull'insieme delle righe, senza leggere e
+riscrivere JSON: eliminare un asset e' un DELETE sull'indice
+(portfolio_id, asset_key), attivare una strategia e' un UPDATE degli asset con
+i valori della strategia, elencare le strategie e' una sola SELECT per portafoglio
+che raggruppa i target in SQLite (json_group_object), una riga per strategia.
+"""
+import json
+from datetime import datetime
+
+from sqlalchemy import exists, func, insert, select, update
+from sqlalchemy.orm import Session
+
+from models import Asset, Cash, StrategyTarget
+
+_T = StrategyTarget.__table__
+
+
+def targets_by_strategy(db: Session, portfolio_id: int,
+                        strategy_ids: list[int] | None = None) -> dict[int, dict[str, float]]:
+    """Target delle strategie del portafoglio (o solo di strategy_ids), per chiave."""
+    query = (
+        select(_T.c.strategy_id, func.json_group_object(_T.c.asset_key, _T.c.pct))
+        .where(_T.c.portfolio_id == portfolio_id)
+        .group_by(_T.c.strategy_id)
+    )
+    if strategy_ids is not None:
+        query = query.where(_T.c.strategy_id.in_(strategy_ids))
+    return {strategy_id: json.loads(targets) for strategy_id, targets in db.execute(query)}
+
+
+def unknown_keys(db: Session, portfolio_id: int, keys) -> list[str]:
+    """Chiavi che non sono "cash" ne' un asset del portafoglio, con una sola
+    query: le chiavi arrivano come array JSON e vengono confrontate con gli
+    asset in SQLite (json_each ... NOT IN)."""
+    keys = json.dumps(list(keys))
+    given = func.json_each(keys).table_valued("value")
+    query = select(given.c.value).where(
+        given.c.value != "cash",
+        given.c.value.not_in(select(Asset.id).where(Asset.portfolio_id == portfolio_id)),
+    )
+    return list(db.scalars(query))
+
+
+def set_targets(db: Session, strategy, targets: dict[str, float]):
+    """Sostituisce i target di una strategia (che deve avere gia' un id)."""
+    delete_targets(db, strategy.portfolio_id, strategy.id)
+    if targets:
+        db.execute(insert(StrategyTarget), [
+            {"portfolio_id": strategy.portfolio_id, "strategy_id": strategy.id,
+             "asset_key": key, "pct": pct}
+            for key, pct in targets.items()
+        ])
+
+
+def delete_targets(db: Session, portfolio_id: int, strategy_id: int):
+    db.query(StrategyTarget).filter(
+        StrategyTarget.portfolio_id == portfolio_id, StrategyTarget.strategy_id == strategy_id,
+    ).delete()
+
+
+def remove_asset_key(db: Session, portfolio_id: int, asset_key: str):
+    """Toglie un asset da tutte le strategie del portafoglio."""
+    db.query(StrategyTarget).filter(
+        StrategyTarget.portfolio_id == portfolio_id, StrategyTarget.asset_key == asset_key,
+    ).delete()
+
+
+def activate_targets(db: Session, portfolio_id: int, strategy_id: int, now: datetime):
+    """Copia i target della strategia su Asset e Cash con due UPDATE; le chiavi
+    senza asset vengono ignorate, gli asset senza chiave restano invariati."""
+    a = Asset.__table__
+    own = (_T.c.portfolio_id == portfolio_id) & (_T.c.strategy_id == strategy_id)
+    db.execute(
+        update(a)
+        .where(a.c.portfolio_id == portfolio_id,
+               a.c.id.in_(select(_T.c.asset_key).where(own)))
+        .values(
+            target_pct=select(_T.c.pct).where(own, _T.c.asset_key == a.c.id).scalar_subquery(),
+            updated_at=now,
+        )
+    )
+    cash = select(_T.c.pct).where(own, _T.c.asset_key == "cash")
+    db.execute(
+        update(Cash.__table__)
+        .where(Cash.__table__.c.portfolio_id == portfolio_id, exists(cash))
+        .values(target_pct=cash.scalar_subquery(), updated_at=now)
+    )
@@ -0,0 +1,127 @@
+"""Regressioni del registro movimenti: qty/PMC di un asset con movimenti non si
+modificano a mano, quindi posizione e registro restano allineati sia con i
+movimenti in coda (O(1)) sia con quelli retrodatati (ricalcolo completo).
+
+    cd backend && python -m pytest -q test_ledger.py
+"""
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.orm import sessionmaker
+
+import database
+import jobs
+import ledger
+import main
+import polling
+from analytics import window_cache
+from main import app
+from migrations import run_migrations
+from models import Transaction
+from valuation import valuation_cache
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    path = tmp_path / "portfolio.db"
+    engine = create_engine(f"sqlite:///{path}")
+    async_engine = create_async_engine(f"sqlite+aiosqlite:///{path}")
+    run_migrations(engine)
+    # Sessioni sul database temporaneo; monkeypatch ripristina quelle originali
+    session_local = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    async_session_local = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+    for module in (database, main, jobs, polling):
+        monkeypatch.setattr(module, "SessionLocal", session_local)
+    for module in (database, main):
+        monkeypatch.setattr(module, "AsyncSessionLocal", async_session_local)
+    valuation_cache.clear()
+    window_cache.clear()
+    # Senza "with": niente startup, quindi niente scheduler ne' polling
+    yield TestClient(app)
+    valuation_cache.clear()
+    window_cache.clear()
+    async_engine.sync_engine.dispose()
+    engine.dispose()
+
+
+def _add_asset(client, qty=220, pmc=10.0):
+    r = client.post("/api/assets", json={
+        "id": "test", "name": "Test", "ticker": "TST", "qty": qty, "pmc": pmc, "price": 12.0,
+    })
+    assert r.status_code == 201, r.text
+    assert r.json()["ledger"] is False
+
+
+def _buy(client, day, qty=1, price=10.0):
+    r = client.post("/api/transactions", json={
+        "asset_id": "test", "date": day, "type": "buy", "qty": qty, "price": price,
+    })
+    assert r.status_code == 201, r.text
+
+
+def _position(client):
+    asset = next(e for e in client.get("/api/portfolio").json()["etfs"] if e["id"] == "test")
+    return asset["qty"], asset["pmc"], asset["ledger"]
+
+
+def _ledger_position():
+    with database.SessionLocal() as db:
+        rows = (
+            db.query(Transaction.type, Transaction.qty, Transaction.price, Transaction.fee)
+            .filter(Transaction.asset_id == "test")
+            .order_by(Transaction.date, Transaction.id)
+            .all()
+        )
+    return ledger.replay(rows)
+
+
+def test_hand_edit_allowed_before_first_transaction(client):
+    _add_asset(client)
+    r = client.put("/api/assets/test", json={"qty": 300})
+    assert r.status_code == 200
+    _buy(client, "2024-01-10")
+    qty, _, tracked = _position(client)
+    assert (qty, tracked) == (301, True)    # saldo iniziale 300 + 1
+
+
+def test_backdated_transaction_after_rejected_hand_edit(client):
+    _add_asset(client)
+    _buy(client, "2024-03-01")
+    assert _position(client)[0] == 221
+
+    r = client.put("/api/assets/test", json={"qty": 999})
+    assert r.status_code == 400
+    r = client.put("/api/assets/test", json={"pmc": 1.0})
+    assert r.status_code == 400
+    assert _position(client)[0] == 221
+
+    _buy(client, "2024-01-01")              # retrodatato: ricalcolo dal registro
+    qty, pmc, _ = _position(client)
+    assert (qty, pmc) == pytest.approx(_ledger_position())
+    assert qty == 222
+
+
+def test_append_after_rejected_bulk_edit(client):
+    _add_asset(client)
+    _buy(client, "2024-03-01")
+
+    r = client.patch("/api/assets", json={"assets": [
+        {"id": "test", "qty": 500},
+        {"id": "world", "price": 1.0},
+    ]})
+    assert r.status_code == 400
+    assert "test" in r.json()["detail"]
+    # Tutto o niente: anche la modifica valida non e' stata applicata
+    world = next(e for e in client.get("/api/portfolio").json()["etfs"] if e["id"] == "world")
+    assert world["price"] != 1.0
+
+    # Solo prezzo e ticker restano modificabili
+    r = client.patch("/api/assets", json={"assets": [{"id": "test", "price": 13.0}]})
+    assert r.status_code == 200
+    assert r.json()["assets"][0]["ledger"] is True
+
+    _buy(client, "2024-03-02", price=14.0)  # in coda: aggiornamento O(1)
+    qty, pmc, _ = _position(client)
+    assert (qty, pmc) == pytest.approx(_ledger_position())
+    assert qty == 222
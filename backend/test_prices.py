@@ -0,0 +1,134 @@
+"""Aggiornamento prezzi offline con LocalQuoteProvider (fixtures/quotes.json):
+conteggi, conversione in EUR, errori del fixture ed errori simulati sempre uguali.
+
+    cd backend && python -m pytest -q test_prices.py
+"""
+import json
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+
+from migrations import run_migrations
+from models import Asset, PriceHistory
+from prices import refresh_prices
+from quotes import LocalQuoteProvider
+from valuation import current_version
+
+# id asset -> yahoo_ticker (None = senza ticker, saltato)
+ASSETS = {
+    "world": "XMAW.MI",         # EUR
+    "apple": "AAPL",            # USD, cambio 1.08
+    "sp500": "VUSA.L",          # GBP, cambio 0.85
+    "old": "DELISTED.MI",       # "error" nel fixture
+    "manual": None,
+}
+
+
+@pytest.fixture
+def db(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'portfolio.db'}")
+    run_migrations(engine)
+    with Session(engine) as session:
+        session.query(Asset).filter(Asset.portfolio_id == 1).delete()
+        session.add_all(
+            Asset(portfolio_id=1, id=asset_id, name=asset_id, ticker=asset_id,
+                  yahoo_ticker=symbol, qty=1, pmc=1, price=1, target_pct=0)
+            for asset_id, symbol in ASSETS.items()
+        )
+        session.commit()
+        yield session
+    engine.dispose()
+
+
+def _by_id(out):
+    return {r.id: r for r in out.results}
+
+
+def test_refresh_counts_and_eur_prices(db):
+    out = refresh_prices(db, 1, provider=LocalQuoteProvider())
+    assert (out.updated, out.skipped, out.errors) == (3, 1, 1)
+
+    results = _by_id(out)
+    assert results["world"].new_price == 44.665
+    assert results["apple"].new_price == round(227.48 / 1.08, 4)
+    assert results["sp500"].new_price == round(88.21 / 0.85, 4)
+    assert results["manual"].status == "skipped"
+    assert results["old"].status == "error" and results["old"].new_price == 1
+
+    prices = dict(db.query(Asset.id, Asset.price).filter(Asset.portfolio_id == 1))
+    assert prices["world"] == 44.665 and prices["old"] == 1
+    assert db.query(PriceHistory).count() == 3
+
+
+def test_unchanged_refresh_keeps_version(db):
+    provider = LocalQuoteProvider()
+    refresh_prices(db, 1, provider=provider)
+    version = current_version(db, 1)
+
+    out = refresh_prices(db, 1, provider=provider)
+    assert (out.updated, out.skipped, out.errors) == (3, 1, 1)
+    assert current_version(db, 1) == version
+    assert db.query(PriceHistory).count() == 3
+
+
+def test_simulated_errors_are_deterministic(db):
+    symbols = [s for s in ASSETS.values() if s]
+    provider = LocalQuoteProvider(error_rate=0.5, seed=7)
+    failing = set()
+    for symbol in symbols:
+        try:
+            provider.get_quote(symbol)
+        except ValueError:
+            failing.add(symbol)
+    assert 0 < len(failing) < len(symbols)
+
+    first = refresh_prices(db, 1, provider=provider)
+    second = refresh_prices(db, 1, provider=LocalQuoteProvider(error_rate=0.5, seed=7))
+    errors = {r.id for r in first.results if r.status == "error"}
+    assert errors == {r.id for r in second.results if r.status == "error"}
+    assert errors == {asset_id for asset_id, s in ASSETS.items() if s in failing}
+    assert first.errors == len(failing)
+    assert first.updated == len(symbols) - len(failing)
+
+
+class _CountingFx(LocalQuoteProvider):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.fx_calls = []
+
+    def get_fx_rate(self, currency):
+        self.fx_calls.append(currency)
+        return super().get_fx_rate(currency)
+
+
+def test_missing_fx_rate_is_an_error(db, tmp_path):
+    fixture = tmp_path / "quotes.json"
+    fixture.write_text(json.dumps({
+        "quotes": {
+            "7203.T": {"price": 2800, "currency": "JPY"},
+            "6758.T": {"price": 3100, "currency": "JPY"},
+            "NESN.SW": {"price": 90, "currency": "CHF"},
+        },
+        "fx": {"CHF": 0.94},
+    }))
+    db.query(Asset).filter(Asset.portfolio_id == 1).delete()
+    db.add_all(
+        Asset(portfolio_id=1, id=symbol, name=symbol, ticker=symbol, yahoo_ticker=symbol,
+              qty=1, pmc=1, price=1, target_pct=0)
+        for symbol in ("7203.T", "6758.T", "NESN.SW")
+    )
+    db.commit()
+
+    provider = _CountingFx(path=str(fixture))
+    out = refresh_prices(db, 1, provider=provider)
+    assert (out.updated, out.skipped, out.errors) == (1, 0, 2)
+    results = _by_id(out)
+    assert results["NESN.SW"].new_price == round(90 / 0.94, 4)
+    for symbol in ("7203.T", "6758.T"):
+        assert results[symbol].status == "error"
+        assert "EUR/JPY" in results[symbol].error
+    # Nessun prezzo non convertito scritto come EUR; un solo tentativo per valuta
+    prices = dict(db.query(Asset.id, Asset.price).filter(Asset.portfolio_id == 1))
+    assert prices["7203.T"] == 1 and prices["6758.T"] == 1
+    assert sorted(provider.fx_calls) == ["CHF", "JPY"]
@@ -0,0 +1,62 @@
+"""Ricerca ticker offline con LocalQuoteProvider (fixtures/quotes.json): risultati
+del provider, risposte dall'indice locale senza rete e ripiego sui risultati locali.
+
+    cd backend && python -m pytest -q test_search.py
+"""
+import pytest
+
+from quotes import LocalQuoteProvider
+from search import TickerSearch
+
+
+class _Down(LocalQuoteProvider):
+    """Provider che non risponde alle ricerche."""
+
+    def search(self, query, max_results=10):
+        raise ValueError("provider non raggiungibile")
+
+
+def _symbols(results):
+    return [r.symbol for r in results]
+
+
+def test_remote_results_from_fixture():
+    searcher = TickerSearch(provider=LocalQuoteProvider())
+    assert _symbols(searcher.search("apple")) == ["AAPL"]
+    assert _symbols(searcher.search("IE00BK5BQT80")) == ["VWCE.DE"]
+    # Simbolo con "error" nel fixture: mai tra i risultati
+    assert searcher.search("delisted") == []
+    assert searcher.remote_calls == 3
+
+
+def test_known_instruments_answered_locally():
+    searcher = TickerSearch(provider=LocalQuoteProvider())
+    searcher.search("vanguard")
+    calls = searcher.remote_calls
+
+    assert _symbols(searcher.search("vangu"))[0] in ("VWCE.DE", "VUSA.L")
+    assert "VWCE.DE" in _symbols(searcher.search("Vanguard FTSE"))
+    assert _symbols(searcher.search("vwce.de")) == ["VWCE.DE"]
+    assert searcher.remote_calls == calls
+
+    # Richiesta esplicita di altri risultati: il provider viene interrogato
+    searcher.search("vangu", more=True)
+    assert searcher.remote_calls == calls + 1
+
+
+def test_cached_query_is_not_repeated():
+    searcher = TickerSearch(provider=LocalQuoteProvider())
+    first = searcher.search("msci")
+    assert searcher.search("  MSCI ") == first
+    assert searcher.remote_calls == 1
+
+
+def test_provider_down_falls_back_to_local():
+    searcher = TickerSearch(provider=LocalQuoteProvider())
+    searcher.search("xtrackers")
+    searcher._provider = _Down()
+
+    # Sottostringa senza prefisso: serve il provider, che fallisce
+    assert set(_symbols(searcher.search("trackers"))) == {"XMAW.MI", "XMME.MI"}
+    with pytest.raises(ValueError):
+        searcher.search("bitcoin")
@@ -0,0 +1,199 @@
+"""Cache in memoria della valorizzazione dei portafogli.
+
+Gli endpoint di lettura (portfolio, summary, rebalance) usano tutti le stesse
+righe Asset + Cash e gli stessi totali: invece di rileggere la tabella a ogni
+richiesta, la valorizzazione viene calcolata una volta e riusata finche' il
+contatore di versione del portafoglio non cambia.
+
+I contatori vivono nel database (tabella data_version, una riga per portafoglio)
+e ogni endpoint di scrittura incrementa quello del proprio portafoglio nella
+stessa transazione con bump_version(): l'invalidazione vale anche tra piu' worker
+uvicorn e per le scritture dello scheduler, e una scrittura su un portafoglio non
+invalida gli altri. Il costo di una lettura in cache e' una SELECT per chiave primaria.
+
+bump_version e' anche il punto di aggancio per le notifiche di modifica: i
+portafogli toccati vengono annotati nella sessione e, a commit riuscito, passati
+alle callback registrate con on_data_change (es. il canale push live.py).
+
+Gli handler async leggono con get_async() su una AsyncSession (aiosqlite): stessa
+cache e stesso calcolo, eseguito con run_sync senza bloccare l'event loop.
+"""
+import threading
+from dataclasses import dataclass, field
+
+from sqlalchemy import event, text
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from models import Asset, Cash, Transaction
+
+
+@dataclass(frozen=True)
+class AssetRow:
+    """Copia immutabile di una riga Asset, sicura da condividere tra thread."""
+    id: str
+    name: str
+    ticker: str
+    yahoo_ticker: str | None
+    isin: str | None
+    type: str
+    qty: float
+    pmc: float
+    price: float
+    target_pct: float
+    ledger: bool = False        # ha movimenti: qty/pmc derivano dal registro
+
+    @property
+    def value(self) -> float:
+        return self.price * self.qty
+
+
+@dataclass(frozen=True)
+class Valuation:
+    portfolio_id: int
+    version: int
+    assets: tuple[AssetRow, ...]
+    cash_amount: float
+    cash_target_pct: float
+    total_value: float          # asset + liquidita', non arrotondato
+    total_invested: float       # costo asset + liquidita', non arrotondato
+    memo: dict = field(default_factory=dict, repr=False, compare=False)
+
+    def weight_pct(self, value: float) -> float:
+        return round((value / self.total_value * 100) if self.total_value else 0, 2)
+
+    def cached(self, key, build):
+        """Risultato derivato (es. PortfolioOut) calcolato una sola volta per versione."""
+        if key not in self.memo:
+            self.memo[key] = build()
+        return self.memo[key]
+
+
+# ---------------------------------------------------------------------------
+# Contatore di versione dei dati
+# ---------------------------------------------------------------------------
+_VERSION_SQL = text("SELECT version FROM data_version WHERE id = :id")
+
+
+def current_version(db: Session, portfolio_id: int) -> int | None:
+    """Versione dei dati del portafoglio; None se il portafoglio non esiste."""
+    row = db.execute(_VERSION_SQL, {"id": portfolio_id}).first()
+    return row[0] if row else None
+
+
+async def current_version_async(db: AsyncSession, portfolio_id: int) -> int | None:
+    row = (await db.execute(_VERSION_SQL, {"id": portfolio_id})).first()
+    return row[0] if row else None
+
+
+def bump_version(db: Session, *portfolio_ids: int):
+    """Incrementa la versione dei portafogli indicati. Va chiamata prima del commit."""
+    db.execute(
+        text("UPDATE data_version SET version = version + 1 WHERE id = :id"),
+        [{"id": p} for p in portfolio_ids],
+    )
+    db.info.setdefault("changed_portfolios", set()).update(portfolio_ids)
+
+
+# ---------------------------------------------------------------------------
+# Notifiche di modifica
+# ---------------------------------------------------------------------------
+_change_listeners = []
+
+
+def on_data_change(callback):
+    """Registra callback(portfolio_ids) chiamata dopo ogni commit che ha
+    incrementato la versione di qualche portafoglio (nel thread del commit)."""
+    _change_listeners.append(callback)
+
+
+@event.listens_for(Session, "after_commit")
+def _notify_changes(session: Session):
+    changed = session.info.pop("changed_portfolios", None)
+    if changed:
+        for callback in _change_listeners:
+            callback(frozenset(changed))
+
+
+@event.listens_for(Session, "after_rollback")
+def _forget_changes(session: Session):
+    session.info.pop("changed_portfolios", None)
+
+
+# ---------------------------------------------------------------------------
+# Cache
+# ---------------------------------------------------------------------------
+def _compute(db: Session, portfolio_id: int, version: int) -> Valuation:
+    tracked = {
+        asset_id for asset_id, in
+        db.query(Transaction.asset_id).filter(Transaction.portfolio_id == portfolio_id).distinct()
+    }
+    assets = tuple(
+        AssetRow(
+            id=a.id, name=a.name, ticker=a.ticker, yahoo_ticker=a.yahoo_ticker,
+            isin=a.isin, type=a.type or "etf", qty=a.qty, pmc=a.pmc,
+            price=a.price, target_pct=a.target_pct, ledger=a.id in tracked,
+        )
+        # Ordine di inserimento (rowid), come nella lista del frontend
+        for a in db.query(Asset).filter(Asset.portfolio_id == portfolio_id).order_by(text("assets.rowid"))
+    )
+    cash = db.query(Cash.amount, Cash.target_pct).filter(Cash.portfolio_id == portfolio_id).first()
+    cash_amount = cash.amount if cash else 0.0
+    cash_target = cash.target_pct if cash else 0.0
+    return Valuation(
+        portfolio_id=portfolio_id,
+        version=version,
+        assets=assets,
+        cash_amount=cash_amount,
+        cash_target_pct=cash_target,
+        total_value=sum(a.value for a in assets) + cash_amount,
+        total_invested=sum(a.pmc * a.qty for a in assets) + cash_amount,
+    )
+
+
+class ValuationCache:
+    """Una valorizzazione per portafoglio, sostituita quando la versione cambia."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._valuations: dict[int, Valuation] = {}
+
+    def get(self, db: Session, portfolio_id: int) -> Valuation:
+        # La versione va letta prima delle righe: se una scrittura arriva nel mezzo,
+        # la cache resta etichettata con la versione vecchia e alla prossima
+        # lettura viene ricalcolata.
+        version = current_version(db, portfolio_id) or 0
+        cached = self._valuations.get(portfolio_id)
+        if cached is not None and cached.version == version:
+            return cached
+        with self._lock:
+            cached = self._valuations.get(portfolio_id)
+            if cached is not None and cached.version == version:
+                return cached
+            cached = _compute(db, portfolio_id, version)
+            self._valuations[portfolio_id] = cached
+            return cached
+
+    async def get_async(self, db: AsyncSession, portfolio_id: int,
+                        version: int | None = None) -> Valuation:
+        """Come get() per gli handler async; version se gia' letta (es. per l'ETag).
+        Senza lock tra le richieste: due ricalcoli concorrenti della stessa
+        versione danno lo stesso risultato."""
+        if version is None:
+            version = await current_version_async(db, portfolio_id) or 0
+        cached = self._valuations.get(portfolio_id)
+        if cached is not None and cached.version == version:
+            return cached
+        cached = await db.run_sync(_compute, portfolio_id, version)
+        with self._lock:
+            self._valuations[portfolio_id] = cached
+        return cached
+
+    def discard(self, portfolio_id: int):
+        self._valuations.pop(portfolio_id, None)
+
+    def clear(self):
+        self._valuations = {}
+
+
+valuation_cache = ValuationCache()